@@ -0,0 +1,91 @@
+"""Servidor compatible con /v1/chat/completions de OpenAI para el benchmark
+
+Responde con un texto fijo tras una latencia configurable, con o sin stream, e
+informa el uso de tokens como lo haría DeepSeek.
+
+Variables de entorno:
+    FAKE_LLM_LATENCY  segundos hasta completar la respuesta (0.8)
+    FAKE_LLM_TTFT     segundos hasta el primer fragmento en modo stream (0.2)
+    FAKE_LLM_TOKENS   fragmentos/tokens de la respuesta (60)
+
+    uvicorn bench.fake_llm:app --port 8902
+"""
+import os
+import json
+import time
+import asyncio
+from collections import Counter
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+LATENCY = float(os.getenv('FAKE_LLM_LATENCY', '0.8'))
+TTFT = float(os.getenv('FAKE_LLM_TTFT', '0.2'))
+TOKENS = int(os.getenv('FAKE_LLM_TOKENS', '60'))
+
+WORDS = ('Claro, con gusto te cuento sobre el programa. Tiene un enfoque práctico, '
+         'clases con docentes del sector y opciones de financiación. ').split()
+
+app = FastAPI()
+calls: Counter = Counter()
+
+def _text() -> list:
+    return [WORDS[i % len(WORDS)] + ' ' for i in range(TOKENS)]
+
+def _prompt_tokens(body: dict) -> int:
+    # Aproximación suficiente para el benchmark: unas cuatro letras por token
+    return sum(len(m.get('content') or '') for m in body.get('messages', [])) // 4 + 1
+
+def _chunk(body: dict, delta: dict, finish=None, usage=None) -> str:
+    payload = {
+        'id': 'bench', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': body.get('model', 'fake'),
+        'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish}]
+    }
+    if usage:
+        payload['usage'] = usage
+    return f"data: {json.dumps(payload)}\n\n"
+
+@app.get('/__stats')
+def stats():
+    return dict(calls)
+
+@app.post('/__reset')
+def reset():
+    calls.clear()
+    return {'status': 'ok'}
+
+@app.post('/v1/chat/completions')
+async def chat(request: Request):
+    body = await request.json()
+    calls['chat'] += 1
+    calls['model ' + str(body.get('model'))] += 1
+    prompt_tokens = _prompt_tokens(body)
+    calls['prompt_tokens'] += prompt_tokens
+    words = _text()
+    usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': len(words), 'total_tokens': prompt_tokens + len(words)}
+
+    if body.get('stream'):
+        calls['stream'] += 1
+
+        async def events():
+            try:
+                await asyncio.sleep(TTFT)
+                step = max(0.0, LATENCY - TTFT) / max(1, len(words))
+                yield _chunk(body, {'role': 'assistant', 'content': ''})
+                for word in words:
+                    yield _chunk(body, {'content': word})
+                    await asyncio.sleep(step)
+                yield _chunk(body, {}, finish='stop', usage=usage)
+                yield 'data: [DONE]\n\n'
+                calls['stream_completed'] += 1
+            except asyncio.CancelledError:
+                calls['stream_cancelled'] += 1
+                raise
+
+        return StreamingResponse(events(), media_type='text/event-stream')
+
+    await asyncio.sleep(LATENCY)
+    return JSONResponse({
+        'id': 'bench', 'object': 'chat.completion', 'created': int(time.time()), 'model': body.get('model', 'fake'),
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ''.join(words).strip()}, 'finish_reason': 'stop'}],
+        'usage': usage
+    })
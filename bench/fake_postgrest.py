@@ -0,0 +1,142 @@
+"""Servidor compatible con PostgREST para el benchmark
+
+Sirve en memoria las tablas que usa el servicio (chatbots, mensajes,
+programas_academicos, planes_estudio y conversaciones) con el subconjunto de la
+API que usa postgrest-py: select, filtros eq/gt/in, order, limit, offset, respuestas de
+un solo objeto, inserciones individuales o en lote y PATCH.
+
+Variables de entorno:
+    FAKE_DB_LATENCY   segundos añadidos a cada petición (0.005)
+    FAKE_CHATBOTS     número de chatbots (10)
+    FAKE_PROGRAMS     número de programas académicos (20)
+
+    uvicorn bench.fake_postgrest:app --port 8901
+"""
+import os
+import json
+import time
+import random
+import asyncio
+from collections import Counter
+from fastapi import FastAPI, Request, Response
+
+LATENCY = float(os.getenv('FAKE_DB_LATENCY', '0.005'))
+CHATBOTS = int(os.getenv('FAKE_CHATBOTS', '10'))
+PROGRAMS = int(os.getenv('FAKE_PROGRAMS', '20'))
+
+AREAS = ['Sistemas', 'Industrial', 'Civil', 'Administración', 'Contaduría', 'Psicología', 'Derecho', 'Enfermería', 'Diseño Gráfico', 'Mercadeo']
+LEVELS = [('Pregrado', 'Ingeniería en'), ('Especialización', 'Especialización en'), ('Maestría', 'Maestría en'), ('Tecnología', 'Tecnología en')]
+
+app = FastAPI()
+calls: Counter = Counter()
+tables: dict = {}
+
+def program_name(index: int) -> str:
+    level, prefix = LEVELS[index % len(LEVELS)]
+    area = AREAS[(index // len(LEVELS)) % len(AREAS)]
+    cohort = index // (len(LEVELS) * len(AREAS))
+    return f"{prefix} {area}" + (f" {cohort + 1}" if cohort else '')
+
+def reset_tables() -> None:
+    rng = random.Random(7)
+    tables.clear()
+    tables['chatbots'] = [
+        {'id': f'bot-{i}', 'nombre': f'Asesor {i}', 'contexto': 'Eres un asesor de admisiones de una universidad. Responde en español, de forma breve y amable.'}
+        for i in range(CHATBOTS)
+    ]
+    tables['programas_academicos'] = [
+        {
+            'id': f'prog-{i}',
+            'nombre': program_name(i),
+            'nivel': LEVELS[i % len(LEVELS)][0],
+            'modalidad': rng.choice(['Presencial', 'Virtual', 'Híbrida']),
+            'duracion': f"{rng.randint(2, 10)} semestres",
+            'creditos': rng.randint(30, 170),
+            'descripcion': 'Programa orientado a formar profesionales con enfoque práctico y proyectos con empresas de la región.'
+        }
+        for i in range(PROGRAMS)
+    ]
+    tables['planes_estudio'] = [
+        {'id': f'plan-{i}', 'programa_id': f'prog-{i}', 'titulo': f"Plan de estudios {program_name(i)}", 'url_pdf': f'https://example.edu/planes/prog-{i}.pdf'}
+        for i in range(PROGRAMS)
+        if i % 5 != 4  # Algunos programas no tienen plan publicado
+    ]
+    tables['mensajes'] = []
+    tables['conversaciones'] = []
+
+reset_tables()
+
+def _matches(row: dict, column: str, expression: str) -> bool:
+    operator, _, value = expression.partition('.')
+    current = row.get(column)
+    if operator == 'eq':
+        return str(current) == value
+    if operator == 'gt':
+        return current is not None and str(current) > value
+    if operator == 'in':
+        return str(current) in value.strip('()').split(',')
+    return True
+
+def _now() -> str:
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()) + f".{int(time.time() * 1e6) % 1000000:06d}+00:00"
+
+@app.get('/__stats')
+def stats():
+    return dict(calls)
+
+@app.post('/__reset')
+def reset(data: bool = False):
+    """Pone los contadores a cero; con data=true también recrea las tablas"""
+    calls.clear()
+    if data:
+        reset_tables()
+    return {'status': 'ok'}
+
+@app.api_route('/rest/v1/{table}', methods=['GET', 'POST', 'PATCH'])
+async def table(table: str, request: Request):
+    calls[f'{request.method} {table}'] += 1
+    calls['total'] += 1
+    if LATENCY:
+        await asyncio.sleep(LATENCY)
+
+    rows = tables.setdefault(table, [])
+    params = request.query_params
+    filters = [(k, v) for k, v in params.multi_items() if k not in ('select', 'order', 'limit', 'offset', 'columns')]
+    minimal = 'return=minimal' in request.headers.get('prefer', '')
+
+    if request.method == 'POST':
+        body = json.loads(await request.body())
+        body = body if isinstance(body, list) else [body]
+        calls[f'rows {table}'] += len(body)
+        for row in body:
+            row.setdefault('timestamp', _now())
+            rows.append(row)
+        return Response(b'' if minimal else json.dumps(body), status_code=201, media_type='application/json')
+
+    selected = [row for row in rows if all(_matches(row, k, v) for k, v in filters)]
+    if request.method == 'PATCH':
+        changes = json.loads(await request.body())
+        for row in selected:
+            row.update(changes)
+        return Response(b'' if minimal else json.dumps(selected), media_type='application/json')
+
+    if 'order' in params:
+        column, _, direction = params['order'].partition('.')
+        selected = sorted(selected, key=lambda row: str(row.get(column)), reverse=direction.startswith('desc'))
+    if 'offset' in params:
+        selected = selected[int(params['offset']):]
+    if 'limit' in params:
+        selected = selected[:int(params['limit'])]
+    if params.get('select', '*') != '*':
+        columns = [c.strip() for c in params['select'].split(',')]
+        selected = [{c: row.get(c) for c in columns} for row in selected]
+
+    if request.headers.get('accept') == 'application/vnd.pgrst.object+json':
+        if len(selected) != 1:
+            return Response(
+                json.dumps({'code': 'PGRST116', 'details': f'The result contains {len(selected)} rows', 'hint': None, 'message': 'JSON object requested, multiple (or no) rows returned'}),
+                status_code=406,
+                media_type='application/json'
+            )
+        return Response(json.dumps(selected[0]), media_type='application/json')
+    return Response(json.dumps(selected), media_type='application/json')
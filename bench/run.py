@@ -0,0 +1,340 @@
+"""Benchmark de POST /message con el comando web del Procfile y servidores falsos locales
+
+Levanta un PostgREST falso (bench.fake_postgrest), un servidor de chat
+completions falso (bench.fake_llm) y la aplicación con gunicorn tal como la
+arranca el Procfile; luego envía mensajes de leads a la concurrencia indicada.
+
+    python -m bench.run --scenario steady --concurrency 32 --duration 30
+    python -m bench.run --scenario all --output bench/results
+    python -m bench.run --compare bench/results/antes-steady.json bench/results/despues-steady.json
+
+Cada escenario escribe un JSON con latencias p50/p95/p99, peticiones por
+segundo, llamadas a la base de datos y al modelo por petición y el tiempo
+medio de cada etapa según /metrics.
+"""
+import os
+import re
+import sys
+import json
+import time
+import shlex
+import random
+import signal
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+import httpx
+
+from bench.scenarios import SCENARIOS, Scenario
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def procfile_command(port: int, workers: Optional[int]) -> List[str]:
+    """Comando web del Procfile con el intérprete actual y, opcionalmente, otro número de workers"""
+    with open(os.path.join(ROOT, 'Procfile')) as f:
+        line = next(l for l in f if l.startswith('web:'))
+    args = shlex.split(line[len('web:'):].replace('$PORT', str(port)))
+    if workers:
+        args[args.index('-w') + 1] = str(workers)
+    return [sys.executable, '-m', args[0]] + args[1:]
+
+def git_commit() -> str:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'desconocido'
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return round(ordered[index], 2)
+
+class Process:
+    """Subproceso con su salida en un archivo de log"""
+
+    def __init__(self, name: str, args: List[str], env: Dict[str, str], workdir: str):
+        self.name = name
+        self.log_path = os.path.join(workdir, f'{name}.log')
+        self._log = open(self.log_path, 'w')
+        self.proc = subprocess.Popen(args, cwd=ROOT, env=env, stdout=self._log, stderr=subprocess.STDOUT, start_new_session=True)
+
+    def stop(self, timeout: float = 35.0) -> None:
+        if self.proc.poll() is None:
+            os.killpg(self.proc.pid, signal.SIGTERM)
+            try:
+                self.proc.wait(timeout)
+            except subprocess.TimeoutExpired:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+                self.proc.wait()
+        self._log.close()
+
+async def wait_ready(url: str, process: Process, timeout: float = 60.0) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(timeout=2.0) as client:
+        while time.monotonic() < deadline:
+            if process.proc.poll() is not None:
+                raise RuntimeError(f"{process.name} terminó al arrancar, ver {process.log_path}")
+            try:
+                if (await client.get(url)).status_code < 500:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.25)
+    raise RuntimeError(f"{process.name} no respondió en {timeout}s, ver {process.log_path}")
+
+def stage_totals(metrics_text: str) -> Dict[str, List[float]]:
+    """Suma y conteo de eamcrm_stage_seconds por etapa"""
+    totals: Dict[str, List[float]] = {}
+    for line in metrics_text.splitlines():
+        match = re.match(r'eamcrm_stage_seconds_(sum|count)\{stage="([^"]+)"\} (\S+)', line)
+        if match:
+            kind, stage, value = match.groups()
+            totals.setdefault(stage, [0.0, 0.0])[0 if kind == 'sum' else 1] = float(value)
+    return totals
+
+class Bench:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.app_url = f'http://127.0.0.1:{args.port}'
+        self.db_url = f'http://127.0.0.1:{args.db_port}'
+        self.llm_url = f'http://127.0.0.1:{args.llm_port}'
+
+    async def seed(self, client: httpx.AsyncClient, scenario: Scenario, conversations: List[str]) -> None:
+        """Inserta mensajes previos directamente en el PostgREST falso"""
+        for conversation_id in conversations:
+            rows = [
+                {
+                    'conversacion_id': conversation_id,
+                    'emisor_tipo': 'lead' if i % 2 == 0 else 'chatbot',
+                    'emisor_id': 'seed',
+                    'contenido': f'Mensaje previo número {i} de la conversación',
+                    'timestamp': f'2024-01-01T00:{i // 60 % 60:02d}:{i % 60:02d}.000000+00:00'
+                }
+                for i in range(scenario.seed_turns)
+            ]
+            await client.post(f'{self.db_url}/rest/v1/mensajes', json=rows, headers={'Prefer': 'return=minimal'})
+
+    async def load(self, scenario: Scenario, duration: float, max_requests: Optional[int], run_id: str, offset: int = 0) -> Dict[str, Any]:
+        """Envía mensajes a la concurrencia indicada durante duration segundos"""
+        rng = random.Random(self.args.seed + offset)
+        chatbots = int(scenario.fake_db_env.get('FAKE_CHATBOTS', '10'))
+        latencies: List[float] = []
+        statuses: Counter = Counter()
+        counter = iter(range(offset, sys.maxsize))
+        deadline = time.monotonic() + duration
+        limits = httpx.Limits(max_connections=self.args.concurrency, max_keepalive_connections=self.args.concurrency)
+
+        async with httpx.AsyncClient(base_url=self.app_url, timeout=self.args.timeout, limits=limits) as client:
+            async def user() -> None:
+                while time.monotonic() < deadline:
+                    n = next(counter)
+                    if max_requests and n - offset >= max_requests:
+                        return
+                    conversation, content = scenario.message(rng, n)
+                    payload = {
+                        'conversation_id': f'bench-{run_id}-{conversation}',
+                        'chatbot_id': f'bot-{conversation % chatbots}',
+                        'lead_id': f'lead-{conversation}',
+                        'emisor_tipo': 'lead',
+                        'content': content,
+                        # Como la pasarela: una clave por envío, así las preguntas repetidas no se deduplican
+                        'idempotency_key': f'{run_id}-{n}'
+                    }
+                    started = time.perf_counter()
+                    try:
+                        response = await client.post('/message', json=payload)
+                        statuses[str(response.status_code)] += 1
+                        if response.status_code == 200:
+                            latencies.append((time.perf_counter() - started) * 1000)
+                    except httpx.HTTPError as e:
+                        statuses[type(e).__name__] += 1
+
+            started = time.monotonic()
+            await asyncio.gather(*(user() for _ in range(self.args.concurrency)))
+            elapsed = time.monotonic() - started
+        return {'latencies': latencies, 'statuses': statuses, 'elapsed': elapsed}
+
+    async def run_scenario(self, scenario: Scenario) -> Dict[str, Any]:
+        workdir = tempfile.mkdtemp(prefix=f'eamcrm-bench-{scenario.name}-')
+        base_env = {**os.environ, 'PYTHONPATH': ROOT}
+        db = Process('fake_postgrest', [sys.executable, '-m', 'uvicorn', 'bench.fake_postgrest:app', '--port', str(self.args.db_port), '--log-level', 'warning'], {
+            **base_env, 'FAKE_DB_LATENCY': str(self.args.db_latency), **scenario.fake_db_env
+        }, workdir)
+        llm = Process('fake_llm', [sys.executable, '-m', 'uvicorn', 'bench.fake_llm:app', '--port', str(self.args.llm_port), '--log-level', 'warning'], {
+            **base_env, 'FAKE_LLM_LATENCY': str(self.args.llm_latency), **scenario.fake_llm_env
+        }, workdir)
+        app_env = {
+            **base_env,
+            'PORT': str(self.args.port),
+            'SUPABASE_URL': self.db_url,
+            'SUPABASE_KEY': 'bench',
+            'DEEPSEEK_API_KEY': 'bench',
+            'DEEPSEEK_API_BASE': f'{self.llm_url}/v1',
+            # Archivos compartidos propios de la corrida: ningún estado de una corrida anterior
+            'CACHE_INVALIDATION_FILE': os.path.join(workdir, 'invalidation.log'),
+            'HISTORY_VERSIONS_FILE': os.path.join(workdir, 'versions'),
+            'METRICS_DIR': os.path.join(workdir, 'metrics'),
+            'METRICS_FLUSH_INTERVAL': '1',
+            'ANSWER_CACHE_PATH': os.path.join(workdir, 'answer-cache.sqlite3'),
+            'IDEMPOTENCY_PATH': os.path.join(workdir, 'idempotency.sqlite3'),
+            'CATALOG_SNAPSHOT_PATH': os.path.join(workdir, 'catalog-snapshot'),
+            **scenario.app_env,
+            **dict(item.split('=', 1) for item in self.args.env)
+        }
+        command = procfile_command(self.args.port, self.args.workers)
+        app = None
+        try:
+            await wait_ready(f'{self.db_url}/__stats', db)
+            await wait_ready(f'{self.llm_url}/__stats', llm)
+            app = Process('app', command, app_env, workdir)
+            await wait_ready(f'{self.app_url}/health', app)
+
+            run_id = f'{scenario.name}-{int(time.time())}'
+            async with httpx.AsyncClient(timeout=30.0) as client:
+                if scenario.seed_turns:
+                    await self.seed(client, scenario, [f'bench-{run_id}-{i}' for i in range(scenario.conversations)])
+                if scenario.warmup:
+                    await self.load(scenario, self.args.warmup, None, run_id, offset=1_000_000)
+                    await asyncio.sleep(1.5)
+                await client.post(f'{self.db_url}/__reset')
+                await client.post(f'{self.llm_url}/__reset')
+                before = stage_totals((await client.get(f'{self.app_url}/metrics')).text)
+
+                result = await self.load(scenario, self.args.duration, self.args.requests, run_id)
+
+                # Deja que la escritura diferida y el volcado de métricas terminen antes de contar
+                await asyncio.sleep(1.5)
+                db_stats = (await client.get(f'{self.db_url}/__stats')).json()
+                llm_stats = (await client.get(f'{self.llm_url}/__stats')).json()
+                after = stage_totals((await client.get(f'{self.app_url}/metrics')).text)
+        finally:
+            if app:
+                app.stop()
+            db.stop()
+            llm.stop()
+
+        latencies = result['latencies']
+        requests = sum(result['statuses'].values())
+        per_request = lambda value: round(value / requests, 3) if requests else 0.0
+        stages = {}
+        for stage, (total, count) in after.items():
+            previous = before.get(stage, [0.0, 0.0])
+            if count - previous[1] > 0:
+                stages[stage] = round((total - previous[0]) / (count - previous[1]) * 1000, 2)
+
+        return {
+            'scenario': scenario.name,
+            'description': scenario.description,
+            'commit': git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'config': {
+                'command': ' '.join(command[2:]),
+                'concurrency': self.args.concurrency,
+                'duration': self.args.duration,
+                'db_latency': self.args.db_latency,
+                'llm_latency': self.args.llm_latency,
+                'fake_db_env': scenario.fake_db_env,
+                'fake_llm_env': scenario.fake_llm_env,
+                'app_env': {**scenario.app_env, **dict(item.split('=', 1) for item in self.args.env)},
+                'seed_turns': scenario.seed_turns,
+                'warmup': scenario.warmup
+            },
+            'requests': requests,
+            'ok': len(latencies),
+            'errors': requests - len(latencies),
+            'status': dict(result['statuses']),
+            'throughput_rps': round(len(latencies) / result['elapsed'], 2) if result['elapsed'] else 0.0,
+            'latency_ms': {
+                'p50': percentile(latencies, 0.50),
+                'p95': percentile(latencies, 0.95),
+                'p99': percentile(latencies, 0.99),
+                'mean': round(sum(latencies) / len(latencies), 2) if latencies else 0.0,
+                'max': round(max(latencies), 2) if latencies else 0.0
+            },
+            'db_calls_per_request': per_request(db_stats.get('total', 0)),
+            'db_calls': {key: per_request(value) for key, value in sorted(db_stats.items()) if key != 'total'},
+            'llm_calls_per_request': per_request(llm_stats.get('chat', 0)),
+            'llm_prompt_tokens_per_call': round(llm_stats.get('prompt_tokens', 0) / llm_stats['chat'], 1) if llm_stats.get('chat') else 0.0,
+            'stages_ms': stages,
+            'logs': workdir
+        }
+
+def compare(old_path: str, new_path: str) -> None:
+    """Muestra la variación entre dos resultados del mismo escenario"""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    rows = [
+        ('p50 ms', old['latency_ms']['p50'], new['latency_ms']['p50']),
+        ('p95 ms', old['latency_ms']['p95'], new['latency_ms']['p95']),
+        ('p99 ms', old['latency_ms']['p99'], new['latency_ms']['p99']),
+        ('req/s', old['throughput_rps'], new['throughput_rps']),
+        ('db/req', old['db_calls_per_request'], new['db_calls_per_request']),
+        ('llm/req', old['llm_calls_per_request'], new['llm_calls_per_request']),
+        ('errores', old['errors'], new['errors']),
+    ]
+    print(f"{old['scenario']}: {old['commit'][:10]} -> {new['commit'][:10]}")
+    for label, before, after in rows:
+        change = f"{(after - before) / before * 100:+.1f}%" if before else 'n/a'
+        print(f"  {label:<8} {before:>10} {after:>10} {change:>8}")
+
+def summary(result: Dict[str, Any]) -> str:
+    latency = result['latency_ms']
+    return (
+        f"{result['scenario']}: {result['ok']}/{result['requests']} ok, {result['throughput_rps']} req/s, "
+        f"p50={latency['p50']}ms p95={latency['p95']}ms p99={latency['p99']}ms, "
+        f"db/req={result['db_calls_per_request']} llm/req={result['llm_calls_per_request']}"
+    )
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', action='append', help=f"escenario ({', '.join(SCENARIOS)} o all); se puede repetir")
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=30.0, help='segundos de medición por escenario')
+    parser.add_argument('--warmup', type=float, default=5.0, help='segundos de calentamiento (escenarios que lo usan)')
+    parser.add_argument('--requests', type=int, help='tope de peticiones por escenario')
+    parser.add_argument('--workers', type=int, help='reemplaza -w del Procfile')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--db-port', type=int, default=8901)
+    parser.add_argument('--llm-port', type=int, default=8902)
+    parser.add_argument('--db-latency', type=float, default=0.005)
+    parser.add_argument('--llm-latency', type=float, default=0.8)
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--env', action='append', default=[], help='variable extra para la aplicación, CLAVE=valor')
+    parser.add_argument('--output', default=os.path.join(ROOT, 'bench', 'results'), help='directorio de resultados JSON')
+    parser.add_argument('--compare', nargs=2, metavar=('ANTES', 'DESPUES'), help='compara dos resultados y termina')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    names = args.scenario or ['steady']
+    if 'all' in names:
+        names = list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"escenarios desconocidos: {', '.join(unknown)}")
+
+    os.makedirs(args.output, exist_ok=True)
+    bench = Bench(args)
+    for name in names:
+        result = asyncio.run(bench.run_scenario(SCENARIOS[name]))
+        path = os.path.join(args.output, f"{result['commit'][:12]}-{name}.json")
+        with open(path, 'w') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+        print(summary(result))
+        print(f"  resultado: {path}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import random
+from typing import Callable, Dict, List, NamedTuple
+
+QUESTIONS = [
+    '¿Cuánto dura la carrera?',
+    '¿Las clases son virtuales o presenciales?',
+    '¿Qué costo tiene el semestre?',
+    '¿Tienen becas o descuentos?',
+    '¿Cuáles son los requisitos de inscripción?',
+    '¿Cuándo inician las clases?',
+]
+
+class Scenario(NamedTuple):
+    """Carga de un escenario del benchmark"""
+    name: str
+    description: str
+    # Función (rng, número de petición) -> (índice de conversación, contenido del mensaje)
+    message: Callable[[random.Random, int], tuple]
+    conversations: int = 200
+    warmup: bool = True
+    seed_turns: int = 0
+    fake_db_env: Dict[str, str] = {}
+    fake_llm_env: Dict[str, str] = {}
+    app_env: Dict[str, str] = {}
+
+def _program_names(count: int) -> List[str]:
+    from bench.fake_postgrest import program_name
+    return [program_name(i) for i in range(count)]
+
+def _questions(conversations: int, programs: int, mention_every: int = 4):
+    names = _program_names(programs)
+
+    def message(rng: random.Random, n: int):
+        conversation = rng.randrange(conversations)
+        if n % mention_every == 0:
+            return conversation, f"Hola, me interesa {rng.choice(names)}"
+        return conversation, rng.choice(QUESTIONS)
+    return message
+
+def _fresh_conversations(programs: int):
+    names = _program_names(programs)
+
+    def message(rng: random.Random, n: int):
+        # Cada petición abre una conversación nueva: nada del historial está en caché
+        return n, f"Buenas tardes, quisiera información de {rng.choice(names)}"
+    return message
+
+def _study_plans(conversations: int, programs: int):
+    names = _program_names(programs)
+
+    def message(rng: random.Random, n: int):
+        return rng.randrange(conversations), f"Me puedes enviar el plan de estudios de {rng.choice(names)}?"
+    return message
+
+SCENARIOS: Dict[str, Scenario] = {
+    'steady': Scenario(
+        name='steady',
+        description='Conversaciones recurrentes con cachés calientes',
+        message=_questions(conversations=200, programs=20),
+    ),
+    'cold_cache': Scenario(
+        name='cold_cache',
+        description='Sin calentamiento, muchos chatbots y una conversación nueva por petición',
+        message=_fresh_conversations(programs=20),
+        warmup=False,
+        fake_db_env={'FAKE_CHATBOTS': '200'},
+    ),
+    'long_conversations': Scenario(
+        name='long_conversations',
+        description='Conversaciones con 300 mensajes previos en la base de datos',
+        message=_questions(conversations=50, programs=20),
+        conversations=50,
+        seed_turns=300,
+    ),
+    'large_catalog': Scenario(
+        name='large_catalog',
+        description='Catálogo de 2000 programas con menciones en la mitad de los mensajes',
+        message=_questions(conversations=200, programs=2000, mention_every=2),
+        fake_db_env={'FAKE_PROGRAMS': '2000'},
+    ),
+    'study_plan': Scenario(
+        name='study_plan',
+        description='Solicitudes de plan de estudios que se responden desde la base de datos',
+        message=_study_plans(conversations=200, programs=20),
+    ),
+}
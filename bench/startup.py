@@ -0,0 +1,157 @@
+"""Compara los backends del modelo (LLM_BACKEND): arranque de un worker y costo por llamada
+
+Arranque: cada repetición es un intérprete nuevo que importa main (lo que hace
+un worker de gunicorn al arrancar o al reciclarse con --max-requests) y crea
+el AIService; se mide por separado el import y la construcción.
+
+Costo por llamada: contra bench.fake_llm sin latencia, llamadas secuenciales
+con generate y con stream; lo que queda es el costo del cliente en el worker.
+
+    python -m bench.startup
+    python -m bench.startup --backend http --repeat 10 --calls 500
+"""
+import os
+import sys
+import json
+import asyncio
+import argparse
+import statistics
+import subprocess
+import tempfile
+from typing import Any, Dict
+
+from bench.run import ROOT, Process, git_commit, percentile, wait_ready
+from services.llm_client import BACKENDS
+
+# Se ejecuta en un intérprete nuevo por repetición
+STARTUP_PROBE = '''
+import json, sys, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+from dependencies import Settings
+from services.ai import AIService
+ai = AIService(backend=Settings.LLM_BACKEND)
+built = time.perf_counter()
+print(json.dumps({
+    "import_s": imported - started,
+    "build_s": built - imported,
+    "langchain": any(m.split(".")[0].startswith("langchain") for m in sys.modules),
+    "modules": len(sys.modules)
+}))
+'''
+
+CALLS_PROBE = '''
+import asyncio, json, sys, time
+from dependencies import Settings
+from services.ai import AIService
+
+async def run(calls):
+    ai = AIService(backend=Settings.LLM_BACKEND)
+    client = ai.providers.primary.client
+    messages = [{"role": "system", "content": "Contexto"}, {"role": "user", "content": "Hola"}]
+    await client.generate(messages)
+    results = {}
+    for operation in ("generate", "stream"):
+        latencies = []
+        for _ in range(calls):
+            started = time.perf_counter()
+            if operation == "generate":
+                await client.generate(messages)
+            else:
+                async for _chunk in client.stream(messages):
+                    pass
+            latencies.append((time.perf_counter() - started) * 1000)
+        results[operation] = latencies
+    await ai.aclose()
+    return results
+
+print(json.dumps(asyncio.run(run(int(sys.argv[1])))))
+'''
+
+def probe_env(backend: str, llm_url: str) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update({
+        'LLM_BACKEND': backend,
+        'DEEPSEEK_API_KEY': 'bench',
+        'DEEPSEEK_API_BASE': f'{llm_url}/v1',
+        # El import de main no debe depender de una base de datos
+        'CATALOG_PRELOAD': 'false',
+        'SUPABASE_URL': 'http://127.0.0.1:9',
+        'SUPABASE_KEY': 'bench',
+        'LOG_LEVEL': 'WARNING'
+    })
+    env.pop('OPENAI_API_KEY', None)
+    return env
+
+def run_probe(code: str, env: Dict[str, str], *args: str) -> Dict[str, Any]:
+    result = subprocess.run([sys.executable, '-c', code, *args], cwd=ROOT, env=env, capture_output=True, text=True, timeout=300)
+    if result.returncode != 0:
+        raise RuntimeError(f"La prueba terminó con error:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def measure_startup(backend: str, llm_url: str, repeat: int) -> Dict[str, Any]:
+    env = probe_env(backend, llm_url)
+    # Una corrida previa deja el bytecode compilado, como en un despliegue ya instalado
+    run_probe(STARTUP_PROBE, env)
+    samples = [run_probe(STARTUP_PROBE, env) for _ in range(repeat)]
+    import_s = [s['import_s'] for s in samples]
+    build_s = [s['build_s'] for s in samples]
+    total_s = [a + b for a, b in zip(import_s, build_s)]
+    return {
+        'import_ms': round(statistics.median(import_s) * 1000, 1),
+        'build_ms': round(statistics.median(build_s) * 1000, 1),
+        'total_ms': round(statistics.median(total_s) * 1000, 1),
+        'total_ms_max': round(max(total_s) * 1000, 1),
+        'modules': samples[-1]['modules'],
+        'langchain': samples[-1]['langchain']
+    }
+
+def measure_calls(backend: str, llm_url: str, calls: int) -> Dict[str, Any]:
+    latencies = run_probe(CALLS_PROBE, probe_env(backend, llm_url), str(calls))
+    return {
+        operation: {'p50': percentile(values, 0.5), 'p95': percentile(values, 0.95), 'mean': round(statistics.mean(values), 2)}
+        for operation, values in latencies.items()
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backend', action='append', choices=BACKENDS, help='backend a medir; se puede repetir (todos por defecto)')
+    parser.add_argument('--repeat', type=int, default=5, help='arranques medidos por backend')
+    parser.add_argument('--calls', type=int, default=200, help='llamadas secuenciales por operación (0 para omitir)')
+    parser.add_argument('--llm-port', type=int, default=8902)
+    parser.add_argument('--output', default=os.path.join(ROOT, 'bench', 'results'), help='directorio de resultados JSON')
+    args = parser.parse_args()
+
+    llm_url = f'http://127.0.0.1:{args.llm_port}'
+    workdir = tempfile.mkdtemp(prefix='eamcrm-startup-')
+    env = dict(os.environ, FAKE_LLM_LATENCY='0', FAKE_LLM_TTFT='0', FAKE_LLM_TOKENS='20')
+    llm = Process('fake_llm', [sys.executable, '-m', 'uvicorn', 'bench.fake_llm:app', '--port', str(args.llm_port), '--log-level', 'warning'], env, workdir)
+    results: Dict[str, Any] = {}
+    try:
+        asyncio.run(wait_ready(f'{llm_url}/__stats', llm))
+        for backend in args.backend or list(BACKENDS):
+            results[backend] = {'arranque': measure_startup(backend, llm_url, args.repeat)}
+            if args.calls:
+                results[backend]['llamada_ms'] = measure_calls(backend, llm_url, args.calls)
+    finally:
+        llm.stop()
+
+    for backend, result in results.items():
+        startup = result['arranque']
+        line = (
+            f"{backend:<10} arranque {startup['total_ms']}ms (import {startup['import_ms']}ms, "
+            f"AIService {startup['build_ms']}ms, {startup['modules']} módulos)"
+        )
+        for operation, latency in result.get('llamada_ms', {}).items():
+            line += f", {operation} p50={latency['p50']}ms"
+        print(line)
+
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, f"{git_commit()[:12]}-startup.json")
+    with open(path, 'w') as f:
+        json.dump({'commit': git_commit(), 'repeat': args.repeat, 'calls': args.calls, 'backends': results}, f, indent=2, ensure_ascii=False)
+    print(f"  resultado: {path}")
+
+if __name__ == '__main__':
+    main()
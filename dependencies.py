@@ -1,31 +1,237 @@
 # dependencies.py (versión corregida)
-from fastapi import Depends
-from supabase import create_client, Client
-from langchain_openai import ChatOpenAI
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Header, HTTPException, Request
+from typing import Optional
+import logging
+import functools
 import os
+import secrets
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value else default
+
+def _env_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    return float(value) if value else default
+
 class Settings:
     SUPABASE_URL = os.getenv("SUPABASE_URL")
     SUPABASE_KEY = os.getenv("SUPABASE_KEY")
     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
     DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
+    DEEPSEEK_API_BASE = os.getenv("DEEPSEEK_API_BASE", "https://api.deepseek.com/v1")
+
+    # Pools HTTP keep-alive compartidos por worker
+    HTTP_MAX_CONNECTIONS = _env_int("HTTP_MAX_CONNECTIONS", 50)
+    HTTP_MAX_KEEPALIVE_CONNECTIONS = _env_int("HTTP_MAX_KEEPALIVE_CONNECTIONS", 20)
+    HTTP_KEEPALIVE_EXPIRY = _env_float("HTTP_KEEPALIVE_EXPIRY", 30.0)
+    SUPABASE_TIMEOUT = _env_float("SUPABASE_TIMEOUT", 10.0)
+    LLM_TIMEOUT = _env_float("LLM_TIMEOUT", 20.0)
+
+    # Caché de lectura para chatbots, programas y planes de estudio
+    CACHE_MAX_ENTRIES = _env_int("CACHE_MAX_ENTRIES", 2048)
+    CACHE_TTL_CHATBOTS = _env_float("CACHE_TTL_CHATBOTS", 300.0)
+    CACHE_TTL_PROGRAMAS = _env_float("CACHE_TTL_PROGRAMAS", 900.0)
+    CACHE_TTL_PLANES = _env_float("CACHE_TTL_PLANES", 900.0)
+    # Los cambios de estado hechos por /agent/control se ven de inmediato; los externos, al vencer
+    CACHE_TTL_CONVERSACIONES = _env_float("CACHE_TTL_CONVERSACIONES", 30.0)
+    CACHE_NEGATIVE_TTL = _env_float("CACHE_NEGATIVE_TTL", 60.0)
+    CACHE_INVALIDATION_FILE = os.getenv("CACHE_INVALIDATION_FILE")
+    # Tamaño a partir del cual se rota el registro de invalidaciones (está en /dev/shm)
+    CACHE_INVALIDATION_MAX_BYTES = _env_int("CACHE_INVALIDATION_MAX_BYTES", 1 << 20)
+
+    # Snapshot del catálogo (chatbots, programas y planes) en memoria: intervalo de refresco,
+    # archivo compartido por los workers y cada cuánto revisan si otro worker lo actualizó
+    CATALOG_REFRESH_INTERVAL = _env_float("CATALOG_REFRESH_INTERVAL", 300.0)
+    CATALOG_SNAPSHOT_PATH = os.getenv("CATALOG_SNAPSHOT_PATH")
+    CATALOG_SNAPSHOT_POLL_INTERVAL = _env_float("CATALOG_SNAPSHOT_POLL_INTERVAL", 5.0)
+    # Pausa tras una carga fallida del catálogo: mientras tanto los mensajes usan la caché
+    CATALOG_LOAD_BACKOFF = _env_float("CATALOG_LOAD_BACKOFF", 30.0)
+    # Carga el snapshot en el master antes del fork (gunicorn --preload)
+    CATALOG_PRELOAD = os.getenv("CATALOG_PRELOAD", "true").lower() in ("1", "true", "yes")
+
+    # Contextos del sistema precompilados por chatbot y programa; se precalientan al arrancar el worker
+    CONTEXT_STORE_MAX_ENTRIES = _env_int("CONTEXT_STORE_MAX_ENTRIES", 4096)
+    CONTEXT_WARM = os.getenv("CONTEXT_WARM", "true").lower() in ("1", "true", "yes")
+
+    # Historial: turnos enviados al modelo y buffer de turnos recientes por worker
+    HISTORY_LIMIT = _env_int("HISTORY_LIMIT", 10)
+    HISTORY_BUFFER_TURNS = _env_int("HISTORY_BUFFER_TURNS", 20)
+    HISTORY_BUFFER_CONVERSATIONS = _env_int("HISTORY_BUFFER_CONVERSATIONS", 5000)
+    HISTORY_VERSIONS_FILE = os.getenv("HISTORY_VERSIONS_FILE")
+
+    # Resumen acumulado por conversación: se actualiza cada SUMMARY_EVERY_TURNS turnos fuera del
+    # camino de la respuesta y el prompt lleva el resumen y los turnos que aún no cubre
+    SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "false").lower() in ("1", "true", "yes")
+    SUMMARY_PATH = os.getenv("SUMMARY_PATH")
+    SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "deepseek-chat")
+    SUMMARY_EVERY_TURNS = _env_int("SUMMARY_EVERY_TURNS", 6)
+    SUMMARY_KEEP_TURNS = _env_int("SUMMARY_KEEP_TURNS", 4)
+    SUMMARY_MAX_TOKENS = _env_int("SUMMARY_MAX_TOKENS", 256)
+    SUMMARY_MAX_CONCURRENCY = _env_int("SUMMARY_MAX_CONCURRENCY", 2)
+
+    # Presupuesto de latencia por mensaje y margen reservado para el modelo
+    REQUEST_BUDGET = _env_float("REQUEST_BUDGET", 30.0)
+    REQUEST_BUDGET_LLM_RESERVE = _env_float("REQUEST_BUDGET_LLM_RESERVE", 15.0)
+
+    # Llamadas concurrentes al modelo por worker y cola de espera acotada
+    LLM_MAX_CONCURRENCY = _env_int("LLM_MAX_CONCURRENCY", 16)
+    LLM_MAX_QUEUE = _env_int("LLM_MAX_QUEUE", 64)
+    LLM_QUEUE_TIMEOUT = _env_float("LLM_QUEUE_TIMEOUT", 2.0)
+    LLM_RETRY_AFTER = _env_int("LLM_RETRY_AFTER", 5)
+
+    # Control de admisión de POST /message por worker: 503 con Retry-After si hay ADMISSION_MAX_IN_FLIGHT
+    # mensajes en curso o ADMISSION_MAX_LLM_QUEUE llamadas esperando al modelo, y una cubeta de
+    # ADMISSION_CHATBOT_RATE mensajes por segundo (ráfagas de ADMISSION_CHATBOT_BURST) por chatbot;
+    # los mensajes de agentes se admiten siempre. Un valor de 0 desactiva el límite respectivo
+    ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() in ("1", "true", "yes")
+    ADMISSION_MAX_IN_FLIGHT = _env_int("ADMISSION_MAX_IN_FLIGHT", 64)
+    ADMISSION_MAX_LLM_QUEUE = _env_int("ADMISSION_MAX_LLM_QUEUE", 32)
+    ADMISSION_CHATBOT_RATE = _env_float("ADMISSION_CHATBOT_RATE", 5.0)
+    ADMISSION_CHATBOT_BURST = _env_float("ADMISSION_CHATBOT_BURST", 20.0)
+
+    # Presupuesto de tokens del prompt y tope de tokens de la respuesta
+    PROMPT_MAX_INPUT_TOKENS = _env_int("PROMPT_MAX_INPUT_TOKENS", 3000)
+    LLM_MAX_TOKENS = _env_int("LLM_MAX_TOKENS", 512)
+
+    # Backend del modelo: "http" (cliente directo de /chat/completions) o "langchain" (ChatOpenAI,
+    # que importa LangChain y el SDK de OpenAI al arrancar cada worker)
+    LLM_BACKEND = os.getenv("LLM_BACKEND", "langchain")
+
+    # Proveedor de respaldo (OpenAI, si hay OPENAI_API_KEY) y circuito por proveedor: se abre tras
+    # LLM_BREAKER_FAILURES fallas seguidas y prueba de nuevo pasados LLM_BREAKER_RESET segundos
+    OPENAI_API_BASE = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1")
+    LLM_FALLBACK_MODEL = os.getenv("LLM_FALLBACK_MODEL", "gpt-4o-mini")
+    LLM_BREAKER_FAILURES = _env_int("LLM_BREAKER_FAILURES", 5)
+    LLM_BREAKER_RESET = _env_float("LLM_BREAKER_RESET", 30.0)
+    # Una llamada cancelada que ya llevaba este tiempo cuenta como falla
+    LLM_BREAKER_SLOW_CALL = _env_float("LLM_BREAKER_SLOW_CALL", 10.0)
+    # Hedging: segunda llamada si la primera supera el percentil de latencia (mínimo LLM_HEDGE_MIN_DELAY),
+    # como máximo para una proporción LLM_HEDGE_MAX_RATIO de las llamadas
+    LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+    LLM_HEDGE_PERCENTILE = _env_float("LLM_HEDGE_PERCENTILE", 0.95)
+    LLM_HEDGE_MIN_DELAY = _env_float("LLM_HEDGE_MIN_DELAY", 1.0)
+    LLM_HEDGE_MAX_RATIO = _env_float("LLM_HEDGE_MAX_RATIO", 0.1)
+
+    # Respuestas con plantillas para preguntas sobre el catálogo (plan, programas, modalidad...)
+    INTENT_ROUTER_ENABLED = os.getenv("INTENT_ROUTER_ENABLED", "true").lower() in ("1", "true", "yes")
+
+    # Caché de respuestas: lista de chatbots separados por coma, o "*" para todos
+    ANSWER_CACHE_CHATBOTS = os.getenv("ANSWER_CACHE_CHATBOTS", "")
+    ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH")
+    ANSWER_CACHE_TTL = _env_float("ANSWER_CACHE_TTL", 86400.0)
+    ANSWER_CACHE_MAX_ENTRIES = _env_int("ANSWER_CACHE_MAX_ENTRIES", 10000)
+    ANSWER_CACHE_HISTORY_TURNS = _env_int("ANSWER_CACHE_HISTORY_TURNS", 0)
+
+    # Escritura de mensajes: "direct" (una fila por petición, por defecto), "batched"
+    # (lotes, se espera la escritura del mensaje entrante) o "ack" (se responde antes
+    # del lote; un mensaje en cola se pierde si el worker muere)
+    MESSAGE_WRITE_MODE = os.getenv("MESSAGE_WRITE_MODE", "direct")
+    MESSAGE_BATCH_SIZE = _env_int("MESSAGE_BATCH_SIZE", 50)
+    MESSAGE_FLUSH_INTERVAL = _env_float("MESSAGE_FLUSH_INTERVAL", 0.02)
+    MESSAGE_QUEUE_MAX = _env_int("MESSAGE_QUEUE_MAX", 10000)
+    MESSAGE_MAX_RETRIES = _env_int("MESSAGE_MAX_RETRIES", 5)
+    MESSAGE_DRAIN_TIMEOUT = _env_float("MESSAGE_DRAIN_TIMEOUT", 25.0)
+    # Opcional: la respuesta del chatbot se guarda fuera del camino de la respuesta HTTP;
+    # se pierde si el worker muere antes de escribirla
+    BOT_REPLY_WRITE_BEHIND = os.getenv("BOT_REPLY_WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+
+    # Métricas: directorio compartido por los workers y encabezado Server-Timing opcional
+    METRICS_DIR = os.getenv("METRICS_DIR")
+    METRICS_FLUSH_INTERVAL = _env_float("METRICS_FLUSH_INTERVAL", 5.0)
+    SERVER_TIMING = os.getenv("SERVER_TIMING", "false").lower() in ("1", "true", "yes")
+
+    # Deduplicación de reintentos de /message y orden de los mensajes por conversación
+    IDEMPOTENCY_ENABLED = os.getenv("IDEMPOTENCY_ENABLED", "true").lower() in ("1", "true", "yes")
+    IDEMPOTENCY_PATH = os.getenv("IDEMPOTENCY_PATH")
+    # Solo se deduplican los mensajes con clave (Idempotency-Key o idempotency_key). Con
+    # IDEMPOTENCY_WINDOW > 0 también los que no la traen, por hash del contenido durante
+    # esa ventana: debe ser de pocos segundos, un lead puede repetir "sí" o "gracias"
+    IDEMPOTENCY_WINDOW = _env_float("IDEMPOTENCY_WINDOW", 0.0)
+    IDEMPOTENCY_TTL = _env_float("IDEMPOTENCY_TTL", 86400.0)
+    # Espera máxima por el turno de una conversación antes de responder 409
+    CONVERSATION_WAIT_TIMEOUT = _env_float("CONVERSATION_WAIT_TIMEOUT", 35.0)
+
+    # Modo asíncrono (POST /message/jobs): 202 con el id del trabajo y la respuesta en
+    # GET /message/jobs/{id} o enviada por POST a JOBS_CALLBACK_URL, firmada con JOBS_CALLBACK_SECRET
+    JOBS_ENABLED = os.getenv("JOBS_ENABLED", "false").lower() in ("1", "true", "yes")
+    JOBS_PATH = os.getenv("JOBS_PATH")
+    JOBS_WORKERS = _env_int("JOBS_WORKERS", 8)
+    JOBS_MAX_QUEUE = _env_int("JOBS_MAX_QUEUE", 500)
+    JOBS_MAX_ATTEMPTS = _env_int("JOBS_MAX_ATTEMPTS", 3)
+    JOBS_TTL = _env_float("JOBS_TTL", 86400.0)
+    JOBS_POLL_INTERVAL = _env_float("JOBS_POLL_INTERVAL", 2.0)
+    JOBS_CALLBACK_URL = os.getenv("JOBS_CALLBACK_URL")
+    JOBS_CALLBACK_SECRET = os.getenv("JOBS_CALLBACK_SECRET")
+    JOBS_CALLBACK_RETRIES = _env_int("JOBS_CALLBACK_RETRIES", 6)
+    JOBS_CALLBACK_TIMEOUT = _env_float("JOBS_CALLBACK_TIMEOUT", 10.0)
+
+    # Diagnóstico: peticiones de /message más lentas que SLOW_REQUEST_THRESHOLD segundos (etapas y
+    # stack) y bloqueos del event loop de más de LOOP_STALL_THRESHOLD segundos, en buffers circulares
+    SLOW_REQUEST_THRESHOLD = _env_float("SLOW_REQUEST_THRESHOLD", 5.0)
+    SLOW_REQUEST_CAPACITY = _env_int("SLOW_REQUEST_CAPACITY", 100)
+    LOOP_LAG_INTERVAL = _env_float("LOOP_LAG_INTERVAL", 0.1)
+    LOOP_STALL_THRESHOLD = _env_float("LOOP_STALL_THRESHOLD", 0.5)
+    # Duración máxima de una sesión del profiler por muestreo (POST /admin/profile)
+    PROFILER_MAX_SECONDS = _env_float("PROFILER_MAX_SECONDS", 60.0)
+
+    # Logging: nivel raíz, niveles por logger ("httpx=WARNING,services.ai=DEBUG"), formato
+    # json o text y proporción de peticiones por ruta con eventos debug/info ("/message=0.1,*=1")
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+    LOG_LEVELS = os.getenv("LOG_LEVELS", "httpx=WARNING,httpcore=WARNING")
+    LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+    LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "/health=0")
+
+    # Token para los endpoints de administración (deshabilitados si no existe)
+    ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+def get_services(request: Request):
+    """Devuelve el contenedor de servicios del worker"""
+    return request.app.state.services
+
+def get_supabase(request: Request):
+    return get_services(request).supabase
+
+def get_ai_client(request: Request):
+    return get_services(request).ai
+
+def get_answer_cache(request: Request):
+    return get_services(request).answer_cache
+
+def get_conversation_service(request: Request):
+    return get_services(request).conversation
+
+def get_message_guard(request: Request):
+    return get_services(request).message_guard
+
+def get_message_jobs(request: Request):
+    return get_services(request).jobs
+
+def require_admin(x_admin_token: Optional[str] = Header(None)) -> None:
+    """Valida el token de administración enviado en X-Admin-Token"""
+    if not Settings.ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="No encontrado")
+    if not x_admin_token or not secrets.compare_digest(x_admin_token, Settings.ADMIN_TOKEN):
+        raise HTTPException(status_code=401, detail="Token de administración inválido")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Crea los servicios una vez por worker y los cierra al apagar"""
+    from services.container import ServiceContainer
+    from routers.messages import run_job
 
-def get_supabase() -> Client:
-    url = os.getenv('SUPABASE_URL')
-    key = os.getenv('SUPABASE_KEY')
-    return create_client(url, key)
-
-def get_ai_client(use_deepseek=True):  # Por defecto usamos Deepseek
-    api_key = os.getenv('DEEPSEEK_API_KEY')
-    if not api_key:
-        raise ValueError("DEEPSEEK_API_KEY no está configurada en el archivo .env")
-    
-    return ChatOpenAI(
-        api_key=api_key,
-        base_url="https://api.deepseek.com/v1",  # URL de la API de Deepseek
-        model_name="deepseek-chat",  # Modelo de Deepseek
-        temperature=0.7
-    )
\ No newline at end of file
+    logger.info("Aplicación iniciando...")
+    services = ServiceContainer(Settings)
+    app.state.services = services
+    services.start(job_handler=functools.partial(run_job, services))
+    try:
+        yield
+    finally:
+        logger.info("Aplicación deteniéndose, cerrando conexiones...")
+        await services.aclose()
@@ -1,27 +1,38 @@
 import logging
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
 from dotenv import load_dotenv
-from routers import messages, agents
+from dependencies import Settings, lifespan
+from routers import messages, agents, admin
+from services.metrics import MetricsMiddleware
+from services.admission import AdmissionMiddleware
+from services.profiling import ProfilingMiddleware
+from services.container import preload_catalog
+from services.logs import RequestLogMiddleware, configure_logging, request_log_rates
 
-# Configurar logging
-logging.basicConfig(
-    level=logging.DEBUG,  # Cambiado a DEBUG para más detalle
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Configurar logging: JSON por una cola, niveles desde el entorno
+configure_logging(Settings)
 logger = logging.getLogger(__name__)
 
 # Cargar variables del .env
 load_dotenv()
 
+# Con gunicorn --preload esto corre en el master: los workers heredan el catálogo ya cargado
+preload_catalog(Settings)
+
 app = FastAPI(
     title="Chatbot API",
     description="API para el servicio de chatbot con Supabase",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
+# Rechazo temprano de mensajes con el worker saturado; dentro de CORS para que el 503
+# lleve sus encabezados y dentro de las métricas para contar los rechazos
+app.add_middleware(AdmissionMiddleware)
+
 # Configurar CORS
 app.add_middleware(
     CORSMiddleware,
@@ -38,6 +49,15 @@ app.add_middleware(
     allowed_hosts=["*"]  # Ajustar según necesidades de producción
 )
 
+# Duración de cada petición para /metrics
+app.add_middleware(MetricsMiddleware)
+
+# Registro de peticiones lentas; dentro del id de petición para guardarlo con cada una
+app.add_middleware(ProfilingMiddleware)
+
+# Id de petición y muestreo de logs por ruta; el más externo para cubrir a los demás
+app.add_middleware(RequestLogMiddleware, rates=request_log_rates(Settings))
+
 # Manejador global de errores
 @app.exception_handler(Exception)
 async def global_exception_handler(request, exc):
@@ -50,19 +70,24 @@ async def global_exception_handler(request, exc):
 # Incluir routers
 app.include_router(messages.router)
 app.include_router(agents.router)
+app.include_router(admin.router)
 
-@app.on_event("startup")
-async def startup_event():
-    """Log cuando la aplicación inicia"""
-    logger.info("Aplicación iniciando...")
-    logger.info("CORS origins configurados: *")
-
+# async: leen el estado que el loop modifica, así que no deben correr en el pool de hilos
 @app.get("/health")
-def health_check():
+async def health_check():
     """Endpoint para verificar el estado de la aplicación"""
     logger.info("Health check solicitado")
     return {
         "status": "ok",
         "version": "1.0.0",
-        "environment": "production"
-    }
\ No newline at end of file
+        "environment": "production",
+        **app.state.services.saturation()
+    }
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Métricas de todos los workers en formato de Prometheus"""
+    return PlainTextResponse(
+        app.state.services.metrics.render(),
+        media_type="text/plain; version=0.0.4"
+    )
\ No newline at end of file
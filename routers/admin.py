@@ -0,0 +1,115 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+from schemas.models import CacheInvalidation
+from dependencies import (
+    Settings, get_answer_cache, get_conversation_service, get_message_guard, get_services, get_supabase, require_admin
+)
+from services.profiling import SamplingProfiler
+from typing import Optional
+import asyncio
+import time
+import os
+
+router = APIRouter(prefix="/admin", dependencies=[Depends(require_admin)])
+
+@router.post("/cache/invalidate")
+async def invalidate_cache(
+    invalidation: CacheInvalidation,
+    supabase=Depends(get_supabase),
+    answer_cache=Depends(get_answer_cache)
+):
+    """Invalida en todos los workers la caché de un chatbot y/o un programa"""
+    removed = 0
+    if invalidation.chatbot_id:
+        removed += supabase.invalidate_chatbot(invalidation.chatbot_id)
+        if answer_cache:
+            removed += await answer_cache.invalidate_chatbot(invalidation.chatbot_id)
+    if invalidation.programa_id:
+        removed += supabase.invalidate_program(invalidation.programa_id)
+    return {"status": "invalidated", "removed": removed}
+
+@router.get("/intents/stats")
+async def intent_stats(service=Depends(get_conversation_service)):
+    """Mensajes de este worker respondidos por intención sin llamar al modelo"""
+    return {
+        "pid": os.getpid(),
+        "intenciones": service.intents.stats() if service.intents else None
+    }
+
+@router.get("/cache/stats")
+async def cache_stats(
+    supabase=Depends(get_supabase),
+    answer_cache=Depends(get_answer_cache),
+    service=Depends(get_conversation_service)
+):
+    """Contadores de aciertos y fallos de las cachés de este worker"""
+    return {
+        "pid": os.getpid(),
+        **supabase.cache.stats(),
+        "catalogo": supabase.catalog.stats(),
+        "contextos": service.contexts.stats(),
+        "resumenes": service.summaries.stats() if service.summaries else None,
+        "respuestas": answer_cache.stats() if answer_cache else None
+    }
+
+@router.get("/idempotency/stats")
+async def idempotency_stats(guard=Depends(get_message_guard)):
+    """Mensajes nuevos, duplicados y conversaciones ocupadas en este worker"""
+    return {
+        "pid": os.getpid(),
+        "mensajes": guard.stats() if guard else None
+    }
+
+# Una sola sesión del profiler a la vez por worker
+_profiling = False
+
+@router.post("/profile", response_class=PlainTextResponse)
+async def profile(
+    seconds: float = Query(10.0, gt=0),
+    requests: Optional[int] = Query(None, gt=0),
+    interval_ms: float = Query(5.0, ge=1.0),
+    idle: bool = False,
+    services=Depends(get_services)
+):
+    """
+    Muestrea los stacks de todos los hilos de este worker y devuelve el formato collapsed
+    
+    Dura `seconds` segundos o, si se indica `requests`, hasta que el worker
+    termine esa cantidad de peticiones (con PROFILER_MAX_SECONDS como tope).
+    El resultado se abre con flamegraph.pl o speedscope; `idle` incluye los
+    hilos que solo esperan.
+    """
+    global _profiling
+    if _profiling:
+        raise HTTPException(status_code=409, detail="Ya hay una sesión del profiler en curso en este worker")
+    _profiling = True
+    limit = min(seconds if requests is None else Settings.PROFILER_MAX_SECONDS, Settings.PROFILER_MAX_SECONDS)
+    profiler = SamplingProfiler(interval=interval_ms / 1000, include_idle=idle)
+    recorder = services.slow_requests
+    # La petición del profiler también pasa por el middleware: no cuenta
+    target = recorder.completed + requests if requests else None
+    deadline = time.monotonic() + limit
+    profiler.start()
+    try:
+        while time.monotonic() < deadline and (target is None or recorder.completed < target):
+            await asyncio.sleep(min(0.05, limit))
+    finally:
+        profiler.stop()
+        _profiling = False
+    return PlainTextResponse(
+        profiler.collapsed(),
+        headers={
+            "X-Profile-Samples": str(profiler.count),
+            "X-Profile-Seconds": f"{profiler.elapsed:.3f}",
+            "X-Worker-Pid": str(os.getpid())
+        }
+    )
+
+@router.get("/slow-requests")
+async def slow_requests(limit: int = Query(20, gt=0), services=Depends(get_services)):
+    """Últimas peticiones lentas y bloqueos del event loop de este worker, con sus etapas y stacks"""
+    return {
+        "pid": os.getpid(),
+        "peticiones": {**services.slow_requests.stats(), "ultimas": list(services.slow_requests.entries)[-limit:][::-1]},
+        "event_loop": {**services.loop_lag.stats(), "bloqueos": list(services.loop_lag.stalls)[-limit:][::-1]}
+    }
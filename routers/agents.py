@@ -1,23 +1,34 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends, HTTPException
 from schemas.models import AgentControl
+from services.supabase import SupabaseService
+from services.conversation import AGENT_ACTIVE, CHATBOT_ACTIVE
+from dependencies import get_supabase
+import logging
 
+logger = logging.getLogger(__name__)
 router = APIRouter()
 
 @router.post("/agent/control")
-async def agent_control(control: AgentControl):
-    supabase = SupabaseService()
-    
+async def agent_control(control: AgentControl, supabase: SupabaseService = Depends(get_supabase)):
+    """
+    Un agente humano toma la conversación (el chatbot deja de responder) o se la devuelve al chatbot
+    """
     # Actualizar estado de la conversación
-    status = 'agente_activo' if not control.activate_chatbot else 'chatbot_activo'
-    supabase.update_conversation_status(control.conversation_id, status)
-    
-    # Si hay mensaje del agente
+    status = AGENT_ACTIVE if not control.activate_chatbot else CHATBOT_ACTIVE
+    if not await supabase.update_conversation_status(control.conversation_id, status):
+        raise HTTPException(
+            status_code=404,
+            detail=f"No se encontró la conversación {control.conversation_id}"
+        )
+    logger.info(f"Conversación {control.conversation_id} en estado {status} (agente {control.agent_id})")
+
+    # Si hay mensaje del agente, se agrega al historial en caché al guardarlo
     if control.message:
-        supabase.save_message({
+        await supabase.save_message({
             'conversacion_id': control.conversation_id,
             'emisor_tipo': 'agente',
             'emisor_id': control.agent_id,
             'contenido': control.message
         })
-    
-    return {"status": "control updated"}
\ No newline at end of file
+
+    return {"status": "control updated", "estado": status}
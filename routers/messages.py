@@ -1,78 +1,197 @@
-from fastapi import APIRouter, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from schemas.models import MessageRequest
 from services.conversation import ConversationService
+from services.timing import RequestBudget
+from services.ai import cap_response
+from services.limiter import LLMOverloadedError
+from services.idempotency import ConversationBusyError, MessageGuard
+from services.jobs import JobRetryError, MessageJobs
+from services.logs import log_enabled
+from dependencies import Settings, get_conversation_service, get_message_guard, get_message_jobs
+from contextlib import aclosing, asynccontextmanager
+import asyncio
+import json
+import time
 import logging
-from typing import Dict, Any
+from typing import AsyncIterator, Awaitable, Callable, Dict, Any, Optional
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
+def _incoming_message(request: MessageRequest) -> Dict[str, Any]:
+    return {
+        'conversacion_id': request.conversation_id,
+        'emisor_tipo': request.emisor_tipo,
+        'emisor_id': request.emisor_id if request.emisor_tipo == 'agente' else request.lead_id,
+        'contenido': request.content
+    }
+
+def _bot_message(request: MessageRequest, response: str) -> Dict[str, Any]:
+    return {
+        'conversacion_id': request.conversation_id,
+        'emisor_tipo': 'chatbot',
+        'emisor_id': request.chatbot_id,
+        'contenido': response
+    }
+
+async def _save_incoming(service: ConversationService, request: MessageRequest, budget: RequestBudget) -> None:
+    """Guarda el mensaje entrante antes de generar cualquier respuesta"""
+    try:
+        with budget.measure('guardar_mensaje'):
+            await service.supabase.save_message(_incoming_message(request))
+        logger.info("Mensaje guardado exitosamente: %s", request.conversation_id)
+    except Exception as e:
+        logger.error(f"Error al guardar mensaje en Supabase: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail="Error al guardar mensaje en la base de datos"
+        )
+
+async def _save_reply(service: ConversationService, request: MessageRequest, response: str, budget: RequestBudget) -> None:
+    """Guarda la respuesta del chatbot; con escritura diferida no se espera al lote"""
+    with budget.measure('guardar_respuesta'):
+        await service.supabase.save_message(
+            _bot_message(request, response),
+            background=Settings.BOT_REPLY_WRITE_BEHIND
+        )
+
+def _server_timing(response: Response, budget: RequestBudget) -> None:
+    """Adjunta el desglose de tiempos por etapa si está habilitado"""
+    if Settings.SERVER_TIMING:
+        response.headers["Server-Timing"] = budget.server_timing()
+
+def _overloaded(e: LLMOverloadedError) -> HTTPException:
+    logger.warning(f"Modelo saturado, se rechaza el mensaje: {e}")
+    return HTTPException(
+        status_code=503,
+        detail="El servicio está saturado, intenta de nuevo en unos segundos",
+        headers={"Retry-After": str(e.retry_after)}
+    )
+
+def _busy(e: ConversationBusyError) -> HTTPException:
+    logger.warning(f"Se rechaza el mensaje: {e}")
+    return HTTPException(
+        status_code=409,
+        detail="Hay otro mensaje de esta conversación en proceso, intenta de nuevo en unos segundos",
+        headers={"Retry-After": str(e.retry_after)}
+    )
+
+def _idempotency_key(guard: MessageGuard, request: MessageRequest, req: Request) -> tuple:
+    return guard.key_for(request.dict(), req.headers.get("Idempotency-Key") or request.idempotency_key)
+
+@asynccontextmanager
+async def _conversation_turn(guard: Optional[MessageGuard], conversation_id: str) -> AsyncIterator[None]:
+    """Turno exclusivo de la conversación mientras se guarda el mensaje y se lee el historial"""
+    if guard is None:
+        yield
+        return
+    try:
+        async with guard.ordered(conversation_id):
+            yield
+    except ConversationBusyError as e:
+        raise _busy(e)
+
+def _sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def _agent_active(request: MessageRequest) -> Dict[str, Any]:
+    logger.info("Agente humano activo, el chatbot no responde: %s", request.conversation_id)
+    return {"status": "message received", "chatbot_activo": False}
+
+async def _process_message(
+    service: ConversationService,
+    request: MessageRequest,
+    budget: RequestBudget,
+    received: bool = False,
+    on_saved: Optional[Callable[[], Awaitable[None]]] = None
+) -> Dict[str, Any]:
+    """Guarda el mensaje entrante (salvo que un intento anterior ya lo hiciera) y responde si es del lead"""
+    if received:
+        logger.info("Mensaje ya guardado por un intento anterior: %s", request.conversation_id)
+    else:
+        await _save_incoming(service, request, budget)
+        if on_saved:
+            await on_saved()
+    
+    # Si es mensaje del lead y chatbot activo
+    if request.emisor_tipo != 'lead':
+        return {"status": "message received"}
+    if not await service.chatbot_active(request.conversation_id, budget):
+        return _agent_active(request)
+    
+    try:
+        # Generar respuesta de forma asíncrona
+        reply = await service.handle_message(request.dict(), budget)
+        
+        if not reply:
+            logger.warning("Respuesta vacía del servicio de conversación")
+            raise HTTPException(
+                status_code=500,
+                detail="No se pudo generar una respuesta"
+            )
+        
+        # Guardar respuesta del chatbot
+        await _save_reply(service, request, reply, budget)
+        logger.info("Respuesta del chatbot guardada: %s", request.conversation_id)
+        logger.info("Tiempos por etapa (%s): %s", request.conversation_id, budget.summary())
+        
+        return {"response": reply, "status": "success"}
+    
+    except LLMOverloadedError as e:
+        raise _overloaded(e)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error al procesar respuesta del chatbot: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail="Error al procesar la respuesta del chatbot"
+        )
+
 @router.post("/message")
-async def handle_message(request: MessageRequest, req: Request) -> Dict[str, Any]:
+async def handle_message(
+    request: MessageRequest,
+    req: Request,
+    response: Response,
+    service: ConversationService = Depends(get_conversation_service),
+    guard: Optional[MessageGuard] = Depends(get_message_guard)
+) -> Dict[str, Any]:
     """
     Maneja los mensajes entrantes del chatbot
+    
+    Los reintentos de la pasarela (misma Idempotency-Key, o mismo contenido
+    dentro de la ventana) reciben la respuesta del primer intento sin volver a
+    guardar el mensaje ni llamar al modelo.
     """
     try:
         # Log de la solicitud entrante
-        logger.debug(f"Headers de la solicitud: {dict(req.headers)}")
-        logger.info(f"Mensaje recibido de tipo: {request.emisor_tipo}")
-        
-        service = ConversationService()
-        
-        # Guardar mensaje en Supabase
-        message_data = {
-            'conversacion_id': request.conversation_id,
-            'emisor_tipo': request.emisor_tipo,
-            'emisor_id': request.emisor_id if request.emisor_tipo == 'agente' else request.lead_id,
-            'contenido': request.content
-        }
-        
-        try:
-            await service.supabase.save_message(message_data)
-            logger.info(f"Mensaje guardado exitosamente: {request.conversation_id}")
-        except Exception as e:
-            logger.error(f"Error al guardar mensaje en Supabase: {e}")
-            raise HTTPException(
-                status_code=500,
-                detail="Error al guardar mensaje en la base de datos"
-            )
+        if log_enabled(logger, logging.DEBUG):
+            logger.debug("Headers de la solicitud: %s", dict(req.headers))
+        logger.info("Mensaje recibido de tipo: %s", request.emisor_tipo)
         
-        # Si es mensaje del lead y chatbot activo
-        if request.emisor_tipo == 'lead':
-            try:
-                # Generar respuesta de forma asíncrona
-                response = await service.handle_message(request.dict())
-                
-                if not response:
-                    logger.warning("Respuesta vacía del servicio de conversación")
-                    raise HTTPException(
-                        status_code=500,
-                        detail="No se pudo generar una respuesta"
-                    )
-                
-                # Guardar respuesta del chatbot
-                bot_message = {
-                    'conversacion_id': request.conversation_id,
-                    'emisor_tipo': 'chatbot',
-                    'emisor_id': request.chatbot_id,
-                    'contenido': response
-                }
-                
-                await service.supabase.save_message(bot_message)
-                logger.info(f"Respuesta del chatbot guardada: {request.conversation_id}")
-                
-                return {"response": response, "status": "success"}
+        budget = service.new_budget()
+        if guard is None:
+            body = await _process_message(service, request, budget)
+        else:
+            key, ttl = _idempotency_key(guard, request, req)
             
-            except Exception as e:
-                logger.error(f"Error al procesar respuesta del chatbot: {e}")
-                raise HTTPException(
-                    status_code=500,
-                    detail="Error al procesar la respuesta del chatbot"
+            async def compute(received: bool) -> Dict[str, Any]:
+                return await _process_message(
+                    service, request, budget, received,
+                    on_saved=lambda: guard.mark_received(key, request.conversation_id, ttl)
                 )
+            
+            body, replayed = await guard.run(key, ttl, request.conversation_id, compute)
+            if replayed:
+                logger.info("Mensaje duplicado, se devuelve la respuesta del primer intento: %s", request.conversation_id)
+                response.headers["Idempotent-Replayed"] = "true"
         
-        return {"status": "message received"}
+        _server_timing(response, budget)
+        return body
         
+    except ConversationBusyError as e:
+        raise _busy(e)
     except HTTPException as he:
         raise he
     except Exception as e:
@@ -80,4 +199,209 @@ async def handle_message(request: MessageRequest, req: Request) -> Dict[str, Any
         raise HTTPException(
             status_code=500,
             detail="Error interno del servidor"
-        )
\ No newline at end of file
+        )
+
+async def run_job(services, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Genera la respuesta de un trabajo de /message/jobs; el mensaje entrante ya está guardado"""
+    request = MessageRequest(**payload)
+    service = services.conversation
+    budget = service.new_budget()
+    try:
+        async with _conversation_turn(services.message_guard, request.conversation_id):
+            return await _process_message(service, request, budget, received=True)
+    except HTTPException as he:
+        # Saturación u otro mensaje en proceso: el trabajo se reintenta más tarde
+        if he.status_code in (409, 503):
+            retry_after = (he.headers or {}).get("Retry-After", Settings.LLM_RETRY_AFTER)
+            raise JobRetryError(he.detail, float(retry_after))
+        raise RuntimeError(he.detail)
+
+@router.post("/message/jobs", status_code=202)
+async def submit_message_job(
+    request: MessageRequest,
+    req: Request,
+    response: Response,
+    service: ConversationService = Depends(get_conversation_service),
+    guard: Optional[MessageGuard] = Depends(get_message_guard),
+    jobs: Optional[MessageJobs] = Depends(get_message_jobs)
+) -> Dict[str, Any]:
+    """
+    Igual que /message, pero responde 202 con el id del trabajo apenas guarda el mensaje
+    
+    La respuesta del chatbot se consulta en GET /message/jobs/{job_id} o llega
+    al callback configurado. Un reintento de la pasarela recibe el mismo trabajo.
+    """
+    if jobs is None:
+        raise HTTPException(status_code=404, detail="El modo asíncrono no está habilitado")
+    if not jobs.has_capacity():
+        logger.warning("Cola de trabajos llena, se rechaza el mensaje: %s", request.conversation_id)
+        raise HTTPException(
+            status_code=503,
+            detail="El servicio está saturado, intenta de nuevo en unos segundos",
+            headers={"Retry-After": str(Settings.LLM_RETRY_AFTER)}
+        )
+    logger.info("Mensaje recibido de tipo: %s (trabajo)", request.emisor_tipo)
+    budget = service.new_budget()
+    
+    try:
+        if guard is None:
+            await _save_incoming(service, request, budget)
+            body = await jobs.submit(request.conversation_id, request.dict())
+        else:
+            key, ttl = _idempotency_key(guard, request, req)
+            # Un mismo mensaje enviado a /message y a /message/jobs no comparte resultado
+            key = f"trabajo-{key}"
+            
+            async def submit(received: bool) -> Dict[str, Any]:
+                if not received:
+                    await _save_incoming(service, request, budget)
+                    await guard.mark_received(key, request.conversation_id, ttl)
+                return await jobs.submit(request.conversation_id, request.dict())
+            
+            body, replayed = await guard.run(key, ttl, request.conversation_id, submit)
+            if replayed:
+                logger.info("Mensaje duplicado, se devuelve el trabajo del primer intento: %s", request.conversation_id)
+                response.headers["Idempotent-Replayed"] = "true"
+    except ConversationBusyError as e:
+        raise _busy(e)
+    
+    response.headers["Location"] = f"/message/jobs/{body['job_id']}"
+    return body
+
+@router.get("/message/jobs/{job_id}")
+async def get_message_job(job_id: str, jobs: Optional[MessageJobs] = Depends(get_message_jobs)) -> Dict[str, Any]:
+    """Estado de un trabajo y, si terminó, la respuesta del chatbot"""
+    if jobs is None:
+        raise HTTPException(status_code=404, detail="El modo asíncrono no está habilitado")
+    job = await jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return job
+
+def _replay_stream(body: Dict[str, Any]):
+    """Entrega de una vez la respuesta guardada de un mensaje repetido"""
+    if "response" not in body:
+        return body
+    
+    async def events() -> AsyncIterator[str]:
+        yield _sse("token", {"content": body["response"]})
+        yield _sse("done", body)
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "Idempotent-Replayed": "true"}
+    )
+
+@router.post("/message/stream")
+async def stream_message(
+    request: MessageRequest,
+    req: Request,
+    service: ConversationService = Depends(get_conversation_service),
+    guard: Optional[MessageGuard] = Depends(get_message_guard)
+):
+    """
+    Igual que /message, pero entrega la respuesta del chatbot token a token (Server-Sent Events)
+    """
+    logger.info("Mensaje recibido de tipo: %s (stream)", request.emisor_tipo)
+    budget = service.new_budget()
+    key, ttl = _idempotency_key(guard, request, req) if guard else (None, None)
+    
+    # El turno de la conversación cubre hasta leer el historial; el stream corre fuera de él
+    async with _conversation_turn(guard, request.conversation_id):
+        stored = await guard.lookup(key) if guard else None
+        if stored and stored.body is not None:
+            logger.info("Mensaje duplicado, se devuelve la respuesta del primer intento: %s", request.conversation_id)
+            return _replay_stream(stored.body)
+        # Un duplicado del intento que sigue generando no vuelve a llamar al modelo
+        attempt = await guard.claim(key) if guard else None
+        if guard and attempt is None:
+            logger.info("Mensaje duplicado mientras el primer intento sigue en curso: %s", request.conversation_id)
+            raise _busy(ConversationBusyError(f"El primer intento del mensaje {key} sigue en curso"))
+        try:
+            if not stored:
+                await _save_incoming(service, request, budget)
+                if guard:
+                    await guard.mark_received(key, request.conversation_id, ttl)
+            
+            if request.emisor_tipo != 'lead':
+                body = {"status": "message received"}
+            elif not await service.chatbot_active(request.conversation_id, budget):
+                body = _agent_active(request)
+            else:
+                body = None
+            if body is not None:
+                if guard:
+                    await guard.remember(key, request.conversation_id, ttl, body)
+                    await guard.release(key, attempt)
+                return body
+            
+            # Los errores previos al primer token se responden como HTTP normal
+            try:
+                plan = await service.prepare_reply(request.dict(), budget)
+                if plan.answer is None:
+                    service.ai.limiter.check()
+            except LLMOverloadedError as e:
+                raise _overloaded(e)
+            except HTTPException:
+                raise
+            except Exception as e:
+                logger.error(f"Error al preparar la respuesta del chatbot: {e}", exc_info=True)
+                raise HTTPException(
+                    status_code=500,
+                    detail="Error al procesar la respuesta del chatbot"
+                )
+        except BaseException:
+            if guard:
+                await guard.release(key, attempt)
+            raise
+    
+    async def events() -> AsyncIterator[str]:
+        parts = []
+        renewed = time.monotonic()
+        try:
+            # Si el cliente se desconecta, Starlette cancela este generador y
+            # aclosing cierra el stream hacia el modelo en cadena
+            async with aclosing(service.stream_reply(plan, request.dict(), budget)) as chunks:
+                async for chunk in chunks:
+                    parts.append(chunk)
+                    yield _sse("token", {"content": chunk})
+                    if guard and time.monotonic() - renewed >= guard.lease / 3:
+                        renewed = time.monotonic()
+                        await guard.renew(key, attempt)
+            
+            # Lo mismo que se guardaría por /message: cortado en el límite y en una oración completa
+            response = cap_response(''.join(parts))
+            if not response.strip():
+                raise ValueError("Respuesta vacía del modelo")
+            
+            await _save_reply(service, request, response, budget)
+            logger.info("Respuesta del chatbot guardada: %s", request.conversation_id)
+            logger.info("Tiempos por etapa (%s): %s", request.conversation_id, budget.summary())
+            body = {"response": response, "status": "success"}
+            if guard:
+                await guard.remember(key, request.conversation_id, ttl, body)
+            yield _sse("done", body)
+        
+        except LLMOverloadedError as e:
+            logger.warning(f"Modelo saturado durante el stream: {e}")
+            yield _sse("error", {"detail": "El servicio está saturado, intenta de nuevo en unos segundos", "retry_after": e.retry_after})
+        except asyncio.CancelledError:
+            logger.info("Cliente desconectado, generación cancelada: %s", request.conversation_id)
+            raise
+        except Exception as e:
+            logger.error(f"Error durante el stream de la respuesta: {e}", exc_info=True)
+            yield _sse("error", {"detail": "Error al procesar la respuesta del chatbot"})
+        finally:
+            # Con la respuesta guardada un duplicado la repite; sin ella, puede regenerar de inmediato
+            if guard:
+                await guard.release(key, attempt)
+    
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    if Settings.SERVER_TIMING:
+        # Solo las etapas previas al primer token: el resto llega después de los encabezados
+        headers["Server-Timing"] = budget.server_timing()
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers=headers
+    )
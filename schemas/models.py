@@ -9,9 +9,14 @@ class MessageRequest(BaseModel):
     emisor_tipo: str  # 'lead' o 'agente'
     emisor_id: Optional[str] = None  # id del perfil del agente si es un agente humano
     programa_id: Optional[str] = None  # opcional, se puede extraer del contexto
+    idempotency_key: Optional[str] = None  # opcional, también se acepta el encabezado Idempotency-Key
 
 class AgentControl(BaseModel):
     conversation_id: str
     agent_id: str
     activate_chatbot: bool
-    message: Optional[str] = None
\ No newline at end of file
+    message: Optional[str] = None
+
+class CacheInvalidation(BaseModel):
+    chatbot_id: Optional[str] = None
+    programa_id: Optional[str] = None
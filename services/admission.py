@@ -0,0 +1,215 @@
+import json
+import time
+import logging
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+from services.limiter import ConcurrencyLimiter
+from services.metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+# Rutas que pasan por el control de admisión (solo POST)
+ADMISSION_PATHS = ('/message', '/message/stream', '/message/jobs')
+# Emisores que nunca llaman al modelo: se admiten siempre
+PRIORITY_SENDERS = frozenset({'agente'})
+
+class Rejection(NamedTuple):
+    reason: str
+    retry_after: int
+    detail: str
+
+class TokenBucket:
+    """Cubeta de fichas: rate fichas por segundo hasta un máximo de burst"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self) -> float:
+        """Toma una ficha; devuelve 0 si se pudo o los segundos hasta la próxima"""
+        self._refill(time.monotonic())
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+class AdmissionController:
+    """Decide si un mensaje entra al worker antes de leerlo por completo en FastAPI
+
+    Rechaza con 503 cuando el worker ya tiene max_in_flight mensajes en curso o
+    la cola del limitador del modelo llegó a max_llm_queue: es mejor que la
+    pasarela reintente a que las peticiones se acumulen hasta que gunicorn mate
+    el worker. Cada chatbot tiene además su cubeta de fichas para que una campaña
+    ruidosa no deje sin cupo a las demás. Los mensajes de agentes humanos no
+    llaman al modelo y se admiten siempre. Los límites son por worker.
+    """
+
+    def __init__(
+        self,
+        limiter: Optional[ConcurrencyLimiter] = None,
+        max_in_flight: int = 64,
+        max_llm_queue: int = 32,
+        chatbot_rate: float = 5.0,
+        chatbot_burst: float = 20.0,
+        retry_after: int = 5,
+        max_buckets: int = 10000,
+        metrics: Optional[Metrics] = None
+    ):
+        self.limiter = limiter or ConcurrencyLimiter()
+        self.max_in_flight = max_in_flight
+        self.max_llm_queue = max_llm_queue
+        self.chatbot_rate = chatbot_rate
+        self.chatbot_burst = chatbot_burst
+        self.retry_after = retry_after
+        self.max_buckets = max_buckets
+        self.metrics = metrics or Metrics()
+        self._buckets: Dict[str, TokenBucket] = {}
+        self.in_flight = 0
+        self.counts: Dict[Tuple[str, str], int] = {}
+
+    def admit(self, chatbot_id: Optional[str], sender: Optional[str]) -> Optional[Rejection]:
+        """None si el mensaje se admite (y cuenta como en curso hasta release), o el motivo del rechazo"""
+        if sender in PRIORITY_SENDERS:
+            return self._accept('agente')
+
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            return self._reject(Rejection(
+                'en_curso', self.retry_after, "El servicio está saturado, intenta de nuevo en unos segundos"
+            ))
+        if self.max_llm_queue and self.limiter.queued >= self.max_llm_queue:
+            return self._reject(Rejection(
+                'cola_modelo', self.retry_after, "El servicio está saturado, intenta de nuevo en unos segundos"
+            ))
+        if self.chatbot_rate > 0 and chatbot_id:
+            wait = self._bucket(str(chatbot_id)).take()
+            if wait:
+                return self._reject(Rejection(
+                    'chatbot', max(1, int(wait + 0.999)),
+                    "Demasiados mensajes para este chatbot, intenta de nuevo en unos segundos"
+                ))
+        return self._accept('lead')
+
+    def release(self) -> None:
+        self.in_flight -= 1
+
+    def _bucket(self, chatbot_id: str) -> TokenBucket:
+        bucket = self._buckets.get(chatbot_id)
+        if bucket is None:
+            if len(self._buckets) >= self.max_buckets:
+                # Una cubeta llena equivale a una nueva: se pueden descartar sin perder estado
+                now = time.monotonic()
+                for key in [key for key, b in self._buckets.items() if b.full(now)]:
+                    del self._buckets[key]
+            bucket = self._buckets[chatbot_id] = TokenBucket(self.chatbot_rate, self.chatbot_burst)
+        return bucket
+
+    def _accept(self, lane: str) -> None:
+        self.in_flight += 1
+        self._count('admitido', lane)
+        return None
+
+    def _reject(self, rejection: Rejection) -> Rejection:
+        self._count('rechazado', rejection.reason)
+        return rejection
+
+    def _count(self, decision: str, reason: str) -> None:
+        key = (decision, reason)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.metrics.inc('admission_total', decision=decision, reason=reason)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'en_curso': self.in_flight,
+            'max_en_curso': self.max_in_flight,
+            'max_cola_modelo': self.max_llm_queue,
+            'chatbots': len(self._buckets),
+            **{f'{decision}_{reason}': count for (decision, reason), count in sorted(self.counts.items())}
+        }
+
+class AdmissionMiddleware:
+    """Middleware ASGI que aplica el AdmissionController del worker a POST /message
+
+    Lee el cuerpo (pequeño) para conocer el chatbot y el emisor y luego se lo
+    entrega intacto a la aplicación. Un rechazo responde 503 con Retry-After sin
+    pasar por FastAPI.
+    """
+
+    def __init__(self, app, paths: Tuple[str, ...] = ADMISSION_PATHS):
+        self.app = app
+        self.paths = frozenset(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'POST' or scope['path'] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+        services = getattr(scope['app'].state, 'services', None)
+        controller = getattr(services, 'admission', None)
+        if controller is None:
+            await self.app(scope, receive, send)
+            return
+
+        messages = []
+        body = b''
+        while True:
+            message = await receive()
+            messages.append(message)
+            if message['type'] != 'http.request':
+                break
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        chatbot_id, sender = _peek(body)
+        rejection = controller.admit(chatbot_id, sender)
+        if rejection is not None:
+            logger.warning("Mensaje rechazado por control de admisión (%s, chatbot %s)", rejection.reason, chatbot_id)
+            await _send_rejection(send, rejection)
+            return
+
+        async def replay():
+            if messages:
+                return messages.pop(0)
+            return await receive()
+
+        try:
+            await self.app(scope, replay, send)
+        finally:
+            controller.release()
+
+def _peek(body: bytes) -> Tuple[Optional[str], Optional[str]]:
+    try:
+        data = json.loads(body)
+    except ValueError:
+        # FastAPI responderá 422: no se decide aquí
+        return None, None
+    if not isinstance(data, dict):
+        return None, None
+    return _text(data.get('chatbot_id')), _text(data.get('emisor_tipo'))
+
+def _text(value: Any) -> Optional[str]:
+    # Un tipo inválido (lista, objeto) lo rechaza FastAPI con 422; aquí solo no debe fallar
+    return value if isinstance(value, str) else None
+
+async def _send_rejection(send, rejection: Rejection) -> None:
+    payload = json.dumps({'detail': rejection.detail, 'reason': rejection.reason}, ensure_ascii=False).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': 503,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(payload)).encode('latin-1')),
+            (b'retry-after', str(rejection.retry_after).encode('latin-1'))
+        ]
+    })
+    await send({'type': 'http.response.body', 'body': payload})
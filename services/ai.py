@@ -1,87 +1,280 @@
 import os
-from typing import List
+from typing import Any, AsyncIterator, Dict, List, Optional
+from contextlib import aclosing
 import logging
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import SystemMessage, HumanMessage
+import httpx
 import asyncio
-from tenacity import retry, stop_after_attempt, wait_exponential
+import time
+from services.limiter import ConcurrencyLimiter, LLMOverloadedError
+from services.context_store import SystemContext
+from services.llm_client import create_chat_client
+from services.metrics import Metrics
+from services.providers import CircuitBreaker, LLMProvider, ProviderRouter
+from services.prompt import PromptBuilder, TokenCounter, trim_to_sentence
+from tenacity import retry, retry_if_exception_type, retry_if_not_exception_type, stop_after_attempt, wait_exponential
 
 logger = logging.getLogger(__name__)
 
+MAX_RESPONSE_CHARS = 2000
+
+TIMEOUT_MESSAGE = "Lo siento, estoy tardando demasiado en responder. ¿Podrías reformular tu pregunta de forma más específica?"
+ERROR_MESSAGE = "Lo siento, tuve un problema al procesar tu mensaje. ¿Podrías intentarlo de nuevo?"
+EMPTY_MESSAGE = "Lo siento, no pude generar una respuesta válida. ¿Podrías reformular tu pregunta?"
+
+# Respuestas de contingencia: nunca se guardan como respuestas reutilizables
+FALLBACK_MESSAGES = frozenset({TIMEOUT_MESSAGE, ERROR_MESSAGE, EMPTY_MESSAGE})
+
+def cap_response(response: str) -> str:
+    """Salvaguarda por si el proveedor ignora max_tokens: una respuesta que llega al
+    límite de caracteres se corta ahí y en la última oración completa
+
+    Es la misma regla para /message y para el stream, que deja de emitir al llegar
+    al límite.
+    """
+    if len(response) < MAX_RESPONSE_CHARS:
+        return response
+    return trim_to_sentence(response[:MAX_RESPONSE_CHARS])
+
 class AIService:
-    def __init__(self):
-        self.model = ChatOpenAI(
-            model_name="deepseek-chat",
-            openai_api_key=os.getenv('DEEPSEEK_API_KEY'),
-            openai_api_base="https://api.deepseek.com/v1",
-            temperature=0.7,
-            request_timeout=20,
-            max_retries=1
+    def __init__(
+        self,
+        limits: Optional[httpx.Limits] = None,
+        timeout: float = 20.0,
+        limiter: Optional[ConcurrencyLimiter] = None,
+        metrics: Optional[Metrics] = None,
+        max_input_tokens: int = 3000,
+        max_tokens: int = 512,
+        backend: str = 'langchain',
+        fallback_model: Optional[str] = "gpt-4o-mini",
+        breaker_failures: int = 5,
+        breaker_reset: float = 30.0,
+        slow_call: float = 10.0,
+        hedge: bool = False,
+        hedge_percentile: float = 0.95,
+        hedge_min_delay: float = 1.0,
+        hedge_max_ratio: float = 0.1
+    ):
+        limits = limits or httpx.Limits()
+        self.limiter = limiter or ConcurrencyLimiter()
+        self.metrics = metrics or Metrics()
+
+        # Cliente HTTP keep-alive reutilizado por todas las llamadas del worker
+        self.async_http_client = httpx.AsyncClient(limits=limits, timeout=timeout)
+        self.backend = backend
+        self.timeout = timeout
+        client_params = {'timeout': timeout, 'max_tokens': max_tokens}
+        providers = [LLMProvider(
+            'deepseek',
+            self.chat_client("deepseek-chat", max_tokens),
+            CircuitBreaker('deepseek', breaker_failures, breaker_reset, self.metrics),
+            slow_call
+        )]
+
+        # Modelo de respaldo cuando el circuito del principal está abierto o su llamada falla
+        openai_key = os.getenv('OPENAI_API_KEY')
+        if fallback_model and openai_key:
+            providers.append(LLMProvider(
+                'openai',
+                create_chat_client(
+                    backend,
+                    http_client=httpx.AsyncClient(limits=limits, timeout=timeout),
+                    model=fallback_model,
+                    api_key=openai_key,
+                    api_base=os.getenv('OPENAI_API_BASE', "https://api.openai.com/v1"),
+                    **client_params
+                ),
+                CircuitBreaker('openai', breaker_failures, breaker_reset, self.metrics),
+                slow_call
+            ))
+        # Las llamadas al modelo son nativas asíncronas y no ocupan el pool de hilos del loop
+        self.providers = ProviderRouter(
+            providers,
+            limiter=self.limiter,
+            metrics=self.metrics,
+            hedge=hedge,
+            hedge_percentile=hedge_percentile,
+            hedge_min_delay=hedge_min_delay,
+            hedge_max_ratio=hedge_max_ratio
+        )
+        self.tokens = TokenCounter("deepseek-chat")
+        self.prompts = PromptBuilder(self.tokens, max_input_tokens=max_input_tokens)
+
+    def chat_client(self, model: str, max_tokens: int, temperature: float = 0.7):
+        """Cliente del proveedor principal sobre el pool HTTP del worker, con otro modelo o parámetros"""
+        return create_chat_client(
+            self.backend,
+            http_client=self.async_http_client,
+            model=model,
+            api_key=os.getenv('DEEPSEEK_API_KEY'),
+            api_base=os.getenv('DEEPSEEK_API_BASE', "https://api.deepseek.com/v1"),
+            timeout=self.timeout,
+            max_tokens=max_tokens,
+            temperature=temperature
         )
 
-    def detect_study_plan_request(self, message: str) -> bool:
-        """Detecta si el mensaje es una solicitud de plan de estudios"""
-        message = message.lower()
-        keywords = ['plan', 'estudio', 'pensum', 'materias', 'asignaturas', 'semestres']
-        return any(keyword in message for keyword in keywords)
+    async def aclose(self) -> None:
+        """Cierra los pools HTTP hacia los proveedores del modelo"""
+        for provider in self.providers.providers:
+            await provider.client.aclose()
 
-    @retry(stop=stop_after_attempt(2), wait=wait_exponential(multiplier=1, min=2, max=5))
-    async def generate_response(self, context: str, history: List[str], message: str) -> str:
+    async def generate_response(
+        self,
+        context: str,
+        history: List[Dict[str, Any]],
+        message: str,
+        timeout: Optional[float] = None,
+        program_context: str = '',
+        system: Optional[SystemContext] = None,
+        summary: str = ''
+    ) -> str:
         """Genera una respuesta usando el modelo de IA con reintentos"""
         try:
             # Preparar el contexto y el mensaje
-            prompt = self._prepare_prompt(context, history[-3:], message)
+            prompt = self._prepare_prompt(context, history, message, program_context, system, summary)
             
-            # Generar respuesta usando asyncio.to_thread directamente
-            loop = asyncio.get_running_loop()
-            response = await loop.run_in_executor(None, self._generate_response_sync, prompt)
+            # La espera por un cupo y los reintentos también cuentan dentro del timeout de la petición
+            response = await asyncio.wait_for(self._generate_with_retries(prompt), timeout=timeout)
             
             # Validar y limpiar la respuesta
             cleaned_response = self._clean_response(response)
             return cleaned_response
 
+        except LLMOverloadedError:
+            # Sin cupo o sin proveedor disponible (LLMUnavailableError): el llamador responde 503 en lugar de esperar
+            raise
         except asyncio.TimeoutError:
             logger.error("Timeout al generar respuesta de IA")
-            return "Lo siento, estoy tardando demasiado en responder. ¿Podrías reformular tu pregunta de forma más específica?"
+            return TIMEOUT_MESSAGE
         except Exception as e:
             logger.error(f"Error al generar respuesta de IA: {e}", exc_info=True)
-            return "Lo siento, tuve un problema al procesar tu mensaje. ¿Podrías intentarlo de nuevo?"
+            return ERROR_MESSAGE
+
+    async def stream_response(
+        self,
+        context: str,
+        history: List[Dict[str, Any]],
+        message: str,
+        program_context: str = '',
+        system: Optional[SystemContext] = None,
+        summary: str = ''
+    ) -> AsyncIterator[str]:
+        """Genera la respuesta token a token; max_tokens limita su largo y MAX_RESPONSE_CHARS lo que se emite
 
-    def _prepare_prompt(self, context: str, history: List[str], message: str) -> List:
-        """Prepara el prompt para el modelo"""
+        El texto emitido debe pasar por cap_response antes de guardarse.
+        """
+        prompt = self._prepare_prompt(context, history, message, program_context, system, summary)
+        chunks_received = 0
+        emitted = 0
+        usage = None
+        outcome = 'ok'
+        queued = time.perf_counter()
+        # aclosing cierra el stream del proveedor en cuanto el consumidor deja de leer
+        provider = self.providers.primary.name
+        async with self.limiter.slot(), aclosing(self.providers.stream(prompt)) as chunks:
+            started = time.perf_counter()
+            self.metrics.observe('llm_queue_wait_seconds', started - queued)
+            try:
+                async for chunk, used in chunks:
+                    provider = used.name
+                    usage = chunk.usage or usage
+                    text = chunk.text
+                    if not text:
+                        continue
+                    chunks_received += 1
+                    if emitted + len(text) >= MAX_RESPONSE_CHARS:
+                        # Al salir del bucle aclosing cierra el stream y el proveedor deja de generar
+                        yield text[:MAX_RESPONSE_CHARS - emitted]
+                        logger.warning("Respuesta del stream cortada en %d caracteres", MAX_RESPONSE_CHARS)
+                        break
+                    emitted += len(text)
+                    yield text
+            except (asyncio.CancelledError, GeneratorExit):
+                outcome = 'cancelled'
+                raise
+            except Exception:
+                outcome = 'error'
+                raise
+            finally:
+                self.metrics.observe(
+                    'llm_seconds', time.perf_counter() - started, operation='stream', outcome=outcome, provider=provider
+                )
+                if usage:
+                    self._record_usage(usage)
+                else:
+                    # Sin conteo de uso en el stream: cada fragmento equivale aproximadamente a un token
+                    self.metrics.inc('llm_tokens_total', chunks_received, type='completion', source='stream')
+
+    def _prepare_prompt(
+        self,
+        context: str,
+        history: List[Dict[str, Any]],
+        message: str,
+        program_context: str = '',
+        system: Optional[SystemContext] = None,
+        summary: str = ''
+    ) -> List[Dict[str, str]]:
+        """Prepara el prompt para el modelo dentro del presupuesto de tokens de entrada"""
         try:
-            messages = [SystemMessage(content=context)]
-            
-            # Agregar historial limitado
-            for msg in history:
-                messages.append(HumanMessage(content=msg))
-            
-            # Agregar mensaje actual
-            messages.append(HumanMessage(content=message))
-            
-            return messages
+            if system is not None:
+                # Contexto precompilado: el texto y sus tokens ya están en el ContextStore
+                return self.prompts.build(
+                    system.context, history, message, system.program_context,
+                    system.context_tokens, system.program_tokens, summary
+                )
+            return self.prompts.build(context, history, message, program_context, summary=summary)
         except Exception as e:
             logger.error(f"Error al preparar prompt: {e}", exc_info=True)
             raise
 
-    def _generate_response_sync(self, messages) -> str:
-        """Método sincrónico para generar respuesta"""
-        try:
-            response = self.model.invoke(messages)
-            if not response or not response.content:
-                raise ValueError("Respuesta vacía del modelo")
-            return response.content
-        except Exception as e:
-            logger.error(f"Error en _generate_response_sync: {e}", exc_info=True)
-            raise
+    @retry(
+        stop=stop_after_attempt(2),
+        wait=wait_exponential(multiplier=0.5, min=0.5, max=2),
+        # Solo fallas del modelo: una cancelación (timeout, cliente desconectado) no se reintenta
+        retry=retry_if_exception_type(Exception) & retry_if_not_exception_type(LLMOverloadedError),
+        before_sleep=lambda state: state.args[0].metrics.inc('llm_retries_total')
+    )
+    async def _generate_with_retries(self, messages: List[Dict[str, str]]) -> str:
+        """Un reintento ante una falla del modelo; generate_response decide la respuesta de contingencia"""
+        return await self._generate_limited(messages)
+
+    async def _generate_limited(self, messages: List[Dict[str, str]]) -> str:
+        """Llama al modelo de forma asíncrona dentro de un cupo del limitador"""
+        queued = time.perf_counter()
+        async with self.limiter.slot():
+            started = time.perf_counter()
+            self.metrics.observe('llm_queue_wait_seconds', started - queued)
+            outcome = 'error'
+            provider = self.providers.primary.name
+            try:
+                result, used = await self.providers.generate(messages)
+                provider = used.name
+                outcome = 'ok'
+            except asyncio.CancelledError:
+                outcome = 'cancelled'
+                raise
+            finally:
+                self.metrics.observe(
+                    'llm_seconds', time.perf_counter() - started, operation='generate', outcome=outcome, provider=provider
+                )
+        self._record_usage(result.usage)
+        response = result.text
+        if not response:
+            raise ValueError("Respuesta vacía del modelo")
+        if result.finish_reason == 'length':
+            # Se alcanzó max_tokens: se entrega hasta la última oración completa
+            response = trim_to_sentence(response)
+        return response
+
+    def _record_usage(self, usage: Optional[Dict[str, Any]]) -> None:
+        usage = usage or {}
+        for kind in ('prompt', 'completion'):
+            tokens = usage.get(f'{kind}_tokens')
+            if tokens:
+                self.metrics.inc('llm_tokens_total', tokens, type=kind, source='usage')
 
     def _clean_response(self, response: str) -> str:
         """Limpia y valida la respuesta del modelo"""
         if not response or len(response.strip()) == 0:
-            return "Lo siento, no pude generar una respuesta válida. ¿Podrías reformular tu pregunta?"
-        
-        # Limitar longitud de respuesta
-        if len(response) > 2000:
-            response = response[:1997] + "..."
+            return EMPTY_MESSAGE
         
-        return response
\ No newline at end of file
+        return cap_response(response)
\ No newline at end of file
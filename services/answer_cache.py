@@ -0,0 +1,118 @@
+import time
+import hashlib
+import logging
+from typing import Any, Dict, Iterable, List, Optional
+from services.local_store import LocalStore
+from services.text import normalize_question
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS respuestas (
+    clave TEXT PRIMARY KEY,
+    chatbot_id TEXT NOT NULL,
+    respuesta TEXT NOT NULL,
+    llm_ms REAL NOT NULL DEFAULT 0,
+    creado REAL NOT NULL,
+    expira REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS respuestas_expira ON respuestas (expira);
+CREATE INDEX IF NOT EXISTS respuestas_chatbot ON respuestas (chatbot_id);
+'''
+
+class AnswerCache:
+    """Respuestas ya generadas para preguntas repetidas, por contexto del chatbot y pregunta normalizada"""
+
+    def __init__(
+        self,
+        store: LocalStore,
+        chatbots: Iterable[str],
+        ttl: float = 86400.0,
+        max_entries: int = 10000,
+        history_turns: int = 0
+    ):
+        self.store = store
+        self.chatbots = set(chatbots)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.history_turns = history_turns
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.saved_ms = 0.0
+
+    def enabled_for(self, chatbot_id: str) -> bool:
+        return '*' in self.chatbots or chatbot_id in self.chatbots
+
+    def make_key(self, context_digest: str, question: str, history: List[Dict[str, Any]]) -> str:
+        """Hash del contexto del sistema (su digest del ContextStore), la pregunta normalizada y, opcionalmente, los últimos turnos"""
+        digest = hashlib.sha256()
+        digest.update(context_digest.encode('utf-8'))
+        digest.update(b'\x00')
+        digest.update(normalize_question(question).encode('utf-8'))
+        if self.history_turns:
+            for turn in history[-self.history_turns:]:
+                digest.update(b'\x00')
+                digest.update(f"{turn.get('emisor_tipo')}:{normalize_question(turn.get('contenido', ''))}".encode('utf-8'))
+        return digest.hexdigest()
+
+    async def get(self, key: str) -> Optional[str]:
+        try:
+            row = await self.store.run(_select, key, time.time())
+        except Exception as e:
+            logger.warning(f"Error al leer la caché de respuestas: {e}")
+            return None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.saved_ms += row['llm_ms']
+        return row['respuesta']
+
+    async def put(self, key: str, chatbot_id: str, answer: str, llm_ms: float) -> None:
+        now = time.time()
+        self._writes += 1
+        # La limpieza se hace cada cierto número de escrituras para no pagarla siempre
+        prune = self._writes % 100 == 1
+        try:
+            await self.store.run(_upsert, key, chatbot_id, answer, llm_ms, now, now + self.ttl, prune, self.max_entries)
+            self.stores += 1
+        except Exception as e:
+            logger.warning(f"Error al guardar en la caché de respuestas: {e}")
+
+    async def invalidate_chatbot(self, chatbot_id: str) -> int:
+        return await self.store.run(_delete_chatbot, chatbot_id)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'chatbots': sorted(self.chatbots),
+            'hits': self.hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            'llm_ms_saved': round(self.saved_ms, 2)
+        }
+
+def _select(conn, key: str, now: float):
+    return conn.execute(
+        'SELECT respuesta, llm_ms FROM respuestas WHERE clave = ? AND expira > ?',
+        (key, now)
+    ).fetchone()
+
+def _upsert(conn, key, chatbot_id, answer, llm_ms, now, expires, prune, max_entries) -> None:
+    conn.execute(
+        'INSERT OR REPLACE INTO respuestas (clave, chatbot_id, respuesta, llm_ms, creado, expira) VALUES (?, ?, ?, ?, ?, ?)',
+        (key, chatbot_id, answer, llm_ms, now, expires)
+    )
+    if prune:
+        conn.execute('DELETE FROM respuestas WHERE expira <= ?', (now,))
+        conn.execute(
+            'DELETE FROM respuestas WHERE clave IN ('
+            'SELECT clave FROM respuestas ORDER BY creado DESC LIMIT -1 OFFSET ?)',
+            (max_entries,)
+        )
+
+def _delete_chatbot(conn, chatbot_id: str) -> int:
+    return conn.execute('DELETE FROM respuestas WHERE chatbot_id = ?', (chatbot_id,)).rowcount
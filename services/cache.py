@@ -0,0 +1,239 @@
+import os
+import json
+import fcntl
+import time
+import asyncio
+import logging
+import tempfile
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+def default_invalidation_path() -> str:
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(base, 'eamcrm-cache-invalidations.log')
+
+def _consume_exception(task: asyncio.Future) -> None:
+    if not task.cancelled():
+        task.exception()
+
+class InvalidationLog:
+    """Registro de invalidaciones compartido entre los workers del mismo host
+
+    Cuando el archivo pasa de max_bytes, el worker que publica lo renombra a
+    `<path>.1` bajo un flock y las siguientes líneas van a un archivo nuevo. Un
+    lector detecta el cambio de inodo, termina de leer el archivo anterior desde
+    su posición y sigue con el nuevo desde el principio.
+    """
+
+    def __init__(self, path: str, poll_interval: float = 1.0, max_bytes: int = 1 << 20):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.max_bytes = max_bytes
+        self._inode, self._offset = self._stat(self.path)
+        self._next_poll = 0.0
+
+    @staticmethod
+    def _stat(path: str) -> Tuple[Optional[int], int]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None, 0
+        return st.st_ino, st.st_size
+
+    def publish(self, keys: Iterable[Tuple[str, str]]) -> None:
+        line = json.dumps({'pid': os.getpid(), 'ts': time.time(), 'keys': [list(k) for k in keys]}) + '\n'
+        # O_APPEND hace atómica la escritura de líneas cortas entre procesos
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, line.encode('utf-8'))
+            size = os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+        if size > self.max_bytes:
+            self._rotate()
+
+    def _rotate(self) -> None:
+        lock = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Otro worker pudo haberlo rotado mientras se esperaba el lock
+            if self._stat(self.path)[1] > self.max_bytes:
+                os.replace(self.path, self.path + '.1')
+        except OSError as e:
+            logger.warning(f"No se pudo rotar el registro de invalidaciones: {e}")
+        finally:
+            os.close(lock)
+
+    def poll(self) -> Iterable[Tuple[str, str]]:
+        """Devuelve las claves invalidadas por otros workers desde la última lectura"""
+        now = time.monotonic()
+        if now < self._next_poll:
+            return []
+        self._next_poll = now + self.poll_interval
+
+        keys = []
+        inode, size = self._stat(self.path)
+        if inode != self._inode:
+            # Rotado: lo que quedaba por leer está en el archivo anterior
+            previous = self.path + '.1'
+            previous_inode, previous_size = self._stat(previous)
+            if self._inode is not None and previous_inode == self._inode:
+                keys.extend(self._read(previous, previous_size))
+            self._inode, self._offset = inode, 0
+        elif size < self._offset:
+            self._offset = 0  # Truncado por fuera
+        if inode is not None and size > self._offset:
+            keys.extend(self._read(self.path, size))
+        return keys
+
+    def _read(self, path: str, size: int) -> Iterable[Tuple[str, str]]:
+        keys = []
+        pid = os.getpid()
+        try:
+            with open(path, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read(size - self._offset)
+        except OSError:
+            return keys
+        # Solo se consumen líneas completas
+        end = data.rfind(b'\n') + 1
+        self._offset += end
+        for line in data[:end].splitlines():
+            try:
+                record = json.loads(line)
+                if record.get('pid') != pid:
+                    keys.extend(tuple(k) for k in record['keys'])
+            except (ValueError, KeyError, TypeError):
+                continue
+        return keys
+
+class TTLCache:
+    """Cache LRU acotada con TTL por tabla, caché negativa y carga single-flight"""
+
+    def __init__(
+        self,
+        maxsize: int = 2048,
+        ttls: Optional[Dict[str, float]] = None,
+        default_ttl: float = 300.0,
+        negative_ttl: float = 60.0,
+        invalidation_log: Optional[InvalidationLog] = None
+    ):
+        self.maxsize = maxsize
+        self.ttls = ttls or {}
+        self.default_ttl = default_ttl
+        self.negative_ttl = negative_ttl
+        self.invalidation_log = invalidation_log
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.load_errors = 0
+
+    async def get_or_load(self, key: Tuple[str, str], loader: Callable[[], Awaitable[Any]]) -> Any:
+        """Devuelve el valor en caché o lo carga una sola vez aunque haya peticiones concurrentes"""
+        self._sync_invalidations()
+
+        entry = self._data.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                self._data.move_to_end(key)
+                if value is None:
+                    self.negative_hits += 1
+                else:
+                    self.hits += 1
+                return value
+            del self._data[key]
+
+        task = self._inflight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._load(key, loader))
+            task.add_done_callback(_consume_exception)
+            self._inflight[key] = task
+        else:
+            self.coalesced += 1
+        # shield: cancelar a quien espera no cancela la carga compartida
+        return await asyncio.shield(task)
+
+    async def _load(self, key: Tuple[str, str], loader: Callable[[], Awaitable[Any]]) -> Any:
+        current = asyncio.current_task()
+        try:
+            value = await loader()
+        except Exception:
+            # Los errores no se guardan: el próximo acceso vuelve a intentarlo
+            self.load_errors += 1
+            raise
+        finally:
+            owner = self._inflight.get(key) is current
+            if owner:
+                self._inflight.pop(key, None)
+        # Si la clave se invalidó durante la carga, el valor ya no es confiable
+        if owner:
+            self._store(key, value)
+        return value
+
+    def _store(self, key: Tuple[str, str], value: Any) -> None:
+        ttl = self.negative_ttl if value is None else self.ttls.get(key[0], self.default_ttl)
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def set(self, key: Tuple[str, str], value: Any, broadcast: bool = True) -> None:
+        """Guarda un valor recién escrito en la base de datos y descarta la copia de los demás workers"""
+        self._inflight.pop(key, None)
+        self._store(key, value)
+        if broadcast and self.invalidation_log:
+            try:
+                self.invalidation_log.publish([key])
+            except OSError as e:
+                logger.warning(f"No se pudo publicar la invalidación de caché: {e}")
+
+    def invalidate(self, keys: Iterable[Tuple[str, str]], broadcast: bool = True) -> int:
+        """Elimina claves de la caché y, opcionalmente, avisa a los demás workers"""
+        keys = list(keys)
+        removed = sum(1 for key in keys if self._data.pop(key, None) is not None)
+        for key in keys:
+            self._inflight.pop(key, None)
+        if broadcast and self.invalidation_log:
+            try:
+                self.invalidation_log.publish(keys)
+            except OSError as e:
+                logger.warning(f"No se pudo publicar la invalidación de caché: {e}")
+        return removed
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def _sync_invalidations(self) -> None:
+        if not self.invalidation_log:
+            return
+        try:
+            keys = self.invalidation_log.poll()
+        except OSError as e:
+            logger.warning(f"No se pudo leer el registro de invalidaciones: {e}")
+            return
+        for key in keys:
+            self._data.pop(key, None)
+            self._inflight.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.negative_hits + self.misses + self.coalesced
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'evictions': self.evictions,
+            'load_errors': self.load_errors,
+            'hit_ratio': round((self.hits + self.negative_hits + self.coalesced) / lookups, 4) if lookups else 0.0
+        }
@@ -0,0 +1,421 @@
+import os
+import re
+import gc
+import json
+import mmap
+import time
+import zlib
+import fcntl
+import struct
+import asyncio
+import hashlib
+import logging
+import tempfile
+from contextlib import contextmanager
+from types import MappingProxyType
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
+from services.text import normalize_text
+
+logger = logging.getLogger(__name__)
+
+# Tablas del snapshot y la columna por la que se consultan
+SNAPSHOT_TABLES = (
+    ('chatbots', 'id'),
+    ('programas_academicos', 'id'),
+    ('planes_estudio', 'programa_id'),
+)
+
+_MAGIC = b'EAMCAT01'
+# Versión, momento de la última verificación contra la base de datos y crc32 del contenido
+_HEADER = struct.Struct('<QdI')
+
+def default_snapshot_path(source: str = '') -> str:
+    # Un archivo por base de datos: staging y producción pueden compartir host
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    name = hashlib.sha1(source.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(base, f'eamcrm-catalog-{name}')
+
+def encode_tables(tables: Dict[str, List[Dict[str, Any]]]) -> bytes:
+    """Serialización canónica: el mismo contenido produce siempre los mismos bytes"""
+    return json.dumps(tables, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+def write_snapshot(path: str, payload: bytes, version: int, checked_at: float) -> None:
+    """Publica el snapshot reemplazando el archivo de forma atómica"""
+    directory = os.path.dirname(path) or '.'
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.catalog-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_MAGIC)
+            f.write(_HEADER.pack(version, checked_at, zlib.crc32(payload)))
+            f.write(payload)
+        os.chmod(tmp, 0o600)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+def read_snapshot(path: str, header_only: bool = False) -> Optional[Tuple[int, float, Optional[bytes]]]:
+    """Lee (versión, verificado, contenido) del archivo mapeado en memoria; None si no existe o está dañado"""
+    try:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < len(_MAGIC) + _HEADER.size:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if data[:len(_MAGIC)] != _MAGIC:
+                    return None
+                version, checked_at, crc = _HEADER.unpack_from(data, len(_MAGIC))
+                if header_only:
+                    return version, checked_at, None
+                payload = data[len(_MAGIC) + _HEADER.size:]
+    except FileNotFoundError:
+        return None
+    if zlib.crc32(payload) != crc:
+        logger.warning(f"Snapshot del catálogo dañado, se ignora: {path}")
+        return None
+    return version, checked_at, payload
+
+class ProgramMatcher:
+    """Índice inmutable que encuentra nombres de programas con una sola expresión regular"""
+
+    def __init__(self, programs: List[Dict[str, Any]]):
+        self.programs = tuple(programs)
+        self._ids_by_name: Dict[str, str] = {}
+        for programa in programs:
+            name = normalize_text(programa.get('nombre') or '')
+            if name and name not in self._ids_by_name:
+                self._ids_by_name[name] = programa['id']
+
+        # Los nombres más largos primero para que "Ingeniería de Sistemas" gane a "Ingeniería"
+        names = sorted(self._ids_by_name, key=len, reverse=True)
+        self._pattern = re.compile(
+            r'(?<!\w)(?:' + '|'.join(re.escape(name) for name in names) + r')(?!\w)'
+        ) if names else None
+
+    def find(self, texts: List[str]) -> List[str]:
+        """Devuelve los ids mencionados ordenados por su última aparición (la más reciente al final)"""
+        if not self._pattern:
+            return []
+        last_seen: Dict[str, Tuple[int, int]] = {}
+        for index, text in enumerate(texts):
+            for match in self._pattern.finditer(normalize_text(text)):
+                last_seen[self._ids_by_name[match.group(0)]] = (index, match.start())
+        return sorted(last_seen, key=last_seen.get)
+
+class CatalogSnapshot:
+    """Copia inmutable de chatbots, programas y planes de estudio
+
+    Nunca se modifica: un refresco construye otro snapshot y lo reemplaza con
+    una sola asignación, así cada petición ve una versión completa. Las filas
+    se entregan sin copiar y deben tratarse como de solo lectura.
+    """
+
+    __slots__ = ('version', 'loaded_at', 'digest', 'chatbots', 'programs', 'study_plans', 'matcher')
+
+    def __init__(self, tables: Dict[str, List[Dict[str, Any]]], version: int, loaded_at: float, digest: str):
+        self.version = version
+        self.loaded_at = loaded_at
+        self.digest = digest
+        indexes = [
+            MappingProxyType({row[column]: row for row in tables.get(table) or [] if row.get(column) is not None})
+            for table, column in SNAPSHOT_TABLES
+        ]
+        self.chatbots, self.programs, self.study_plans = indexes
+        # El listado y el índice de menciones solo necesitan id y nombre
+        self.matcher = ProgramMatcher([
+            {'id': programa['id'], 'nombre': programa.get('nombre')}
+            for programa in tables.get('programas_academicos') or []
+        ])
+
+    @classmethod
+    def from_payload(cls, payload: bytes, version: int, loaded_at: float) -> "CatalogSnapshot":
+        return cls(json.loads(payload), version, loaded_at, hashlib.sha256(payload).hexdigest())
+
+    @property
+    def program_list(self) -> Tuple[Dict[str, Any], ...]:
+        return self.matcher.programs
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'version': self.version,
+            'chatbots': len(self.chatbots),
+            'programas': len(self.programs),
+            'planes': len(self.study_plans)
+        }
+
+@contextmanager
+def _try_lock(path: Optional[str]) -> Iterator[bool]:
+    """Lock exclusivo entre procesos sin esperar: indica si este proceso lo obtuvo"""
+    if not path:
+        yield True
+        return
+    fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+class ProgramCatalog:
+    """Snapshot del catálogo compartido por los workers y refrescado en segundo plano
+
+    Con gunicorn --preload el master carga el snapshot antes del fork y los
+    workers lo heredan copy-on-write. El snapshot también se publica en un
+    archivo mapeado en memoria: un worker nuevo lo adopta sin consultar la base
+    de datos y, cuando vence, solo el worker que obtiene el lock del archivo
+    vuelve a consultar; los demás adoptan lo que ese worker publica. Si el
+    contenido no cambió se conserva el mismo objeto, y con él las páginas
+    compartidas con el master.
+
+    Una fila invalidada deja de servirse desde el snapshot (snapshot_for) hasta
+    que una verificación contra la base de datos iniciada después la cubra.
+    """
+
+    def __init__(
+        self,
+        loader: Callable[[], Awaitable[Dict[str, List[Dict[str, Any]]]]],
+        refresh_interval: float = 300.0,
+        path: Optional[str] = None,
+        poll_interval: float = 5.0,
+        snapshot: Optional[CatalogSnapshot] = None,
+        load_backoff: float = 30.0
+    ):
+        self.loader = loader
+        self.refresh_interval = refresh_interval
+        self.path = path
+        self.poll_interval = poll_interval
+        self.snapshot = snapshot
+        # Tras una carga fallida las peticiones no reintentan durante load_backoff segundos
+        self.load_backoff = load_backoff
+        self._failed_at: Optional[float] = None
+        # (tabla, id) -> momento de la invalidación
+        self._invalidated: Dict[Tuple[str, str], float] = {}
+        self.checked_at = snapshot.loaded_at if snapshot else 0.0
+        self.refreshes = 0
+        self.adopted = 0
+        self._lock = asyncio.Lock()
+        self._refresh_requested = asyncio.Event()
+        self._pending_refresh = False
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def programs(self) -> Tuple[Dict[str, Any], ...]:
+        return self.snapshot.program_list if self.snapshot else ()
+
+    async def refresh(self) -> None:
+        """Vuelve a cargar el catálogo, reemplaza el snapshot si cambió y lo publica en el archivo"""
+        # La verificación vale desde que empieza la consulta: lo invalidado durante ella sigue oculto
+        started = time.time()
+        tables = await self.loader()
+        payload = await asyncio.to_thread(encode_tables, tables)
+        digest = hashlib.sha256(payload).hexdigest()
+        now = time.time()
+        current = self.snapshot
+        if current is None or current.digest != digest:
+            version = max(int(now * 1000), current.version + 1 if current else 0)
+            snapshot = await asyncio.to_thread(CatalogSnapshot, tables, version, now, digest)
+            self.snapshot = snapshot
+            logger.info(f"Catálogo cargado (versión {version}): {snapshot.stats()}")
+        self.checked_at = started
+        self._failed_at = None
+        self.refreshes += 1
+        if self.path:
+            try:
+                await asyncio.to_thread(write_snapshot, self.path, payload, self.snapshot.version, started)
+            except OSError as e:
+                logger.warning(f"No se pudo publicar el snapshot del catálogo: {e}")
+
+    async def _adopt_file(self) -> bool:
+        """Adopta el snapshot publicado por otro proceso si es más nuevo que el propio"""
+        if not self.path:
+            return False
+        header = read_snapshot(self.path, header_only=True)
+        if header is None:
+            return False
+        version, checked_at, _ = header
+        current = self.snapshot
+        if current is not None and version <= current.version:
+            if version == current.version:
+                self.checked_at = max(self.checked_at, checked_at)
+            return False
+        data = await asyncio.to_thread(read_snapshot, self.path)
+        if data is None:
+            return False
+        version, checked_at, payload = data
+        self.snapshot = await asyncio.to_thread(CatalogSnapshot.from_payload, payload, version, checked_at)
+        self.checked_at = checked_at
+        self._failed_at = None
+        self.adopted += 1
+        logger.info(f"Snapshot del catálogo adoptado desde {self.path} (versión {version})")
+        return True
+
+    async def sync(self, force: bool = False) -> None:
+        """Adopta el archivo compartido y, si el snapshot venció (o se pidió), lo vuelve a cargar"""
+        if not force:
+            await self._adopt_file()
+            if time.time() - self.checked_at < self.refresh_interval:
+                return
+        with _try_lock(self.path) as locked:
+            if not locked:
+                # Otro worker está consultando; un refresco pedido se reintenta en la siguiente vuelta
+                self._pending_refresh = self._pending_refresh or force
+                return
+            if not force:
+                await self._adopt_file()
+                if time.time() - self.checked_at < self.refresh_interval:
+                    return
+            await self.refresh()
+
+    def request_refresh(self) -> None:
+        """Pide un refresco inmediato, por ejemplo después de invalidar un chatbot o un programa"""
+        self._refresh_requested.set()
+
+    def invalidate(self, table: str, key: str) -> None:
+        """Oculta una fila del snapshot hasta el próximo refresco y lo pide"""
+        self._invalidated[(table, key)] = time.time()
+        self.request_refresh()
+
+    def snapshot_for(self, table: str, key: str) -> Optional[CatalogSnapshot]:
+        """El snapshot si puede responder por la fila; None si se invalidó después de su última verificación"""
+        invalidated = self._invalidated.get((table, key))
+        if invalidated is not None:
+            if self.checked_at < invalidated:
+                return None
+            del self._invalidated[(table, key)]
+        return self.snapshot
+
+    def _backing_off(self) -> bool:
+        return self._failed_at is not None and time.monotonic() - self._failed_at < self.load_backoff
+
+    async def ensure_loaded(self) -> bool:
+        """Carga el snapshot si todavía no existe; las peticiones concurrentes esperan la misma carga
+
+        Si la última carga falló hace menos de load_backoff segundos devuelve
+        False sin consultar: durante una caída de la base de datos cada mensaje
+        no debe repetir la carga completa. Los reintentos quedan para el refresco
+        periódico.
+        """
+        if self.snapshot is not None:
+            return True
+        if self._backing_off():
+            return False
+        async with self._lock:
+            if self.snapshot is None and not self._backing_off():
+                try:
+                    if not await self._adopt_file():
+                        await self.refresh()
+                except Exception as e:
+                    self._failed_at = time.monotonic()
+                    logger.error(f"Error al cargar el catálogo, se reintenta en {self.load_backoff:.0f}s: {e}")
+        return self.snapshot is not None
+
+    async def find_mentions(self, texts: List[str]) -> List[str]:
+        if not await self.ensure_loaded():
+            return []
+        return self.snapshot.matcher.find(texts)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _refresh_loop(self) -> None:
+        await self.ensure_loaded()
+        while True:
+            try:
+                await asyncio.wait_for(self._refresh_requested.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            force = self._refresh_requested.is_set() or self._pending_refresh
+            self._refresh_requested.clear()
+            self._pending_refresh = False
+            if not force and self._backing_off():
+                # Se adopta lo que otro worker publique, pero la consulta espera al fin de la pausa
+                try:
+                    await self._adopt_file()
+                except Exception as e:
+                    logger.warning(f"Error al adoptar el snapshot del catálogo: {e}")
+                continue
+            try:
+                await self.sync(force)
+            except Exception as e:
+                # Se conserva el snapshot anterior hasta el próximo intento
+                if self.snapshot is None:
+                    self._failed_at = time.monotonic()
+                logger.warning(f"Error al refrescar el catálogo: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **(self.snapshot.stats() if self.snapshot else {'version': None}),
+            'verificado_hace': round(time.time() - self.checked_at, 1) if self.checked_at else None,
+            'refrescos': self.refreshes,
+            'invalidadas': len(self._invalidated),
+            'adoptados': self.adopted,
+            'archivo': self.path
+        }
+
+_preloaded: Optional[CatalogSnapshot] = None
+
+def preloaded_snapshot() -> Optional[CatalogSnapshot]:
+    return _preloaded
+
+def preload_snapshot(
+    loader: Callable[[], Awaitable[Dict[str, List[Dict[str, Any]]]]],
+    path: Optional[str] = None,
+    max_age: float = 300.0
+) -> Optional[CatalogSnapshot]:
+    """Carga el snapshot en el proceso master antes del fork (gunicorn --preload)
+
+    Usa el archivo compartido si es reciente; si no, consulta la base de datos
+    con un loop temporal. Después congela el heap (gc.freeze) para que la
+    recolección de basura de los workers no escriba en las páginas heredadas.
+    Si algo falla, cada worker cargará el catálogo al arrancar.
+    """
+    global _preloaded
+    try:
+        asyncio.get_running_loop()
+        logger.info("Hay un loop en ejecución: el catálogo se cargará en el worker")
+        return None
+    except RuntimeError:
+        pass
+
+    data = read_snapshot(path) if path else None
+    snapshot = None
+    if data and time.time() - data[1] < max_age:
+        snapshot = CatalogSnapshot.from_payload(data[2], data[0], data[1])
+    else:
+        try:
+            tables = asyncio.run(loader())
+            payload = encode_tables(tables)
+            now = time.time()
+            version = max(int(now * 1000), data[0] + 1 if data else 0)
+            snapshot = CatalogSnapshot(tables, version, now, hashlib.sha256(payload).hexdigest())
+            if path:
+                write_snapshot(path, payload, version, now)
+        except Exception as e:
+            logger.warning(f"No se pudo precargar el catálogo: {e}")
+            if data:
+                # Un snapshot vencido sirve hasta que los workers lo refresquen
+                snapshot = CatalogSnapshot.from_payload(data[2], data[0], data[1])
+    if snapshot is not None:
+        logger.info(f"Catálogo precargado antes del fork (versión {snapshot.version}): {snapshot.stats()}")
+        _preloaded = snapshot
+        gc.freeze()
+    return snapshot
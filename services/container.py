@@ -0,0 +1,302 @@
+import time
+import httpx
+import asyncio
+import logging
+from services.cache import InvalidationLog, TTLCache, default_invalidation_path
+from services.history import ConversationVersions, RecentTurnsBuffer, default_versions_path
+from services.limiter import ConcurrencyLimiter
+from services.admission import AdmissionController
+from services.persistence import MessageWriter
+from services.metrics import Metrics, default_metrics_dir, http_pool_stats
+from services.profiling import LoopLagMonitor, SlowRequestRecorder
+from services.local_store import LocalStore, default_store_path
+from services.answer_cache import AnswerCache, SCHEMA as ANSWER_CACHE_SCHEMA
+from services.idempotency import MessageGuard, SCHEMA as IDEMPOTENCY_SCHEMA
+from services.jobs import MessageJobs, SCHEMA as JOBS_SCHEMA
+from services.summaries import ConversationSummarizer, SCHEMA as SUMMARY_SCHEMA
+from services.catalog import default_snapshot_path, preload_snapshot, preloaded_snapshot
+from services.supabase import SupabaseService, create_postgrest_client, fetch_catalog_tables
+from services.ai import AIService
+from services.context_store import ContextStore
+from services.providers import BREAKER_STATES
+from services.conversation import ConversationService
+from services.intents import IntentClassifier
+
+logger = logging.getLogger(__name__)
+
+def summary_history_limit(settings) -> int:
+    """Turnos que lee el resumidor (ConversationSummarizer.history_limit); 0 si está deshabilitado"""
+    return 2 * settings.SUMMARY_EVERY_TURNS + settings.SUMMARY_KEEP_TURNS if settings.SUMMARY_ENABLED else 0
+
+def catalog_snapshot_path(settings) -> str:
+    return settings.CATALOG_SNAPSHOT_PATH or default_snapshot_path(settings.SUPABASE_URL or '')
+
+def preload_catalog(settings) -> None:
+    """Carga el catálogo una vez en el proceso master; los workers lo heredan al hacer fork"""
+    if not settings.CATALOG_PRELOAD:
+        return
+
+    async def load():
+        client = create_postgrest_client(timeout=settings.SUPABASE_TIMEOUT)
+        try:
+            return await fetch_catalog_tables(client)
+        finally:
+            await client.aclose()
+
+    preload_snapshot(load, catalog_snapshot_path(settings), settings.CATALOG_REFRESH_INTERVAL)
+
+class ServiceContainer:
+    """Servicios de larga vida compartidos por todas las peticiones de un worker"""
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.metrics = Metrics(
+            directory=settings.METRICS_DIR or default_metrics_dir(),
+            flush_interval=settings.METRICS_FLUSH_INTERVAL
+        )
+        self.slow_requests = SlowRequestRecorder(
+            threshold=settings.SLOW_REQUEST_THRESHOLD,
+            capacity=settings.SLOW_REQUEST_CAPACITY,
+            metrics=self.metrics
+        )
+        self.loop_lag = LoopLagMonitor(
+            interval=settings.LOOP_LAG_INTERVAL,
+            stall_threshold=settings.LOOP_STALL_THRESHOLD,
+            metrics=self.metrics
+        )
+        self.http_limits = httpx.Limits(
+            max_connections=settings.HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY
+        )
+
+        self.cache = TTLCache(
+            maxsize=settings.CACHE_MAX_ENTRIES,
+            ttls={
+                'chatbots': settings.CACHE_TTL_CHATBOTS,
+                'programas_academicos': settings.CACHE_TTL_PROGRAMAS,
+                'planes_estudio': settings.CACHE_TTL_PLANES,
+                'conversaciones': settings.CACHE_TTL_CONVERSACIONES
+            },
+            negative_ttl=settings.CACHE_NEGATIVE_TTL,
+            invalidation_log=InvalidationLog(
+                settings.CACHE_INVALIDATION_FILE or default_invalidation_path(),
+                max_bytes=settings.CACHE_INVALIDATION_MAX_BYTES
+            )
+        )
+        self.history = RecentTurnsBuffer(
+            max_turns=max(settings.HISTORY_BUFFER_TURNS, settings.HISTORY_LIMIT, summary_history_limit(settings)),
+            max_conversations=settings.HISTORY_BUFFER_CONVERSATIONS,
+            versions=ConversationVersions(
+                settings.HISTORY_VERSIONS_FILE or default_versions_path()
+            )
+        )
+        self.message_writer = None
+        if settings.MESSAGE_WRITE_MODE != 'direct':
+            self.message_writer = MessageWriter(
+                batch_size=settings.MESSAGE_BATCH_SIZE,
+                flush_interval=settings.MESSAGE_FLUSH_INTERVAL,
+                max_queue=settings.MESSAGE_QUEUE_MAX,
+                max_retries=settings.MESSAGE_MAX_RETRIES
+            )
+        self.supabase = SupabaseService(
+            limits=self.http_limits,
+            timeout=settings.SUPABASE_TIMEOUT,
+            cache=self.cache,
+            catalog_refresh_interval=settings.CATALOG_REFRESH_INTERVAL,
+            history=self.history,
+            writer=self.message_writer,
+            ack_before_flush=settings.MESSAGE_WRITE_MODE == 'ack',
+            metrics=self.metrics,
+            catalog_path=catalog_snapshot_path(settings),
+            catalog_poll_interval=settings.CATALOG_SNAPSHOT_POLL_INTERVAL,
+            catalog_load_backoff=settings.CATALOG_LOAD_BACKOFF,
+            catalog_snapshot=preloaded_snapshot()
+        )
+        self.llm_limiter = ConcurrencyLimiter(
+            max_concurrency=settings.LLM_MAX_CONCURRENCY,
+            max_queue=settings.LLM_MAX_QUEUE,
+            queue_timeout=settings.LLM_QUEUE_TIMEOUT,
+            retry_after=settings.LLM_RETRY_AFTER
+        )
+        self.ai = AIService(
+            limits=self.http_limits,
+            timeout=settings.LLM_TIMEOUT,
+            limiter=self.llm_limiter,
+            metrics=self.metrics,
+            max_input_tokens=settings.PROMPT_MAX_INPUT_TOKENS,
+            max_tokens=settings.LLM_MAX_TOKENS,
+            backend=settings.LLM_BACKEND,
+            fallback_model=settings.LLM_FALLBACK_MODEL,
+            breaker_failures=settings.LLM_BREAKER_FAILURES,
+            breaker_reset=settings.LLM_BREAKER_RESET,
+            slow_call=settings.LLM_BREAKER_SLOW_CALL,
+            hedge=settings.LLM_HEDGE_ENABLED,
+            hedge_percentile=settings.LLM_HEDGE_PERCENTILE,
+            hedge_min_delay=settings.LLM_HEDGE_MIN_DELAY,
+            hedge_max_ratio=settings.LLM_HEDGE_MAX_RATIO
+        )
+        self.admission = None
+        if settings.ADMISSION_ENABLED:
+            self.admission = AdmissionController(
+                self.llm_limiter,
+                max_in_flight=settings.ADMISSION_MAX_IN_FLIGHT,
+                max_llm_queue=settings.ADMISSION_MAX_LLM_QUEUE,
+                chatbot_rate=settings.ADMISSION_CHATBOT_RATE,
+                chatbot_burst=max(settings.ADMISSION_CHATBOT_BURST, 1.0),
+                retry_after=settings.LLM_RETRY_AFTER,
+                metrics=self.metrics
+            )
+        self.answer_cache = None
+        chatbots = [c.strip() for c in (settings.ANSWER_CACHE_CHATBOTS or '').split(',') if c.strip()]
+        if chatbots:
+            self.answer_cache = AnswerCache(
+                LocalStore(settings.ANSWER_CACHE_PATH or default_store_path('answer-cache'), ANSWER_CACHE_SCHEMA),
+                chatbots=chatbots,
+                ttl=settings.ANSWER_CACHE_TTL,
+                max_entries=settings.ANSWER_CACHE_MAX_ENTRIES,
+                history_turns=settings.ANSWER_CACHE_HISTORY_TURNS
+            )
+        self.message_guard = None
+        if settings.IDEMPOTENCY_ENABLED:
+            self.message_guard = MessageGuard(
+                LocalStore(settings.IDEMPOTENCY_PATH or default_store_path('idempotency'), IDEMPOTENCY_SCHEMA),
+                window=settings.IDEMPOTENCY_WINDOW,
+                ttl=settings.IDEMPOTENCY_TTL,
+                # El turno debe durar más que el mensaje más lento que permite el presupuesto
+                lease=settings.REQUEST_BUDGET + 15.0,
+                wait_timeout=settings.CONVERSATION_WAIT_TIMEOUT,
+                metrics=self.metrics
+            )
+        self.summaries = None
+        if settings.SUMMARY_ENABLED:
+            self.summaries = ConversationSummarizer(
+                LocalStore(settings.SUMMARY_PATH or default_store_path('summaries'), SUMMARY_SCHEMA),
+                # Baja temperatura: el resumen debe conservar los datos, no reformularlos
+                self.ai.chat_client(settings.SUMMARY_MODEL, settings.SUMMARY_MAX_TOKENS, temperature=0.2),
+                limiter=self.llm_limiter,
+                every=settings.SUMMARY_EVERY_TURNS,
+                keep=settings.SUMMARY_KEEP_TURNS,
+                max_concurrency=settings.SUMMARY_MAX_CONCURRENCY,
+                timeout=settings.LLM_TIMEOUT,
+                metrics=self.metrics
+            )
+        self.jobs = None
+        if settings.JOBS_ENABLED:
+            self.jobs = MessageJobs(
+                LocalStore(settings.JOBS_PATH or default_store_path('jobs'), JOBS_SCHEMA),
+                workers=settings.JOBS_WORKERS,
+                max_queue=settings.JOBS_MAX_QUEUE,
+                # El trabajo espera el turno de la conversación y luego usa el presupuesto de un mensaje
+                timeout=settings.REQUEST_BUDGET + settings.CONVERSATION_WAIT_TIMEOUT,
+                max_attempts=settings.JOBS_MAX_ATTEMPTS,
+                ttl=settings.JOBS_TTL,
+                poll_interval=settings.JOBS_POLL_INTERVAL,
+                callback_url=settings.JOBS_CALLBACK_URL,
+                callback_secret=settings.JOBS_CALLBACK_SECRET,
+                callback_retries=settings.JOBS_CALLBACK_RETRIES,
+                callback_timeout=settings.JOBS_CALLBACK_TIMEOUT,
+                metrics=self.metrics
+            )
+        self.contexts = ContextStore(self.ai.tokens, max_entries=settings.CONTEXT_STORE_MAX_ENTRIES, metrics=self.metrics)
+        self.conversation = ConversationService(
+            supabase=self.supabase,
+            ai=self.ai,
+            history_limit=settings.HISTORY_LIMIT,
+            request_budget=settings.REQUEST_BUDGET,
+            llm_reserve=settings.REQUEST_BUDGET_LLM_RESERVE,
+            answer_cache=self.answer_cache,
+            metrics=self.metrics,
+            intents=IntentClassifier() if settings.INTENT_ROUTER_ENABLED else None,
+            contexts=self.contexts,
+            summaries=self.summaries
+        )
+        self._register_gauges()
+
+    def _register_gauges(self) -> None:
+        self.metrics.gauge('llm_in_flight', lambda: self.llm_limiter.in_flight)
+        self.metrics.gauge('llm_queued', lambda: self.llm_limiter.queued)
+        for provider in self.ai.providers.providers:
+            self.metrics.gauge(
+                'llm_breaker_state', lambda b=provider.breaker: BREAKER_STATES[b.state], provider=provider.name
+            )
+        if self.admission:
+            self.metrics.gauge('admission_in_flight', lambda: self.admission.in_flight)
+        if self.jobs:
+            self.metrics.gauge('jobs_queued', lambda: self.jobs.queued)
+            self.metrics.gauge('jobs_running', lambda: self.jobs.running)
+        if self.message_writer:
+            self.metrics.gauge('message_queue', lambda: self.message_writer.stats()['queued'])
+        for pool, client in (('supabase', self.supabase.client.session), ('llm', self.ai.async_http_client)):
+            self.metrics.gauge('http_pool_connections', lambda c=client: http_pool_stats(c)['connections'], pool=pool)
+            self.metrics.gauge('http_pool_waiting', lambda c=client: http_pool_stats(c)['waiting'], pool=pool)
+
+    def saturation(self) -> dict:
+        """Ocupación de los pools HTTP, del limitador del modelo y de la cola de mensajes"""
+        max_connections = self.settings.HTTP_MAX_CONNECTIONS
+        return {
+            'http': {
+                'supabase': http_pool_stats(self.supabase.client.session, max_connections),
+                'llm': http_pool_stats(self.ai.async_http_client, max_connections)
+            },
+            'llm': {**self.llm_limiter.stats(), **self.ai.providers.stats()},
+            'admision': self.admission.stats() if self.admission else None,
+            'trabajos': self.jobs.stats() if self.jobs else None,
+            'event_loop': self.loop_lag.stats(),
+            'mensajes': self.message_writer.stats() if self.message_writer else None
+        }
+
+    def start(self, job_handler=None) -> None:
+        """Arranca las tareas en segundo plano del worker; job_handler procesa los trabajos de mensajes"""
+        self.supabase.start()
+        self.metrics.start()
+        self.slow_requests.start()
+        self.loop_lag.start()
+        if self.jobs and job_handler:
+            self.jobs.start(job_handler)
+        # La codificación de tokens se carga en segundo plano; mientras tanto se estima
+        self._tokens_task = asyncio.create_task(self.ai.tokens.load())
+        if self.settings.CONTEXT_WARM:
+            self._warm_task = asyncio.create_task(self._warm_contexts())
+
+    async def _warm_contexts(self) -> None:
+        """Arma los contextos del sistema del catálogo una vez cargados el catálogo y la codificación"""
+        try:
+            # Con la codificación real los contextos no se vuelven a contar
+            await self._tokens_task
+            if not await self.supabase.catalog.ensure_loaded():
+                return
+            snapshot = self.supabase.catalog.snapshot
+            started = time.perf_counter()
+            built = await self.contexts.warm(snapshot.chatbots.values(), snapshot.programs.values())
+            logger.info(f"Contextos del sistema precalentados: {built} en {time.perf_counter() - started:.2f}s")
+        except Exception as e:
+            logger.warning(f"Error al precalentar los contextos del sistema: {e}")
+
+    async def aclose(self) -> None:
+        """Escribe los mensajes pendientes y cierra los pools HTTP del worker"""
+        if self.jobs:
+            # Antes de vaciar la cola de mensajes: los trabajos en curso todavía guardan respuestas
+            try:
+                await self.jobs.aclose()
+            except Exception as e:
+                logger.warning(f"Error al detener los trabajos de mensajes: {e}")
+        try:
+            await self.supabase.drain(self.settings.MESSAGE_DRAIN_TIMEOUT)
+        except Exception as e:
+            logger.error(f"Error al vaciar la cola de mensajes: {e}")
+        for name, service in (('supabase', self.supabase), ('ai', self.ai)):
+            try:
+                await service.aclose()
+            except Exception as e:
+                logger.warning(f"Error al cerrar el servicio {name}: {e}")
+        if self.answer_cache:
+            self.answer_cache.store.close()
+        if self.message_guard:
+            self.message_guard.store.close()
+        if self.summaries:
+            await self.summaries.aclose()
+        await self.slow_requests.stop()
+        await self.loop_lag.stop()
+        # El último volcado conserva los contadores del worker después de reciclarlo
+        await self.metrics.stop()
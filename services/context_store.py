@@ -0,0 +1,164 @@
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, NamedTuple, Optional, Tuple
+from services.metrics import Metrics
+from services.prompt import TokenCounter
+
+logger = logging.getLogger(__name__)
+
+class SystemContext(NamedTuple):
+    """Contexto del sistema ya armado para un chatbot y, opcionalmente, un programa"""
+    context: str
+    program_context: str
+    context_tokens: int
+    program_tokens: int
+    # sha256 del texto completo: igual contenido, igual hash en todos los workers y despliegues
+    digest: str
+    # Versiones de las filas de origen (chatbot, programa) con las que se armó
+    versions: Tuple[int, int]
+    # Si los tokens se contaron con la codificación real o se estimaron
+    exact: bool
+
+    @property
+    def text(self) -> str:
+        return self.context + self.program_context
+
+    @property
+    def tokens(self) -> int:
+        return self.context_tokens + self.program_tokens
+
+def build_program_context(programa: Optional[Dict[str, Any]]) -> str:
+    """Bloque del contexto con los datos de un programa académico"""
+    if not programa:
+        return ''
+    try:
+        return ''.join((
+            f"\nContexto del programa académico {programa['nombre']}:",
+            f"\n- Nivel: {programa['nivel']}",
+            f"\n- Modalidad: {programa['modalidad']}",
+            f"\n- Duración: {programa['duracion']}",
+            f"\n- Créditos: {programa['creditos']}",
+            f"\n- Descripción: {programa['descripcion']}",
+        ))
+    except KeyError as e:
+        logger.warning(f"Programa sin el campo {e}, se omite su contexto")
+        return ''
+
+class _RowVersion(NamedTuple):
+    row: Any
+    digest: str
+    version: int
+
+class ContextStore:
+    """Contextos del sistema precompilados por (chatbot_id, programa_id)
+
+    Cada entrada guarda el texto final, sus tokens y su hash. Es válida mientras
+    las filas de las que salió no cambien: cada fila tiene una versión que solo
+    sube si cambia el contenido que entra al contexto. Como las filas del
+    snapshot del catálogo son los mismos objetos entre peticiones, la versión
+    se recalcula solo cuando llega una fila nueva (otro snapshot o la caché),
+    y si su contenido es igual las entradas siguen sirviendo.
+    """
+
+    def __init__(self, counter: TokenCounter, max_entries: int = 4096, metrics: Optional[Metrics] = None):
+        self.counter = counter
+        self.max_entries = max_entries
+        self.metrics = metrics or Metrics()
+        self._entries: "OrderedDict[Tuple[str, Optional[str]], SystemContext]" = OrderedDict()
+        self._rows: Dict[Tuple[str, str], _RowVersion] = {}
+        self._version = 0
+        self.hits = 0
+        self.builds = 0
+        self.invalidations = 0
+
+    def get(self, chatbot: Dict[str, Any], programa: Optional[Dict[str, Any]] = None) -> SystemContext:
+        """Contexto del chatbot (y del programa) desde el almacén; lo arma si no existe o cambió"""
+        versions = (
+            self._row_version('chatbots', chatbot, lambda: chatbot.get('contexto') or ''),
+            self._row_version('programas_academicos', programa, lambda: build_program_context(programa)) if programa else 0
+        )
+        key = (str(chatbot.get('id')), str(programa['id']) if programa else None)
+        entry = self._entries.get(key)
+        if entry is not None and entry.versions == versions and (entry.exact or not self.counter.exact):
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.metrics.inc('context_store_total', result='hit')
+            return entry
+
+        result = 'build'
+        if entry is not None:
+            self.invalidations += 1
+            result = 'invalidated'
+        entry = self._build(chatbot, programa, versions)
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self.metrics.inc('context_store_total', result=result)
+        return entry
+
+    def _build(self, chatbot: Dict[str, Any], programa: Optional[Dict[str, Any]], versions: Tuple[int, int]) -> SystemContext:
+        self.builds += 1
+        context = chatbot.get('contexto') or ''
+        program_context = build_program_context(programa)
+        digest = hashlib.sha256()
+        digest.update(context.encode('utf-8'))
+        digest.update(b'\x00')
+        digest.update(program_context.encode('utf-8'))
+        return SystemContext(
+            context=context,
+            program_context=program_context,
+            context_tokens=self.counter.count_static(context),
+            program_tokens=self.counter.count_static(program_context),
+            digest=digest.hexdigest(),
+            versions=versions,
+            exact=self.counter.exact
+        )
+
+    def _row_version(self, table: str, row: Dict[str, Any], content) -> int:
+        key = (table, str(row.get('id')))
+        known = self._rows.get(key)
+        if known is not None and known.row is row:
+            return known.version
+        digest = hashlib.sha1(content().encode('utf-8')).hexdigest()
+        if known is not None and known.digest == digest:
+            # Otra copia de la misma fila (un snapshot nuevo): la versión no cambia
+            self._rows[key] = known._replace(row=row)
+            return known.version
+        self._version += 1
+        self._rows[key] = _RowVersion(row, digest, self._version)
+        return self._version
+
+    async def warm(
+        self,
+        chatbots: Iterable[Dict[str, Any]],
+        programs: Iterable[Dict[str, Any]],
+        batch: int = 200
+    ) -> int:
+        """Arma los contextos de los chatbots y programas activos, cediendo el loop entre lotes"""
+        chatbots = [c for c in chatbots if _active(c)]
+        programs = [p for p in programs if _active(p)]
+        built = 0
+        pairs = [(c, None) for c in chatbots] + [(c, p) for c in chatbots for p in programs]
+        for chatbot, programa in pairs[:self.max_entries]:
+            self.get(chatbot, programa)
+            built += 1
+            if built % batch == 0:
+                await asyncio.sleep(0)
+        if len(pairs) > self.max_entries:
+            logger.info(f"Precalentamiento del contexto limitado a {self.max_entries} de {len(pairs)} combinaciones")
+        return built
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'entradas': len(self._entries),
+            'aciertos': self.hits,
+            'construidos': self.builds,
+            'invalidados': self.invalidations
+        }
+
+def _active(row: Dict[str, Any]) -> bool:
+    # Las tablas no siempre tienen la columna: sin ella la fila se considera activa
+    return row.get('activo', True) is not False
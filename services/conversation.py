@@ -1,38 +1,87 @@
 from services.supabase import SupabaseService
-from services.ai import AIService
-from typing import Optional, List, Dict, Any
+from services.ai import AIService, FALLBACK_MESSAGES, cap_response
+from services.answer_cache import AnswerCache
+from services.context_store import ContextStore, SystemContext
+from services.summaries import ConversationSummarizer, Summary, turns_after
+from services.timing import RequestBudget
+from services.profiling import track_budget
+from services.limiter import LLMOverloadedError
+from services.metrics import Metrics
+from services.intents import IntentClassifier, IntentMatch, render_program_facts, render_program_list, render_program_question
+from typing import Optional, List, Dict, Any, AsyncIterator, NamedTuple
+from contextlib import aclosing
 import logging
 import asyncio
+import time
 from fastapi import HTTPException
 
-logging.basicConfig(level=logging.DEBUG)  # Cambiado a DEBUG para más detalle
 logger = logging.getLogger(__name__)
 
+# Estados de conversaciones.estado
+CHATBOT_ACTIVE = 'chatbot_activo'
+AGENT_ACTIVE = 'agente_activo'
+
+class ReplyPlan(NamedTuple):
+    """Resultado de preparar un mensaje: respuesta directa o contexto para el modelo"""
+    answer: Optional[str] = None
+    context: str = ''
+    program_context: str = ''
+    history: List[Dict[str, Any]] = []
+    cache_key: Optional[str] = None
+    system: Optional[SystemContext] = None
+    # Resumen de los turnos anteriores a history
+    summary: Optional[Summary] = None
+
 class ConversationService:
-    def __init__(self):
-        self.supabase = SupabaseService()
-        self.ai = AIService()
+    def __init__(
+        self,
+        supabase: Optional[SupabaseService] = None,
+        ai: Optional[AIService] = None,
+        history_limit: int = 10,
+        request_budget: float = 30.0,
+        llm_reserve: float = 15.0,
+        answer_cache: Optional[AnswerCache] = None,
+        metrics: Optional[Metrics] = None,
+        intents: Optional[IntentClassifier] = None,
+        contexts: Optional[ContextStore] = None,
+        summaries: Optional[ConversationSummarizer] = None
+    ):
+        self.supabase = supabase or SupabaseService()
+        self.ai = ai or AIService()
+        self.history_limit = history_limit
+        self.request_budget = request_budget
+        self.llm_reserve = llm_reserve
+        self.answer_cache = answer_cache
+        self.metrics = metrics or Metrics()
+        # Sin clasificador todos los mensajes van al modelo
+        self.intents = intents
+        self.contexts = contexts or ContextStore(self.ai.tokens, metrics=self.metrics)
+        # Sin resumidor el prompt lleva solo los últimos history_limit turnos
+        self.summaries = summaries
+
+    def new_budget(self) -> RequestBudget:
+        """Crea el presupuesto de latencia de una petición"""
+        budget = RequestBudget(self.request_budget, reserve=self.llm_reserve, metrics=self.metrics)
+        track_budget(budget)
+        return budget
     
-    async def handle_message(self, message_data: dict) -> str:
+    async def handle_message(self, message_data: dict, budget: Optional[RequestBudget] = None) -> str:
         """Maneja un mensaje entrante y genera una respuesta"""
+        budget = budget or self.new_budget()
         try:
-            # Validar datos de entrada
-            self._validate_message_data(message_data)
-            
-            # Obtener configuración del chatbot
-            chatbot_config = await self._get_chatbot_config(message_data['chatbot_id'])
-            
-            # Obtener historial y contexto
-            history = await self._get_conversation_history(message_data['conversation_id'])
-            programa_id = await self._get_program_context(history, message_data)
-            
-            # Manejar solicitud de plan de estudios si es necesario
-            if self.ai.detect_study_plan_request(message_data['content']):
-                return await self._handle_study_plan_request(programa_id)
+            plan = await self.prepare_reply(message_data, budget)
+            if plan.answer is not None:
+                return plan.answer
             
             # Generar respuesta normal
-            context = await self._build_context(chatbot_config, programa_id)
-            response = await self.ai.generate_response(context, history, message_data['content'])
+            with budget.measure('llm'):
+                response = await self.ai.generate_response(
+                    plan.context, plan.history, message_data['content'],
+                    timeout=budget.remaining(), program_context=plan.program_context, system=plan.system,
+                    summary=plan.summary.text if plan.summary else ''
+                )
+            await self.remember_answer(plan, message_data, response, budget.timings.get('llm', 0.0))
+            self.schedule_summary(plan, message_data)
             
             if not response:
                 raise HTTPException(
@@ -45,6 +94,8 @@ class ConversationService:
         except HTTPException as he:
             logger.error(f"Error HTTP en handle_message: {he.detail}")
             raise he
+        except LLMOverloadedError:
+            raise
         except Exception as e:
             logger.error(f"Error inesperado en handle_message: {str(e)}", exc_info=True)
             raise HTTPException(
@@ -52,6 +103,102 @@ class ConversationService:
                 detail=f"Error interno del servidor: {str(e)}"
             )
 
+    async def stream_reply(self, plan: "ReplyPlan", message_data: dict, budget: RequestBudget) -> AsyncIterator[str]:
+        """Entrega la respuesta por fragmentos a medida que el modelo la genera"""
+        if plan.answer is not None:
+            yield plan.answer
+            return
+        
+        started = time.monotonic()
+        parts = []
+        try:
+            async with aclosing(self.ai.stream_response(
+                plan.context, plan.history, message_data['content'], plan.program_context, system=plan.system,
+                summary=plan.summary.text if plan.summary else ''
+            )) as chunks:
+                async for chunk in chunks:
+                    if not parts:
+                        budget.record('primer_token', started)
+                    parts.append(chunk)
+                    yield chunk
+        finally:
+            budget.record('llm', started)
+        await self.remember_answer(plan, message_data, cap_response(''.join(parts)), budget.timings['llm'])
+        self.schedule_summary(plan, message_data)
+
+    async def chatbot_active(self, conversation_id: str, budget: RequestBudget) -> bool:
+        """Indica si el chatbot debe responder: no lo hace mientras un agente humano atiende la conversación"""
+        status = await budget.run(
+            'estado',
+            self.supabase.get_conversation_status(conversation_id),
+            optional=True,
+            default=None
+        )
+        return status != AGENT_ACTIVE
+
+    async def prepare_reply(self, message_data: dict, budget: RequestBudget) -> "ReplyPlan":
+        """Reúne lo necesario para responder: una respuesta directa o el contexto para el modelo"""
+        # Validar datos de entrada
+        self._validate_message_data(message_data)
+        programa_id = self._explicit_program_id(message_data)
+        
+        # Configuración, historial, resumen y programa explícito no dependen entre sí
+        chatbot_config, history, summary, programa_info = await asyncio.gather(
+            self._get_chatbot_config(message_data['chatbot_id'], budget),
+            self._get_conversation_history(message_data['conversation_id'], budget),
+            self._get_summary(message_data['conversation_id'], budget),
+            self._get_program_info(programa_id, budget)
+        )
+        history = self._previous_turns(history, message_data)
+        if not programa_id:
+            programa_id = await self._get_program_context(history, message_data, budget)
+        
+        # Preguntas sobre el catálogo se responden con plantillas, sin llamar al modelo
+        intent = self.intents.classify(message_data['content']) if self.intents else None
+        if intent:
+            answer = await self._answer_intent(intent, programa_id, programa_info, budget)
+            if answer is not None:
+                self._record_intent(intent)
+                return ReplyPlan(answer=answer)
+        self._record_intent(None)
+        
+        # La información del programa enriquece el contexto, pero se omite si no hay tiempo
+        if programa_id and programa_info is None:
+            programa_info = await self._get_program_info(programa_id, budget)
+        
+        # Contexto precompilado del chatbot y del programa, con sus tokens y su hash
+        system = self.contexts.get(chatbot_config, programa_info)
+        
+        # Preguntas repetidas con el mismo contexto se responden sin llamar al modelo
+        cache_key = None
+        if self.answer_cache and self.answer_cache.enabled_for(message_data['chatbot_id']):
+            cache_key = self.answer_cache.make_key(system.digest, message_data['content'], history)
+            with budget.measure('cache_respuestas'):
+                cached = await self.answer_cache.get(cache_key)
+            if cached is not None:
+                return ReplyPlan(answer=cached)
+        
+        return ReplyPlan(
+            context=system.context,
+            program_context=system.program_context,
+            # Con resumen, el prompt lleva solo los turnos que el resumen todavía no cubre
+            history=turns_after(history, summary.until) if summary else history,
+            cache_key=cache_key,
+            system=system,
+            summary=summary
+        )
+
+    async def remember_answer(self, plan: ReplyPlan, message_data: dict, response: str, llm_ms: float) -> None:
+        """Guarda una respuesta generada por el modelo para reutilizarla en preguntas iguales"""
+        if not plan.cache_key or not response or response in FALLBACK_MESSAGES:
+            return
+        await self.answer_cache.put(plan.cache_key, message_data['chatbot_id'], response, llm_ms)
+
+    def schedule_summary(self, plan: ReplyPlan, message_data: dict) -> None:
+        """Programa la actualización del resumen de la conversación fuera del camino de la respuesta"""
+        if self.summaries:
+            self.summaries.schedule(message_data['conversation_id'], plan.history, plan.summary)
+
     def _validate_message_data(self, message_data: dict) -> None:
         """Valida los datos del mensaje"""
         required_fields = ['chatbot_id', 'conversation_id', 'content']
@@ -63,13 +210,14 @@ class ConversationService:
                 detail=f"Faltan campos requeridos: {', '.join(missing_fields)}"
             )
 
-    async def _get_chatbot_config(self, chatbot_id: str) -> Dict[str, Any]:
+    def _explicit_program_id(self, message_data: dict) -> Optional[str]:
+        programa_id = message_data.get('programa_id')
+        return programa_id if programa_id and programa_id != 'string' else None
+
+    async def _get_chatbot_config(self, chatbot_id: str, budget: RequestBudget) -> Dict[str, Any]:
         """Obtiene la configuración del chatbot"""
         try:
-            config = await asyncio.wait_for(
-                self.supabase.get_chatbot_config(chatbot_id),
-                timeout=10.0
-            )
+            config = await budget.run('config', self.supabase.get_chatbot_config(chatbot_id))
             if not config:
                 raise HTTPException(
                     status_code=404,
@@ -82,57 +230,116 @@ class ConversationService:
                 detail="Tiempo de espera agotado al obtener configuración del chatbot"
             )
 
-    async def _get_conversation_history(self, conversation_id: str) -> List[str]:
-        """Obtiene el historial de la conversación"""
+    async def _get_conversation_history(self, conversation_id: str, budget: RequestBudget) -> List[Dict[str, Any]]:
+        """Obtiene los últimos turnos de la conversación"""
         try:
-            return await asyncio.wait_for(
-                self.supabase.get_conversation_history(conversation_id),
-                timeout=10.0
+            # Con resumen se leen también los turnos que todavía faltan por resumir
+            limit = max(self.history_limit, self.summaries.history_limit) if self.summaries else self.history_limit
+            return await budget.run(
+                'historial',
+                self.supabase.get_conversation_history(conversation_id, limit=limit),
+                optional=True,
+                default=[]
             )
         except Exception as e:
             logger.warning(f"Error al obtener historial: {e}")
             return []
 
-    async def _get_program_context(self, history: List[str], message_data: dict) -> Optional[str]:
-        """Obtiene el contexto del programa"""
+    async def _get_summary(self, conversation_id: str, budget: RequestBudget) -> Optional[Summary]:
+        """Resumen de la conversación, si lo hay y queda margen en el presupuesto"""
+        if not self.summaries:
+            return None
         try:
-            programa_id = message_data.get('programa_id')
-            if programa_id and programa_id != 'string':
-                return programa_id
-            
-            program_mentions = await asyncio.wait_for(
-                self.supabase.get_program_mentions(history),
-                timeout=10.0
+            return await budget.run('resumen', self.summaries.get(conversation_id), optional=True)
+        except Exception as e:
+            logger.warning(f"Error al obtener el resumen de la conversación: {e}")
+            return None
+
+    def _previous_turns(self, history: List[Dict[str, Any]], message_data: dict) -> List[Dict[str, Any]]:
+        """Quita del historial el mensaje actual, que ya se guardó antes de generar la respuesta"""
+        if history and history[-1].get('emisor_tipo') == 'lead' and history[-1].get('contenido') == message_data['content']:
+            return history[:-1]
+        return history
+
+    async def _get_program_context(
+        self,
+        history: List[Dict[str, Any]],
+        message_data: dict,
+        budget: RequestBudget
+    ) -> Optional[str]:
+        """Obtiene el programa mencionado más recientemente en la conversación"""
+        try:
+            # Las menciones vienen ordenadas por última aparición: la más reciente al final
+            program_mentions = await budget.run(
+                'menciones',
+                self.supabase.get_program_mentions(
+                    [turn['contenido'] for turn in history] + [message_data['content']]
+                ),
+                optional=True,
+                default=[]
             )
             return program_mentions[-1] if program_mentions else None
         except Exception as e:
             logger.warning(f"Error al obtener contexto del programa: {e}")
             return None
 
-    async def _handle_study_plan_request(self, programa_id: Optional[str]) -> str:
+    async def _get_program_info(self, programa_id: Optional[str], budget: RequestBudget) -> Optional[Dict[str, Any]]:
+        """Obtiene la información del programa si queda margen en el presupuesto"""
+        if not programa_id:
+            return None
+        try:
+            return await budget.run(
+                'programa',
+                self.supabase.get_program_info(programa_id),
+                optional=True
+            )
+        except Exception as e:
+            logger.warning(f"Error al obtener información del programa: {e}")
+            return None
+
+    def _record_intent(self, intent: Optional[IntentMatch]) -> None:
+        if not self.intents:
+            return
+        self.intents.record(intent)
+        for name in intent.intents if intent else ('modelo',):
+            self.metrics.inc('intent_messages_total', intent=name)
+
+    async def _answer_intent(
+        self,
+        intent: IntentMatch,
+        programa_id: Optional[str],
+        programa_info: Optional[Dict[str, Any]],
+        budget: RequestBudget
+    ) -> Optional[str]:
+        """Responde una intención con datos de la base de datos; None si debe responder el modelo"""
+        name = intent.intents[0]
+        if name == 'plan_estudios':
+            return await self._handle_study_plan_request(programa_id, budget)
+        
+        try:
+            if name == 'lista_programas' or not programa_id:
+                programs = await budget.run('programas', self.supabase.get_available_programs())
+                if name == 'lista_programas':
+                    return render_program_list(programs) if programs else None
+                return render_program_question(programs, "esa información")
+        except asyncio.TimeoutError:
+            return None
+        
+        if programa_info is None:
+            programa_info = await self._get_program_info(programa_id, budget)
+        return render_program_facts(programa_info, intent.attributes) if programa_info else None
+
+    async def _handle_study_plan_request(self, programa_id: Optional[str], budget: RequestBudget) -> str:
         """Maneja una solicitud de plan de estudios"""
         try:
             if not programa_id:
-                programs = await asyncio.wait_for(
-                    self.supabase.get_available_programs(),
-                    timeout=10.0
-                )
-                if not programs:
-                    return "¿Sobre qué programa académico te gustaría conocer el plan de estudios?"
-                
-                program_list = "\n".join([f"- {p['nombre']}" for p in programs[:5]])
-                return f"¿Sobre qué programa académico te gustaría conocer el plan de estudios? Algunos de nuestros programas son:\n{program_list}"
+                programs = await budget.run('programas', self.supabase.get_available_programs())
+                return render_program_question(programs, "el plan de estudios")
             
-            study_plan = await asyncio.wait_for(
-                self.supabase.get_study_plan(programa_id),
-                timeout=10.0
-            )
+            study_plan = await budget.run('plan_estudios', self.supabase.get_study_plan(programa_id))
             
             if not study_plan:
-                programa_info = await asyncio.wait_for(
-                    self.supabase.get_program_info(programa_id),
-                    timeout=10.0
-                )
+                programa_info = await self._get_program_info(programa_id, budget)
                 if programa_info:
                     return f"Lo siento, no encontré el plan de estudios de {programa_info['nombre']}. ¿Te gustaría conocer más información sobre el programa?"
                 return "Lo siento, no pude encontrar el plan de estudios para ese programa académico."
@@ -141,25 +348,3 @@ class ConversationService:
         except Exception as e:
             logger.error(f"Error al manejar solicitud de plan de estudios: {e}")
             return "Lo siento, hubo un error al buscar el plan de estudios. ¿Podrías intentarlo de nuevo?"
-
-    async def _build_context(self, chatbot_config: dict, programa_id: Optional[str]) -> str:
-        """Construye el contexto para la generación de respuestas"""
-        try:
-            context = chatbot_config.get('contexto', '')
-            if programa_id and programa_id != 'string':
-                programa_info = await asyncio.wait_for(
-                    self.supabase.get_program_info(programa_id),
-                    timeout=10.0
-                )
-                if programa_info:
-                    info = f"\nContexto del programa académico {programa_info['nombre']}:"
-                    info += f"\n- Nivel: {programa_info['nivel']}"
-                    info += f"\n- Modalidad: {programa_info['modalidad']}"
-                    info += f"\n- Duración: {programa_info['duracion']}"
-                    info += f"\n- Créditos: {programa_info['creditos']}"
-                    info += f"\n- Descripción: {programa_info['descripcion']}"
-                    context += info
-            return context
-        except Exception as e:
-            logger.warning(f"Error al construir contexto: {e}")
-            return chatbot_config.get('contexto', '')
\ No newline at end of file
@@ -0,0 +1,142 @@
+import os
+import mmap
+import time
+import struct
+import zlib
+import logging
+import tempfile
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_SLOT = struct.Struct('Q')
+
+def default_versions_path() -> str:
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(base, 'eamcrm-conversation-versions')
+
+class ConversationVersions:
+    """Tabla en memoria compartida que marca qué conversaciones cambiaron en otros workers
+
+    Cada escritura deja un sello único en la ranura de la conversación. Si el sello
+    no coincide con el último que vio este worker, su buffer local está desactualizado.
+    Las colisiones de hash solo provocan una consulta de más, nunca un dato perdido.
+    """
+
+    def __init__(self, path: str, slots: int = 65536):
+        self.slots = slots
+        size = slots * _SLOT.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self._pid = os.getpid() & 0xFFFF
+
+    def _offset(self, conversation_id: str) -> int:
+        return (zlib.crc32(conversation_id.encode('utf-8')) % self.slots) * _SLOT.size
+
+    def get(self, conversation_id: str) -> int:
+        return _SLOT.unpack_from(self._map, self._offset(conversation_id))[0]
+
+    def bump(self, conversation_id: str) -> int:
+        stamp = ((time.time_ns() & 0xFFFFFFFFFFFF) << 16) | self._pid
+        _SLOT.pack_into(self._map, self._offset(conversation_id), stamp)
+        return stamp
+
+    def close(self) -> None:
+        self._map.close()
+
+class _Entry:
+    __slots__ = ('turns', 'version')
+
+    def __init__(self, turns: Deque[Dict[str, Any]], version: int):
+        self.turns = turns
+        self.version = version
+
+class RecentTurnsBuffer:
+    """Últimos turnos de cada conversación atendida por el worker, con desalojo LRU"""
+
+    def __init__(
+        self,
+        max_turns: int = 20,
+        max_conversations: int = 5000,
+        versions: Optional[ConversationVersions] = None
+    ):
+        self.max_turns = max_turns
+        self.max_conversations = max_conversations
+        self.versions = versions
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def version(self, conversation_id: str) -> int:
+        return self.versions.get(conversation_id) if self.versions else 0
+
+    def get(self, conversation_id: str) -> Optional[List[Dict[str, Any]]]:
+        """Devuelve los turnos si el buffer sigue al día con lo escrito por todos los workers"""
+        entry = self._entries.get(conversation_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry.version != self.version(conversation_id):
+            self.stale += 1
+            return None
+        self._entries.move_to_end(conversation_id)
+        self.hits += 1
+        return list(entry.turns)
+
+    def peek(self, conversation_id: str) -> List[Dict[str, Any]]:
+        """Turnos conocidos aunque estén desactualizados, para traer solo lo nuevo"""
+        entry = self._entries.get(conversation_id)
+        return list(entry.turns) if entry else []
+
+    def seed(self, conversation_id: str, turns: List[Dict[str, Any]], version: Optional[int] = None) -> None:
+        """Reemplaza los turnos de una conversación con los leídos de la base de datos"""
+        if version is None:
+            version = self.version(conversation_id)
+        self._entries[conversation_id] = _Entry(deque(turns, maxlen=self.max_turns), version)
+        self._entries.move_to_end(conversation_id)
+        while len(self._entries) > self.max_conversations:
+            self._entries.popitem(last=False)
+
+    def append(self, conversation_id: str, turn: Dict[str, Any]) -> None:
+        """Registra un mensaje guardado por este worker y publica el cambio a los demás"""
+        entry = self._publish(conversation_id)
+        if entry is not None:
+            entry.turns.append(turn)
+
+    def touch(self, conversation_id: str) -> None:
+        """Publica de nuevo un mensaje ya registrado, cuando su escritura diferida llega a la base de datos
+
+        Un worker que consultó entre el registro y la escritura no vio la fila; el
+        nuevo sello lo obliga a volver a leer lo posterior a su último turno.
+        """
+        self._publish(conversation_id)
+
+    def _publish(self, conversation_id: str) -> Optional[_Entry]:
+        """Deja un sello nuevo y devuelve la entrada local solo si seguía al día"""
+        entry = self._entries.get(conversation_id)
+        in_sync = entry is not None and entry.version == self.version(conversation_id)
+        version = self.versions.bump(conversation_id) if self.versions else 0
+        if not in_sync:
+            # Otro worker escribió antes: el buffer queda desactualizado y la próxima
+            # lectura trae de la base de datos todo lo posterior a su último turno
+            return None
+        entry.version = version
+        return entry
+
+    def discard(self, conversation_id: str) -> None:
+        self._entries.pop(conversation_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'conversations': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale': self.stale
+        }
@@ -0,0 +1,308 @@
+import os
+import json
+import time
+import asyncio
+import uuid
+import hashlib
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, NamedTuple, Optional, Tuple
+from services.local_store import LocalStore
+from services.metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS resultados (
+    clave TEXT PRIMARY KEY,
+    conversacion_id TEXT NOT NULL,
+    cuerpo TEXT,
+    creado REAL NOT NULL,
+    expira REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS resultados_expira ON resultados (expira);
+CREATE TABLE IF NOT EXISTS turnos (
+    conversacion_id TEXT PRIMARY KEY,
+    dueno TEXT NOT NULL,
+    expira REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS generaciones (
+    clave TEXT PRIMARY KEY,
+    dueno TEXT NOT NULL,
+    expira REAL NOT NULL
+);
+'''
+
+class ConversationBusyError(Exception):
+    """Otro mensaje de la misma conversación sigue en proceso después de esperar su turno"""
+
+    def __init__(self, message: str, retry_after: int = 5):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class StoredResult(NamedTuple):
+    """Estado guardado de un mensaje: recibido (ya insertado) y, si terminó, el cuerpo de la respuesta"""
+    received: bool
+    body: Optional[Dict[str, Any]]
+
+class MessageGuard:
+    """Deduplica los reintentos de /message y ordena los mensajes de cada conversación
+
+    La clave de un mensaje es la que envía la pasarela (Idempotency-Key o
+    idempotency_key). Sin ella, si hay ventana (window > 0), es un hash de la
+    conversación, el emisor y el contenido válido durante esa ventana; si no, el
+    mensaje no se deduplica: un lead puede enviar dos veces el mismo texto.
+    Un duplicado que llega mientras
+    el original está en curso en el mismo worker espera ese mismo resultado; uno
+    que llega después (o a otro worker) recibe la respuesta guardada en el
+    LocalStore del host. Si el original falló después de guardar el mensaje
+    entrante, el reintento no lo vuelve a insertar.
+
+    Los mensajes de una conversación se procesan de a uno: un asyncio.Lock por
+    conversación dentro del worker (en orden de llegada) y un turno con
+    vencimiento en el LocalStore entre workers.
+
+    El stream genera fuera del turno, así que cada intento reserva además la
+    generación del mensaje (claim) y la renueva mientras corre: un duplicado que
+    la encuentra vigente no vuelve a llamar al modelo; si venció, el intento
+    original murió y el duplicado la toma y regenera.
+    """
+
+    def __init__(
+        self,
+        store: LocalStore,
+        window: float = 0.0,
+        ttl: float = 86400.0,
+        lease: float = 45.0,
+        wait_timeout: float = 35.0,
+        poll_interval: float = 0.05,
+        max_entries: int = 50000,
+        metrics: Optional[Metrics] = None
+    ):
+        self.store = store
+        self.window = window
+        self.ttl = ttl
+        self.lease = lease
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.max_entries = max_entries
+        self.metrics = metrics or Metrics()
+        self.owner = str(os.getpid())
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # conversación -> (lock, peticiones que lo usan o esperan)
+        self._locks: Dict[str, Tuple[asyncio.Lock, int]] = {}
+        self._writes = 0
+        self.counts = {'nuevo': 0, 'adjunto': 0, 'repetido': 0, 'reintento': 0, 'ocupado': 0, 'generando': 0}
+
+    def key_for(self, message: Dict[str, Any], explicit: Optional[str] = None) -> Tuple[str, float]:
+        """Clave del mensaje y cuánto tiempo se recuerda su resultado"""
+        digest = hashlib.sha256()
+        digest.update(str(message.get('conversation_id')).encode('utf-8'))
+        digest.update(b'\x00')
+        if explicit:
+            digest.update(b'k\x00' + explicit.encode('utf-8'))
+            return digest.hexdigest(), self.ttl
+        if self.window <= 0:
+            # Clave propia del envío: sigue el orden de la conversación, pero nunca coincide con otro
+            return f"envio-{uuid.uuid4().hex}", self.lease
+        for field in ('emisor_tipo', 'emisor_id', 'lead_id'):
+            digest.update(str(message.get(field)).encode('utf-8'))
+            digest.update(b'\x00')
+        digest.update((message.get('content') or '').strip().encode('utf-8'))
+        return digest.hexdigest(), self.window
+
+    async def run(
+        self,
+        key: str,
+        ttl: float,
+        conversation_id: str,
+        compute: Callable[[bool], Awaitable[Dict[str, Any]]]
+    ) -> Tuple[Dict[str, Any], bool]:
+        """Devuelve (cuerpo, repetido): el resultado guardado, el de la ejecución en curso o compute(recibido)"""
+        flight = self._inflight.get(key)
+        if flight is not None:
+            self._count('adjunto')
+            return await asyncio.shield(flight), True
+
+        future = asyncio.get_running_loop().create_future()
+        # Si nadie espera el resultado, su excepción no debe quedar sin consultar
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._inflight[key] = future
+        try:
+            async with self.ordered(conversation_id):
+                stored = await self.lookup(key)
+                if stored and stored.body is not None:
+                    self._count('repetido')
+                    body, replayed = stored.body, True
+                else:
+                    self._count('reintento' if stored else 'nuevo')
+                    body, replayed = await compute(bool(stored)), False
+                    await self.remember(key, conversation_id, ttl, body)
+            future.set_result(body)
+            return body, replayed
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    @asynccontextmanager
+    async def ordered(self, conversation_id: str) -> AsyncIterator[None]:
+        """Ejecuta el bloque cuando ningún otro mensaje de la conversación está en proceso"""
+        lock, users = self._locks.get(conversation_id) or (asyncio.Lock(), 0)
+        self._locks[conversation_id] = (lock, users + 1)
+        try:
+            try:
+                await asyncio.wait_for(lock.acquire(), self.wait_timeout)
+            except asyncio.TimeoutError:
+                self._count('ocupado')
+                raise ConversationBusyError(f"Conversación {conversation_id} ocupada en este worker")
+            try:
+                await self._acquire_lease(conversation_id)
+                try:
+                    yield
+                finally:
+                    await self._release_lease(conversation_id)
+            finally:
+                lock.release()
+        finally:
+            lock, users = self._locks[conversation_id]
+            if users <= 1:
+                del self._locks[conversation_id]
+            else:
+                self._locks[conversation_id] = (lock, users - 1)
+
+    async def lookup(self, key: str) -> Optional[StoredResult]:
+        try:
+            row = await self.store.run(_select, key, time.time())
+        except Exception as e:
+            logger.warning(f"Error al leer el resultado idempotente: {e}")
+            return None
+        if row is None:
+            return None
+        return StoredResult(received=True, body=json.loads(row['cuerpo']) if row['cuerpo'] else None)
+
+    async def mark_received(self, key: str, conversation_id: str, ttl: float) -> None:
+        """Registra que el mensaje entrante ya está guardado, aunque la respuesta aún no exista"""
+        await self.remember(key, conversation_id, ttl, None)
+
+    async def remember(self, key: str, conversation_id: str, ttl: float, body: Optional[Dict[str, Any]]) -> None:
+        now = time.time()
+        self._writes += 1
+        prune = self._writes % 200 == 1
+        payload = json.dumps(body, ensure_ascii=False) if body is not None else None
+        try:
+            await self.store.run(_upsert, key, conversation_id, payload, now, now + ttl, prune, self.max_entries)
+        except Exception as e:
+            # Sin el resultado guardado un reintento se procesaría de nuevo, pero el mensaje ya se atendió
+            logger.warning(f"Error al guardar el resultado idempotente: {e}")
+
+    async def claim(self, key: str) -> Optional[str]:
+        """Reserva la generación del mensaje; devuelve el dueño del intento o None si otro sigue vigente"""
+        attempt = f"{self.owner}-{uuid.uuid4().hex}"
+        now = time.time()
+        try:
+            if await self.store.run(_claim, key, attempt, now, now + self.lease):
+                return attempt
+        except Exception as e:
+            # Sin la reserva se sigue como antes: el duplicado podría regenerar
+            logger.warning(f"Error al reservar la generación del mensaje: {e}")
+            return attempt
+        self._count('generando')
+        return None
+
+    async def renew(self, key: str, attempt: str) -> None:
+        try:
+            await self.store.run(_renew, key, attempt, time.time() + self.lease)
+        except Exception as e:
+            logger.warning(f"Error al renovar la generación del mensaje: {e}")
+
+    async def release(self, key: str, attempt: str) -> None:
+        try:
+            await asyncio.shield(self.store.run(_unclaim, key, attempt))
+        except Exception as e:
+            logger.warning(f"Error al liberar la generación del mensaje: {e}")
+
+    async def _acquire_lease(self, conversation_id: str) -> None:
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            now = time.time()
+            try:
+                if await self.store.run(_acquire, conversation_id, self.owner, now, now + self.lease):
+                    return
+            except Exception as e:
+                # El orden entre workers es una mejora: si el store falla se sigue sin turno
+                logger.warning(f"Error al tomar el turno de la conversación {conversation_id}: {e}")
+                return
+            if time.monotonic() >= deadline:
+                self._count('ocupado')
+                raise ConversationBusyError(f"Conversación {conversation_id} ocupada en otro worker")
+            await asyncio.sleep(self.poll_interval)
+
+    async def _release_lease(self, conversation_id: str) -> None:
+        try:
+            await asyncio.shield(self.store.run(_release, conversation_id, self.owner))
+        except Exception as e:
+            logger.warning(f"Error al liberar el turno de la conversación {conversation_id}: {e}")
+
+    def _count(self, result: str) -> None:
+        self.counts[result] += 1
+        self.metrics.inc('idempotent_messages_total', result=result)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.counts,
+            'en_curso': len(self._inflight),
+            'conversaciones_en_proceso': len(self._locks)
+        }
+
+def _select(conn, key: str, now: float):
+    return conn.execute(
+        'SELECT cuerpo FROM resultados WHERE clave = ? AND expira > ?',
+        (key, now)
+    ).fetchone()
+
+def _upsert(conn, key, conversation_id, body, now, expires, prune, max_entries) -> None:
+    conn.execute(
+        'INSERT OR REPLACE INTO resultados (clave, conversacion_id, cuerpo, creado, expira) VALUES (?, ?, ?, ?, ?)',
+        (key, conversation_id, body, now, expires)
+    )
+    if prune:
+        conn.execute('DELETE FROM resultados WHERE expira <= ?', (now,))
+        conn.execute(
+            'DELETE FROM resultados WHERE clave IN ('
+            'SELECT clave FROM resultados ORDER BY creado DESC LIMIT -1 OFFSET ?)',
+            (max_entries,)
+        )
+        conn.execute('DELETE FROM turnos WHERE expira <= ?', (now,))
+        conn.execute('DELETE FROM generaciones WHERE expira <= ?', (now,))
+
+def _acquire(conn, conversation_id: str, owner: str, now: float, expires: float) -> bool:
+    # El turno se toma si está libre, vencido o ya es de este worker (uno que no se alcanzó a liberar)
+    return conn.execute(
+        'INSERT INTO turnos (conversacion_id, dueno, expira) VALUES (?, ?, ?) '
+        'ON CONFLICT (conversacion_id) DO UPDATE SET dueno = excluded.dueno, expira = excluded.expira '
+        'WHERE turnos.expira <= ? OR turnos.dueno = ?',
+        (conversation_id, owner, expires, now, owner)
+    ).rowcount > 0
+
+def _release(conn, conversation_id: str, owner: str) -> None:
+    conn.execute('DELETE FROM turnos WHERE conversacion_id = ? AND dueno = ?', (conversation_id, owner))
+
+def _claim(conn, key: str, attempt: str, now: float, expires: float) -> bool:
+    # Se toma si no hay otro intento o el anterior dejó vencer su reserva sin renovarla
+    return conn.execute(
+        'INSERT INTO generaciones (clave, dueno, expira) VALUES (?, ?, ?) '
+        'ON CONFLICT (clave) DO UPDATE SET dueno = excluded.dueno, expira = excluded.expira '
+        'WHERE generaciones.expira <= ?',
+        (key, attempt, expires, now)
+    ).rowcount > 0
+
+def _renew(conn, key: str, attempt: str, expires: float) -> None:
+    conn.execute('UPDATE generaciones SET expira = ? WHERE clave = ? AND dueno = ?', (expires, key, attempt))
+
+def _unclaim(conn, key: str, attempt: str) -> None:
+    conn.execute('DELETE FROM generaciones WHERE clave = ? AND dueno = ?', (key, attempt))
@@ -0,0 +1,170 @@
+import re
+import logging
+from collections import Counter
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+from services.text import normalize_question
+
+logger = logging.getLogger(__name__)
+
+class Intent(NamedTuple):
+    """Intención que se puede responder solo con datos de la base de datos"""
+    name: str
+    # (expresión sobre el texto normalizado, peso): la confianza es la suma de los pesos
+    patterns: Tuple[Tuple[str, float], ...]
+    threshold: float
+    # Las intenciones sobre atributos de un programa se pueden responder juntas
+    attribute: Optional[str] = None
+    negative: Tuple[str, ...] = ()
+
+INTENTS: Tuple[Intent, ...] = (
+    Intent('plan_estudios', (
+        (r'\bplan(es)? de estudios?\b', 1.0),
+        (r'\bpensum\b', 1.0),
+        (r'\bmalla (curricular|academica)\b', 1.0),
+        (r'\b(materias|asignaturas)\b', 0.4),
+        (r'\b(que|cuales) (materias|asignaturas|cursos)\b', 0.3),
+        (r'\b(pdf|documento)\b', 0.2),
+    ), threshold=0.6),
+    Intent('lista_programas', (
+        (r'\b(que|cuales) (programas|carreras)\b', 0.8),
+        (r'\b(programas|carreras) (tienen|ofrecen|hay|disponibles)\b', 0.8),
+        (r'\boferta (academica|educativa)\b', 0.9),
+        (r'\b(lista|listado) de (programas|carreras)\b', 1.0),
+        (r'\b(programas|carreras)\b', 0.2),
+    ), threshold=0.6),
+    Intent('modalidad', (
+        (r'\bmodalidad\b', 0.8),
+        (r'\b(virtual|presencial|a distancia|en linea|online|hibrid[ao]|semipresencial)\b', 0.5),
+        (r'\bes (virtual|presencial|a distancia|en linea|online|hibrid[ao])\b', 0.4),
+        (r'\bclases\b.*\b(virtuales|presenciales)\b', 0.8),
+    ), threshold=0.6, attribute='modalidad'),
+    Intent('duracion', (
+        (r'\bcuanto (tiempo )?dura\b', 1.0),
+        (r'\bduracion\b', 0.9),
+        (r'\bcuantos (semestres|anos|meses|periodos)\b', 0.9),
+        (r'\bcuanto tiempo\b', 0.4),
+    ), threshold=0.6, attribute='duracion'),
+    Intent('creditos', (
+        (r'\bcreditos?\b', 0.8),
+        (r'\bcuantos creditos\b', 0.3),
+    ), threshold=0.6, attribute='creditos', negative=(r'\bcredito (educativo|bancario)\b',)),
+    Intent('nivel', (
+        (r'\b(es|son) (un |una )?(pregrado|posgrado|tecnologia|tecnico|especializacion|maestria|doctorado)\b', 0.8),
+        (r'\bnivel (academico|de formacion)\b', 0.8),
+        (r'\b(profesional|tecnologo)\b', 0.3),
+    ), threshold=0.7, attribute='nivel'),
+)
+
+# Temas que la base de datos no responde: si aparecen, el modelo contesta todo el mensaje
+UNANSWERABLE = (
+    r'\b(costo|costos|cuesta|precio|valor|vale|pagar|pago|beca|becas|descuento|descuentos|icetex)\b',
+    r'\b(financ\w*|inscri\w*|matricul\w*|horario\w*|requisito\w*|sede\w*|fecha\w*)\b',
+    r'\bcuando (inicia|inician|empieza|empiezan|comienza|comienzan)\b',
+)
+UNANSWERABLE_PENALTY = 0.6
+# Los mensajes largos suelen traer matices que una plantilla no cubre
+LONG_MESSAGE_WORDS = 30
+LONG_MESSAGE_PENALTY = 0.3
+
+ATTRIBUTE_TEMPLATES = {
+    'modalidad': "{nombre} se ofrece en modalidad {modalidad}.",
+    'duracion': "{nombre} tiene una duración de {duracion}.",
+    'creditos': "{nombre} tiene {creditos} créditos.",
+    'nivel': "{nombre} es un programa de nivel {nivel}.",
+}
+
+class IntentMatch(NamedTuple):
+    """Intenciones reconocidas en un mensaje con la menor de sus confianzas"""
+    intents: Tuple[str, ...]
+    confidence: float
+
+    @property
+    def attributes(self) -> List[str]:
+        return [intent.attribute for intent in INTENTS if intent.name in self.intents and intent.attribute]
+
+class IntentClassifier:
+    """Clasificador por reglas compiladas sobre el texto sin tildes ni puntuación"""
+
+    def __init__(self, intents: Sequence[Intent] = INTENTS):
+        self.intents = tuple(intents)
+        self._compiled = [
+            (intent, [(re.compile(p), w) for p, w in intent.patterns], [re.compile(p) for p in intent.negative])
+            for intent in self.intents
+        ]
+        self._unanswerable = [re.compile(p) for p in UNANSWERABLE]
+        self.counts: Counter = Counter()
+        self.answered = 0
+
+    def scores(self, message: str) -> Dict[str, float]:
+        text = normalize_question(message)
+        penalty = 0.0
+        if any(p.search(text) for p in self._unanswerable):
+            penalty += UNANSWERABLE_PENALTY
+        if len(text.split()) > LONG_MESSAGE_WORDS:
+            penalty += LONG_MESSAGE_PENALTY
+
+        scores = {}
+        for intent, patterns, negative in self._compiled:
+            score = sum(weight for pattern, weight in patterns if pattern.search(text))
+            if not score or any(p.search(text) for p in negative):
+                continue
+            scores[intent.name] = round(min(1.0, score) - penalty, 3)
+        return scores
+
+    def classify(self, message: str) -> Optional[IntentMatch]:
+        """Devuelve las intenciones que superan su umbral, o None si el mensaje debe ir al modelo"""
+        scores = self.scores(message)
+        winners = [intent for intent in self.intents if scores.get(intent.name, 0.0) >= intent.threshold]
+        if not winners:
+            return None
+
+        exclusive = [intent for intent in winners if not intent.attribute]
+        if exclusive and len(winners) > 1:
+            # Dos preguntas de distinto tipo en un mismo mensaje: mejor que responda el modelo
+            logger.debug(f"Intenciones ambiguas, se usa el modelo: {scores}")
+            self.counts['ambiguo'] += 1
+            return None
+        return IntentMatch(
+            intents=tuple(intent.name for intent in winners),
+            confidence=min(scores[intent.name] for intent in winners)
+        )
+
+    def record(self, match: Optional[IntentMatch]) -> None:
+        """Cuenta un mensaje respondido con plantilla (por intención) o enviado al modelo"""
+        if match is None:
+            self.counts['modelo'] += 1
+            return
+        self.answered += 1
+        for intent in match.intents:
+            self.counts[intent] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.answered + self.counts['modelo']
+        return {
+            **dict(self.counts),
+            'respondidos': self.answered,
+            'sin_modelo_ratio': round(self.answered / total, 4) if total else 0.0
+        }
+
+def render_program_facts(programa: Dict[str, Any], attributes: List[str]) -> Optional[str]:
+    """Responde los atributos pedidos de un programa; None si falta alguno en la base de datos"""
+    sentences = []
+    for attribute in attributes:
+        if programa.get(attribute) in (None, ''):
+            return None
+        sentences.append(ATTRIBUTE_TEMPLATES[attribute].format(**programa))
+    sentences.append("¿Te gustaría conocer algo más del programa?")
+    return ' '.join(sentences)
+
+def render_program_list(programs: Sequence[Dict[str, Any]], limit: int = 10) -> str:
+    names = "\n".join(f"- {p['nombre']}" for p in programs[:limit])
+    more = f"\ny {len(programs) - limit} programas más." if len(programs) > limit else ''
+    return f"Estos son algunos de nuestros programas:\n{names}{more}\n¿Sobre cuál te gustaría saber más?"
+
+def render_program_question(programs: Sequence[Dict[str, Any]], topic: str) -> str:
+    """Pide al lead que indique el programa cuando la pregunta no lo menciona"""
+    question = f"¿Sobre qué programa académico te gustaría conocer {topic}?"
+    if not programs:
+        return question
+    names = "\n".join(f"- {p['nombre']}" for p in programs[:5])
+    return f"{question} Algunos de nuestros programas son:\n{names}"
@@ -0,0 +1,406 @@
+import os
+import hmac
+import json
+import time
+import uuid
+import asyncio
+import hashlib
+import logging
+import httpx
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+from services.local_store import LocalStore
+from services.metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS trabajos (
+    id TEXT PRIMARY KEY,
+    conversacion_id TEXT NOT NULL,
+    estado TEXT NOT NULL,
+    solicitud TEXT NOT NULL,
+    cuerpo TEXT,
+    error TEXT,
+    intentos INTEGER NOT NULL DEFAULT 0,
+    dueno TEXT,
+    disponible REAL NOT NULL,
+    vence REAL,
+    entrega TEXT,
+    entrega_intentos INTEGER NOT NULL DEFAULT 0,
+    entrega_siguiente REAL,
+    creado REAL NOT NULL,
+    actualizado REAL NOT NULL,
+    expira REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS trabajos_estado ON trabajos (estado, disponible);
+CREATE INDEX IF NOT EXISTS trabajos_entrega ON trabajos (entrega, entrega_siguiente);
+CREATE INDEX IF NOT EXISTS trabajos_expira ON trabajos (expira);
+'''
+
+PENDING = 'pendiente'
+RUNNING = 'en_curso'
+DONE = 'completado'
+FAILED = 'fallido'
+
+# Estados de la entrega al callback
+DELIVERY_PENDING = 'pendiente'
+DELIVERED = 'entregado'
+DELIVERY_FAILED = 'fallido'
+
+class JobRetryError(Exception):
+    """El trabajo no se pudo procesar ahora (modelo saturado, conversación ocupada): se reintenta"""
+
+    def __init__(self, message: str, retry_after: float = 5.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def _iso(moment: Optional[float]) -> Optional[str]:
+    return datetime.fromtimestamp(moment, tz=timezone.utc).isoformat() if moment else None
+
+class MessageJobs:
+    """Mensajes procesados en segundo plano: POST /message/jobs responde 202 y la respuesta llega después
+
+    Cada trabajo se guarda en el LocalStore del host antes de responder, así que
+    sobrevive al reciclaje del worker (--max-requests). El worker que lo recibe lo
+    encola en su pool acotado de `workers` tareas; cualquier worker del host toma
+    además, cada `poll_interval` segundos, los trabajos pendientes que nadie
+    procesa: los de un worker que se apagó antes de empezarlos, los que vencieron
+    en curso porque el worker murió y los que esperan un reintento.
+
+    Si hay `callback_url`, el resultado se envía por POST con reintentos y espera
+    exponencial; el estado de la entrega también queda en el store.
+    """
+
+    def __init__(
+        self,
+        store: LocalStore,
+        workers: int = 8,
+        max_queue: int = 500,
+        timeout: float = 60.0,
+        max_attempts: int = 3,
+        ttl: float = 86400.0,
+        poll_interval: float = 2.0,
+        callback_url: Optional[str] = None,
+        callback_secret: Optional[str] = None,
+        callback_retries: int = 6,
+        callback_timeout: float = 10.0,
+        metrics: Optional[Metrics] = None
+    ):
+        self.store = store
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        # Un trabajo en curso que supera este plazo es de un worker que murió
+        self.lease = timeout + 15.0
+        self.max_attempts = max_attempts
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.callback_url = callback_url
+        self.callback_secret = callback_secret
+        self.callback_retries = callback_retries
+        self.callback_timeout = callback_timeout
+        self.metrics = metrics or Metrics()
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.handler: Optional[Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]] = None
+        self._queue: "asyncio.Queue[str]" = asyncio.Queue()
+        self._queued: Set[str] = set()
+        self._delivering: Set[str] = set()
+        self._tasks: List[asyncio.Task] = []
+        self._deliveries: Set[asyncio.Task] = set()
+        self._client: Optional[httpx.AsyncClient] = None
+        self.running = 0
+        self._closing = False
+        self.counts = {'creado': 0, 'completado': 0, 'fallido': 0, 'reintento': 0, 'recuperado': 0}
+
+    @property
+    def queued(self) -> int:
+        return self._queue.qsize()
+
+    def has_capacity(self) -> bool:
+        return not self._closing and self._queue.qsize() < self.max_queue
+
+    def start(self, handler: Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]) -> None:
+        """Arranca el pool de tareas; handler(solicitud) devuelve el cuerpo de la respuesta"""
+        self.handler = handler
+        if self.callback_url:
+            self._client = httpx.AsyncClient(timeout=self.callback_timeout)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._sweep_loop()))
+
+    async def submit(self, conversation_id: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Guarda el trabajo y lo encola en este worker; devuelve su estado inicial"""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        # Los demás workers solo lo toman si este no lo empezó tras un par de barridos
+        available = now + 2 * self.poll_interval
+        delivery = DELIVERY_PENDING if self.callback_url else None
+        await self.store.run(
+            _insert, job_id, conversation_id, json.dumps(payload, ensure_ascii=False),
+            available, delivery, now, now + self.ttl
+        )
+        self._count('creado')
+        self._enqueue(job_id)
+        return {'job_id': job_id, 'conversation_id': conversation_id, 'status': PENDING, 'created_at': _iso(now)}
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = await self.store.run(_select, job_id, time.time())
+        if row is None:
+            return None
+        return {
+            'job_id': row['id'],
+            'conversation_id': row['conversacion_id'],
+            'status': row['estado'],
+            'attempts': row['intentos'],
+            'result': json.loads(row['cuerpo']) if row['cuerpo'] else None,
+            'error': row['error'],
+            'callback': row['entrega'],
+            'created_at': _iso(row['creado']),
+            'updated_at': _iso(row['actualizado'])
+        }
+
+    def _enqueue(self, job_id: str) -> None:
+        if job_id not in self._queued:
+            self._queued.add(job_id)
+            self._queue.put_nowait(job_id)
+
+    async def _worker(self) -> None:
+        while True:
+            job_id = await self._queue.get()
+            self._queued.discard(job_id)
+            if self._closing:
+                continue
+            try:
+                await self._run(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error al procesar el trabajo {job_id}: {e}", exc_info=True)
+
+    async def _run(self, job_id: str) -> None:
+        now = time.time()
+        row = await self.store.run(_claim, job_id, self.owner, now, now + self.lease, self.max_attempts)
+        if row is None:
+            # Otro worker lo tomó o ya terminó
+            return
+        attempt = row['intentos']
+        self.running += 1
+        started = time.perf_counter()
+        try:
+            body = await asyncio.wait_for(self.handler(json.loads(row['solicitud'])), self.timeout)
+        except asyncio.CancelledError:
+            # Apagado del worker: el trabajo vuelve a quedar pendiente para otro
+            await asyncio.shield(self.store.run(_release, job_id, self.owner, time.time()))
+            raise
+        except JobRetryError as e:
+            if attempt < self.max_attempts:
+                logger.warning(f"Trabajo {job_id} aplazado {e.retry_after}s (intento {attempt}): {e}")
+                await self.store.run(_retry, job_id, self.owner, time.time() + e.retry_after, str(e))
+                self._count('reintento')
+                return
+            await self._finish(job_id, FAILED, None, str(e))
+        except asyncio.TimeoutError:
+            await self._finish(job_id, FAILED, None, f"Tiempo agotado tras {self.timeout:.0f}s")
+        except Exception as e:
+            logger.error(f"Trabajo {job_id} fallido: {e}")
+            await self._finish(job_id, FAILED, None, str(e) or type(e).__name__)
+        else:
+            await self._finish(job_id, DONE, body, None)
+            logger.info("Trabajo %s completado en %.2fs", job_id, time.perf_counter() - started)
+        finally:
+            self.running -= 1
+
+    async def _finish(self, job_id: str, status: str, body: Optional[Dict[str, Any]], error: Optional[str]) -> None:
+        payload = json.dumps(body, ensure_ascii=False) if body is not None else None
+        await self.store.run(_finish, job_id, self.owner, status, payload, error, time.time())
+        self._count(status)
+        if self.callback_url:
+            self._spawn_delivery(job_id)
+
+    def _spawn_delivery(self, job_id: str) -> None:
+        if job_id in self._delivering:
+            return
+        self._delivering.add(job_id)
+        task = asyncio.create_task(self._deliver(job_id))
+        self._deliveries.add(task)
+        task.add_done_callback(self._deliveries.discard)
+
+    async def _deliver(self, job_id: str) -> None:
+        try:
+            now = time.time()
+            # Reserva la entrega para que dos workers no la envíen a la vez
+            row = await self.store.run(_claim_delivery, job_id, now, now + self.callback_timeout + 5.0)
+            if row is None:
+                return
+            job = await self.get(job_id)
+            data = json.dumps(job, ensure_ascii=False).encode('utf-8')
+            headers = {'Content-Type': 'application/json', 'X-Job-Id': job_id}
+            if self.callback_secret:
+                signature = hmac.new(self.callback_secret.encode('utf-8'), data, hashlib.sha256).hexdigest()
+                headers['X-Signature-256'] = f'sha256={signature}'
+            attempts = row['entrega_intentos'] + 1
+            try:
+                response = await self._client.post(self.callback_url, content=data, headers=headers)
+                status = response.status_code
+                error = None if status < 300 else f"HTTP {status}"
+            except httpx.HTTPError as e:
+                status, error = None, str(e) or type(e).__name__
+            if error is None:
+                result = DELIVERED
+            elif status is not None and 400 <= status < 500 and status not in (408, 429):
+                # El receptor rechazó el cuerpo: reintentar no lo cambia
+                result = DELIVERY_FAILED
+            elif attempts > self.callback_retries:
+                result = DELIVERY_FAILED
+            else:
+                result = DELIVERY_PENDING
+            following = time.time() + min(2.0 ** attempts, 300.0)
+            await self.store.run(_delivered, job_id, result, attempts, following)
+            if error:
+                logger.warning(f"Error al entregar el trabajo {job_id} al callback (intento {attempts}): {error}")
+            self.metrics.inc('job_callbacks_total', result=result if result != DELIVERY_PENDING else 'reintento')
+        except Exception as e:
+            logger.warning(f"Error al entregar el trabajo {job_id}: {e}")
+        finally:
+            self._delivering.discard(job_id)
+
+    async def _sweep_loop(self) -> None:
+        sweeps = 0
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            sweeps += 1
+            try:
+                await self._sweep(prune=sweeps % 100 == 1)
+            except Exception as e:
+                logger.warning(f"Error al revisar los trabajos pendientes: {e}")
+
+    async def _sweep(self, prune: bool = False) -> None:
+        """Toma los trabajos pendientes sin dueño y reintenta las entregas vencidas"""
+        if self._closing:
+            return
+        now = time.time()
+        # Solo los que este worker puede empezar ya: el resto queda para los demás
+        free = self.workers - self.running - self._queue.qsize()
+        if free > 0:
+            for job_id in await self.store.run(_claimable, now, self.max_attempts, free):
+                if job_id not in self._queued:
+                    self._count('recuperado')
+                    self._enqueue(job_id)
+        if self.callback_url:
+            for job_id in await self.store.run(_due_deliveries, now, 50):
+                self._spawn_delivery(job_id)
+        if prune:
+            await self.store.run(_prune, now, self.max_attempts)
+
+    def _count(self, result: str) -> None:
+        self.counts[result] += 1
+        self.metrics.inc('jobs_total', result=result)
+
+    async def aclose(self, timeout: float = 10.0) -> None:
+        """Deja de tomar trabajos, espera un momento los que están en curso y cierra el store"""
+        # Los trabajos en cola siguen pendientes en el store: otro worker los toma
+        self._closing = True
+        deadline = time.monotonic() + timeout
+        while self.running and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._deliveries:
+            await asyncio.wait(list(self._deliveries), timeout=self.callback_timeout)
+        if self._client:
+            await self._client.aclose()
+        self.store.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.counts,
+            'en_cola': self._queue.qsize(),
+            'en_curso': self.running,
+            'entregas_en_curso': len(self._delivering)
+        }
+
+def _insert(conn, job_id, conversation_id, payload, available, delivery, now, expires) -> None:
+    conn.execute(
+        'INSERT INTO trabajos (id, conversacion_id, estado, solicitud, disponible, entrega, entrega_siguiente, '
+        'creado, actualizado, expira) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        (job_id, conversation_id, PENDING, payload, available, delivery, now, now, now, expires)
+    )
+
+def _select(conn, job_id: str, now: float):
+    return conn.execute('SELECT * FROM trabajos WHERE id = ? AND expira > ?', (job_id, now)).fetchone()
+
+def _claim(conn, job_id: str, owner: str, now: float, lease_until: float, max_attempts: int):
+    # Pendiente, o en curso con el plazo vencido (el worker murió) y con intentos disponibles
+    claimed = conn.execute(
+        'UPDATE trabajos SET estado = ?, dueno = ?, vence = ?, intentos = intentos + 1, actualizado = ? '
+        'WHERE id = ? AND intentos < ? AND (estado = ? OR (estado = ? AND vence <= ?))',
+        (RUNNING, owner, lease_until, now, job_id, max_attempts, PENDING, RUNNING, now)
+    ).rowcount
+    if not claimed:
+        return None
+    return conn.execute('SELECT solicitud, intentos FROM trabajos WHERE id = ?', (job_id,)).fetchone()
+
+def _release(conn, job_id: str, owner: str, now: float) -> None:
+    # El intento interrumpido por el apagado no cuenta
+    conn.execute(
+        'UPDATE trabajos SET estado = ?, dueno = NULL, vence = NULL, intentos = intentos - 1, disponible = ?, '
+        'actualizado = ? WHERE id = ? AND dueno = ? AND estado = ?',
+        (PENDING, now, now, job_id, owner, RUNNING)
+    )
+
+def _retry(conn, job_id: str, owner: str, available: float, error: str) -> None:
+    conn.execute(
+        'UPDATE trabajos SET estado = ?, dueno = NULL, vence = NULL, disponible = ?, error = ?, actualizado = ? '
+        'WHERE id = ? AND dueno = ?',
+        (PENDING, available, error, time.time(), job_id, owner)
+    )
+
+def _finish(conn, job_id: str, owner: str, status: str, body: Optional[str], error: Optional[str], now: float) -> None:
+    conn.execute(
+        'UPDATE trabajos SET estado = ?, cuerpo = ?, error = ?, vence = NULL, actualizado = ?, entrega_siguiente = ? '
+        'WHERE id = ? AND dueno = ?',
+        (status, body, error, now, now, job_id, owner)
+    )
+
+def _claimable(conn, now: float, max_attempts: int, limit: int) -> List[str]:
+    rows = conn.execute(
+        'SELECT id FROM trabajos WHERE intentos < ? AND '
+        '((estado = ? AND disponible <= ?) OR (estado = ? AND vence <= ?)) ORDER BY creado LIMIT ?',
+        (max_attempts, PENDING, now, RUNNING, now, limit)
+    ).fetchall()
+    return [row['id'] for row in rows]
+
+def _due_deliveries(conn, now: float, limit: int) -> List[str]:
+    rows = conn.execute(
+        'SELECT id FROM trabajos WHERE entrega = ? AND estado IN (?, ?) AND entrega_siguiente <= ? '
+        'ORDER BY entrega_siguiente LIMIT ?',
+        (DELIVERY_PENDING, DONE, FAILED, now, limit)
+    ).fetchall()
+    return [row['id'] for row in rows]
+
+def _claim_delivery(conn, job_id: str, now: float, until: float):
+    claimed = conn.execute(
+        'UPDATE trabajos SET entrega_siguiente = ? WHERE id = ? AND entrega = ? AND estado IN (?, ?) '
+        'AND entrega_siguiente <= ?',
+        (until, job_id, DELIVERY_PENDING, DONE, FAILED, now)
+    ).rowcount
+    if not claimed:
+        return None
+    return conn.execute('SELECT entrega_intentos FROM trabajos WHERE id = ?', (job_id,)).fetchone()
+
+def _delivered(conn, job_id: str, result: str, attempts: int, following: float) -> None:
+    conn.execute(
+        'UPDATE trabajos SET entrega = ?, entrega_intentos = ?, entrega_siguiente = ? WHERE id = ?',
+        (result, attempts, following, job_id)
+    )
+
+def _prune(conn, now: float, max_attempts: int) -> None:
+    conn.execute('DELETE FROM trabajos WHERE expira <= ?', (now,))
+    # En curso sin intentos disponibles y con el plazo vencido: el worker murió en el último intento
+    conn.execute(
+        'UPDATE trabajos SET estado = ?, error = ?, actualizado = ?, entrega_siguiente = ? '
+        'WHERE estado = ? AND vence <= ? AND intentos >= ?',
+        (FAILED, 'Worker detenido durante el último intento', now, now, RUNNING, now, max_attempts)
+    )
@@ -0,0 +1,74 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict
+
+logger = logging.getLogger(__name__)
+
+class LLMOverloadedError(Exception):
+    """No hay capacidad para otra llamada al modelo en este momento"""
+
+    def __init__(self, message: str, retry_after: int = 5):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class ConcurrencyLimiter:
+    """Limita las llamadas simultáneas al modelo con una cola de espera acotada"""
+
+    def __init__(self, max_concurrency: int = 16, max_queue: int = 64, queue_timeout: float = 2.0, retry_after: int = 5):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.in_flight = 0
+        self.queued = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def check(self) -> None:
+        """Falla de inmediato si una nueva llamada no podría ni siquiera esperar turno"""
+        if self._semaphore.locked() and self.queued >= self.max_queue:
+            self.rejected += 1
+            raise LLMOverloadedError("Cola de llamadas al modelo llena", self.retry_after)
+
+    def has_capacity(self) -> bool:
+        """Hay un cupo libre ahora mismo, sin esperar en la cola"""
+        return not self._semaphore.locked() and self.queued == 0
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Reserva un cupo para una llamada al modelo durante el bloque"""
+        self.check()
+        self.queued += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            raise LLMOverloadedError("Tiempo de espera agotado por un cupo del modelo", self.retry_after)
+        finally:
+            self.queued -= 1
+
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+            self._semaphore.release()
+
+    def saturation(self) -> float:
+        return round(self.in_flight / self.max_concurrency, 4) if self.max_concurrency else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'in_flight': self.in_flight,
+            'queued': self.queued,
+            'max_concurrency': self.max_concurrency,
+            'max_queue': self.max_queue,
+            'saturation': self.saturation(),
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'timed_out': self.timed_out
+        }
@@ -0,0 +1,164 @@
+import json
+import logging
+from typing import Any, AsyncIterator, Dict, List, NamedTuple, Optional
+import httpx
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ('http', 'langchain')
+
+class ChatCompletion(NamedTuple):
+    """Respuesta (o fragmento de un stream) del modelo, igual para todos los backends"""
+    text: str
+    finish_reason: Optional[str] = None
+    # prompt_tokens / completion_tokens; en un stream solo lo trae el último fragmento
+    usage: Optional[Dict[str, int]] = None
+
+class LLMResponseError(Exception):
+    """El proveedor respondió algo que no es una respuesta de chat válida"""
+
+class HTTPChatClient:
+    """Cliente mínimo de /chat/completions de una API compatible con OpenAI
+
+    Envía los mensajes tal como los arma PromptBuilder ({'role', 'content'}) por
+    el pool httpx del worker, sin SDK ni objetos intermedios. Sin reintentos
+    propios: los decide AIService y el respaldo lo decide ProviderRouter.
+    """
+
+    def __init__(
+        self,
+        http_client: httpx.AsyncClient,
+        model: str,
+        api_key: Optional[str],
+        api_base: str,
+        timeout: float = 20.0,
+        max_tokens: int = 512,
+        temperature: float = 0.7
+    ):
+        self.http_client = http_client
+        self.model = model
+        self.url = api_base.rstrip('/') + '/chat/completions'
+        self.headers = {'Authorization': f'Bearer {api_key}'} if api_key else {}
+        self.timeout = timeout
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+
+    def _payload(self, messages: List[Dict[str, str]], stream: bool) -> Dict[str, Any]:
+        payload = {
+            'model': self.model,
+            'messages': messages,
+            'temperature': self.temperature,
+            'max_tokens': self.max_tokens,
+            'stream': stream
+        }
+        if stream:
+            payload['stream_options'] = {'include_usage': True}
+        return payload
+
+    async def generate(self, messages: List[Dict[str, str]]) -> ChatCompletion:
+        response = await self.http_client.post(
+            self.url, json=self._payload(messages, False), headers=self.headers, timeout=self.timeout
+        )
+        response.raise_for_status()
+        try:
+            data = response.json()
+            choice = data['choices'][0]
+            text = choice['message'].get('content') or ''
+        except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+            raise LLMResponseError(f"Respuesta inesperada del modelo: {e}") from e
+        return ChatCompletion(text, choice.get('finish_reason'), data.get('usage'))
+
+    async def stream(self, messages: List[Dict[str, str]]) -> AsyncIterator[ChatCompletion]:
+        async with self.http_client.stream(
+            'POST', self.url, json=self._payload(messages, True), headers=self.headers, timeout=self.timeout
+        ) as response:
+            response.raise_for_status()
+            # Eventos SSE: una línea "data: {...}" por fragmento y "data: [DONE]" al final
+            async for line in response.aiter_lines():
+                if not line.startswith('data:'):
+                    continue
+                data = line[5:].strip()
+                if data == '[DONE]':
+                    return
+                try:
+                    event = json.loads(data)
+                except ValueError as e:
+                    raise LLMResponseError(f"Fragmento inválido del stream: {e}") from e
+                choices = event.get('choices') or []
+                delta = (choices[0].get('delta') or {}) if choices else {}
+                text = delta.get('content') or ''
+                finish_reason = choices[0].get('finish_reason') if choices else None
+                usage = event.get('usage')
+                if text or finish_reason or usage:
+                    yield ChatCompletion(text, finish_reason, usage)
+
+    async def aclose(self) -> None:
+        await self.http_client.aclose()
+
+class LangChainChatClient:
+    """Mismo contrato que HTTPChatClient sobre ChatOpenAI de LangChain
+
+    LangChain y el SDK de OpenAI se importan aquí, solo si se elige este backend:
+    cargarlos suma segundos al arranque de cada worker.
+    """
+
+    def __init__(
+        self,
+        http_client: httpx.AsyncClient,
+        model: str,
+        api_key: Optional[str],
+        api_base: str,
+        timeout: float = 20.0,
+        max_tokens: int = 512,
+        temperature: float = 0.7
+    ):
+        import openai
+        from langchain_openai import ChatOpenAI
+        from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+        self._message_types = {'system': SystemMessage, 'user': HumanMessage, 'assistant': AIMessage}
+        self.http_client = http_client
+        client_params = {
+            'api_key': api_key,
+            'base_url': api_base,
+            'timeout': timeout,
+            'max_retries': 1
+        }
+        self.model = ChatOpenAI(
+            model_name=model,
+            openai_api_key=api_key,
+            openai_api_base=api_base,
+            temperature=temperature,
+            # El largo de la respuesta lo limita el modelo, no un recorte posterior
+            max_tokens=max_tokens,
+            request_timeout=timeout,
+            max_retries=1,
+            async_client=openai.AsyncOpenAI(http_client=http_client, **client_params).chat.completions
+        )
+
+    def _messages(self, messages: List[Dict[str, str]]) -> list:
+        return [self._message_types[m['role']](content=m['content']) for m in messages]
+
+    async def generate(self, messages: List[Dict[str, str]]) -> ChatCompletion:
+        result = await self.model.agenerate([self._messages(messages)])
+        generation = result.generations[0][0] if result.generations else None
+        if generation is None:
+            return ChatCompletion('')
+        usage = (result.llm_output or {}).get('token_usage')
+        return ChatCompletion(generation.text, (generation.generation_info or {}).get('finish_reason'), usage)
+
+    async def stream(self, messages: List[Dict[str, str]]) -> AsyncIterator[ChatCompletion]:
+        async for chunk in self.model.astream(self._messages(messages)):
+            if chunk.content:
+                yield ChatCompletion(chunk.content)
+
+    async def aclose(self) -> None:
+        await self.http_client.aclose()
+
+def create_chat_client(backend: str, **params: Any):
+    """Crea el cliente del backend configurado (LLM_BACKEND): 'http' o 'langchain'"""
+    if backend == 'http':
+        return HTTPChatClient(**params)
+    if backend == 'langchain':
+        return LangChainChatClient(**params)
+    raise ValueError(f"LLM_BACKEND desconocido: {backend} (opciones: {', '.join(BACKENDS)})")
@@ -0,0 +1,55 @@
+import os
+import asyncio
+import sqlite3
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+def default_store_path(name: str) -> str:
+    return os.path.join(tempfile.gettempdir(), f'eamcrm-{name}.sqlite3')
+
+class LocalStore:
+    """Archivo SQLite local compartido por los workers del host
+
+    Todas las operaciones corren en un hilo propio del store para no bloquear el
+    loop ni ocupar el pool de hilos por defecto. WAL permite lecturas concurrentes
+    desde varios procesos mientras uno escribe.
+    """
+
+    def __init__(self, path: str, schema: str):
+        self.path = path
+        self.schema = schema
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"sqlite-{os.path.basename(path)}")
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(self.schema)
+            self._conn = conn
+        return self._conn
+
+    def _call(self, fn: Callable[..., Any], *args: Any) -> Any:
+        return fn(self._connect(), *args)
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """Ejecuta fn(conexión, *args) en el hilo del store"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, fn, *args)
+
+    def close(self) -> None:
+        def _close() -> None:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        self._executor.submit(_close).result()
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,236 @@
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import atexit
+import random
+import logging
+import traceback
+import contextvars
+import logging.handlers
+from typing import Any, Dict, NamedTuple, Optional
+
+# Atributos propios de LogRecord: todo lo demás llegó por extra= y se emite como campo
+_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'request_id', 'route'}
+
+class RequestContext(NamedTuple):
+    request_id: str
+    route: str
+    # Si los eventos debug/info de esta petición se emiten; las advertencias y errores siempre
+    sampled: bool
+
+_context: contextvars.ContextVar[Optional[RequestContext]] = contextvars.ContextVar('log_context', default=None)
+
+def current_request_id() -> Optional[str]:
+    context = _context.get()
+    return context.request_id if context else None
+
+def log_enabled(logger: logging.Logger, level: int) -> bool:
+    """Como isEnabledFor, pero también descarta debug/info de las peticiones no muestreadas
+
+    Sirve para no armar mensajes costosos que el muestreo va a descartar.
+    """
+    if not logger.isEnabledFor(level):
+        return False
+    context = _context.get()
+    return level >= logging.WARNING or context is None or context.sampled
+
+def parse_mapping(value: Optional[str]) -> Dict[str, str]:
+    """'a=1,b=2' -> {'a': '1', 'b': '2'}"""
+    pairs = (item.split('=', 1) for item in (value or '').split(',') if '=' in item)
+    return {key.strip(): val.strip() for key, val in pairs if key.strip()}
+
+class SampleRates:
+    """Proporción de peticiones por ruta cuyos eventos debug/info se registran
+
+    Las claves son rutas exactas o prefijos terminados en '*'; '*' sola es el
+    valor por defecto. La decisión se toma una vez por petición para que una
+    petición muestreada conserve su traza completa.
+    """
+
+    def __init__(self, rates: Dict[str, float]):
+        self.default = rates.get('*', 1.0)
+        self.exact = {route: rate for route, rate in rates.items() if not route.endswith('*')}
+        # Los prefijos más largos primero
+        self.prefixes = sorted(
+            ((route[:-1], rate) for route, rate in rates.items() if route.endswith('*') and route != '*'),
+            key=lambda item: len(item[0]),
+            reverse=True
+        )
+
+    def rate(self, route: str) -> float:
+        if route in self.exact:
+            return self.exact[route]
+        for prefix, rate in self.prefixes:
+            if route.startswith(prefix):
+                return rate
+        return self.default
+
+    def sample(self, route: str) -> bool:
+        rate = self.rate(route)
+        return rate >= 1.0 or (rate > 0.0 and random.random() < rate)
+
+class RequestLogMiddleware:
+    """Asigna un id a cada petición (o respeta X-Request-ID) y decide si se muestrean sus logs
+
+    Middleware ASGI puro: el contexto queda en un ContextVar que heredan las
+    tareas creadas durante la petición, y el id vuelve en la respuesta.
+    """
+
+    def __init__(self, app, rates: Optional[SampleRates] = None):
+        self.app = app
+        self.rates = rates or SampleRates({})
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope.get('headers') or ():
+            if name == b'x-request-id':
+                # Un id externo se acota para no inflar cada línea de log
+                request_id = value.decode('latin-1')[:64]
+                break
+        request_id = request_id or uuid.uuid4().hex
+        route = scope.get('path', '')
+        token = _context.set(RequestContext(request_id, route, self.rates.sample(route)))
+
+        async def send_with_id(message):
+            if message['type'] == 'http.response.start':
+                message.setdefault('headers', [])
+                message['headers'] = list(message['headers']) + [(b'x-request-id', request_id.encode('latin-1'))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            _context.reset(token)
+
+class _ContextFilter(logging.Filter):
+    """Corre en el hilo que registra: toma el contexto de la petición y aplica el muestreo"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        context = _context.get()
+        if context is None:
+            record.request_id = None
+            record.route = None
+            return True
+        record.request_id = context.request_id
+        record.route = context.route
+        return record.levelno >= logging.WARNING or context.sampled
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Encola el registro sin formatearlo: el mensaje se arma en el hilo del listener"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+class JsonFormatter(logging.Formatter):
+    """Una línea JSON por evento con el id de la petición y los campos pasados en extra="""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'pid': record.process,
+        }
+        if getattr(record, 'request_id', None):
+            entry['request_id'] = record.request_id
+            entry['route'] = record.route
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_FIELDS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = ''.join(traceback.format_exception(*record.exc_info)).rstrip()
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class _TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        request_id = getattr(record, 'request_id', None)
+        return f"{line} [{request_id}]" if request_id else line
+
+class LogPipeline:
+    """Logging raíz a través de una cola: el loop solo encola, un hilo formatea y escribe
+
+    Los hilos no sobreviven al fork de gunicorn: cada proceso hijo crea su
+    propia cola y su propio listener (os.register_at_fork).
+    """
+
+    def __init__(self, handler: logging.Handler):
+        self.handler = handler
+        self.queue_handler = _DeferredQueueHandler(queue.SimpleQueue())
+        self.queue_handler.addFilter(_ContextFilter())
+        self.listener: Optional[logging.handlers.QueueListener] = None
+
+    def start(self) -> None:
+        self.listener = logging.handlers.QueueListener(self.queue_handler.queue, self.handler, respect_handler_level=True)
+        self.listener.start()
+
+    def restart_after_fork(self) -> None:
+        # La cola heredada puede contener registros del padre o un lock tomado
+        self.queue_handler.queue = queue.SimpleQueue()
+        self.start()
+
+    def stop(self) -> None:
+        """Escribe lo que quede en la cola y detiene el hilo"""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+_pipeline: Optional[LogPipeline] = None
+
+def parse_level(value: Optional[str]) -> Optional[int]:
+    """'info' o '20' -> 20; None si no es un nivel de logging"""
+    value = (value or '').strip().upper()
+    if value.isdigit():
+        return int(value)
+    level = logging.getLevelName(value)
+    return level if isinstance(level, int) else None
+
+def configure_logging(settings) -> LogPipeline:
+    """Configura el logging del proceso a partir de las variables de entorno (una sola vez)"""
+    global _pipeline
+    if _pipeline is not None:
+        return _pipeline
+
+    handler = logging.StreamHandler(sys.stderr)
+    if settings.LOG_FORMAT == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(_TextFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+    pipeline = LogPipeline(handler)
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(pipeline.queue_handler)
+    # Un nivel inválido no debe impedir que arranque el worker: se usa INFO y se avisa
+    invalid = []
+    level = parse_level(settings.LOG_LEVEL)
+    if level is None:
+        invalid.append(f"LOG_LEVEL={settings.LOG_LEVEL}")
+        level = logging.INFO
+    root.setLevel(level)
+    for name, value in parse_mapping(settings.LOG_LEVELS).items():
+        level = parse_level(value)
+        if level is None:
+            invalid.append(f"LOG_LEVELS {name}={value}")
+            continue
+        logging.getLogger(name).setLevel(level)
+
+    pipeline.start()
+    os.register_at_fork(after_in_child=pipeline.restart_after_fork)
+    atexit.register(pipeline.stop)
+    _pipeline = pipeline
+    for entry in invalid:
+        logging.getLogger(__name__).warning(f"Nivel de log inválido, se ignora: {entry}")
+    return pipeline
+
+def request_log_rates(settings) -> SampleRates:
+    return SampleRates({route: float(rate) for route, rate in parse_mapping(settings.LOG_SAMPLE_RATES).items()})
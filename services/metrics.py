@@ -0,0 +1,353 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import fcntl
+import functools
+import tempfile
+from bisect import bisect_left
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'eamcrm_'
+
+# Contadores e histogramas acumulados de los workers que ya terminaron
+RETIRED_FILE = 'retired.json'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+# Nombre -> (tipo, descripción). Solo se exportan las métricas declaradas aquí
+METRICS = {
+    'http_request_seconds': ('histogram', 'Duración de las peticiones HTTP por ruta y estado'),
+    'stage_seconds': ('histogram', 'Duración de cada etapa de un mensaje'),
+    'stage_skipped_total': ('counter', 'Etapas opcionales omitidas por falta de presupuesto'),
+    'supabase_seconds': ('histogram', 'Duración de los métodos de SupabaseService'),
+    'supabase_query_seconds': ('histogram', 'Duración de cada consulta a PostgREST'),
+    'llm_seconds': ('histogram', 'Duración de cada llamada al modelo'),
+    'event_loop_lag_seconds': ('histogram', 'Retraso del event loop de cada worker medido cada LOOP_LAG_INTERVAL'),
+    'llm_queue_wait_seconds': ('histogram', 'Espera por un cupo del limitador del modelo'),
+    'llm_tokens_total': ('counter', 'Tokens del prompt y de la respuesta del modelo'),
+    'llm_retries_total': ('counter', 'Reintentos de generate_response'),
+    'llm_fallbacks_total': ('counter', 'Llamadas desviadas al proveedor de respaldo por circuito abierto o error'),
+    'llm_hedges_total': ('counter', 'Llamadas duplicadas por latencia y cuál respondió primero'),
+    'llm_breaker_transitions_total': ('counter', 'Cambios de estado del circuito de cada proveedor del modelo'),
+    'idempotent_messages_total': ('counter', 'Mensajes nuevos, duplicados adjuntos o repetidos y conversaciones ocupadas'),
+    'summary_updates_total': ('counter', 'Actualizaciones de resúmenes de conversación por resultado'),
+    'context_store_total': ('counter', 'Contextos del sistema servidos desde el almacén, armados o invalidados'),
+    'intent_messages_total': ('counter', 'Mensajes respondidos por intención sin el modelo, o enviados al modelo'),
+    'admission_total': ('counter', 'Mensajes admitidos o rechazados por el control de admisión, por motivo'),
+    'jobs_total': ('counter', 'Trabajos de mensajes creados, completados, fallidos, aplazados o recuperados de otro worker'),
+    'job_callbacks_total': ('counter', 'Entregas de trabajos al callback por resultado'),
+    'slow_requests_total': ('counter', 'Peticiones más lentas que SLOW_REQUEST_THRESHOLD por ruta'),
+    'event_loop_stalls_total': ('counter', 'Bloqueos del event loop más largos que LOOP_STALL_THRESHOLD'),
+    'admission_in_flight': ('gauge', 'Mensajes admitidos en curso por worker'),
+    'llm_in_flight': ('gauge', 'Llamadas al modelo en curso por worker'),
+    'llm_queued': ('gauge', 'Llamadas al modelo esperando cupo por worker'),
+    'llm_breaker_state': ('gauge', 'Estado del circuito de cada proveedor (0 cerrado, 1 semiabierto, 2 abierto)'),
+    'jobs_queued': ('gauge', 'Trabajos de mensajes en la cola de cada worker'),
+    'jobs_running': ('gauge', 'Trabajos de mensajes en curso por worker'),
+    'message_queue': ('gauge', 'Mensajes pendientes de escribir por worker'),
+    'http_pool_connections': ('gauge', 'Conexiones abiertas de cada pool HTTP por worker'),
+    'http_pool_waiting': ('gauge', 'Peticiones esperando una conexión de cada pool HTTP por worker'),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+def default_metrics_dir() -> str:
+    # Los workers de gunicorn comparten el pid del master: cada despliegue usa un directorio propio
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(base, f'eamcrm-metrics-{os.getppid()}')
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+class Metrics:
+    """Contadores e histogramas del worker, agregados entre workers a través de archivos
+
+    Cada worker vuelca periódicamente su estado a un archivo JSON propio en un
+    directorio compartido; /metrics suma los archivos de todos los workers. Los
+    contadores e histogramas de un worker reciclado se suman a retired.json y su
+    archivo se borra, para que los contadores no retrocedan sin que el
+    directorio crezca con cada reciclaje; los gauges solo se exportan para
+    procesos vivos.
+    """
+
+    def __init__(self, directory: Optional[str] = None, flush_interval: float = 5.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self._histograms: Dict[Tuple[str, Labels], List[Any]] = {}
+        self._gauges: List[Tuple[str, Dict[str, Any], Callable[[], float]]] = []
+        self._task: Optional[asyncio.Task] = None
+        self._path = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._path = os.path.join(directory, f'{os.getpid()}-{time.time_ns()}.json')
+
+    def inc(self, name: str, amount: float = 1.0, **labels: Any) -> None:
+        key = (name, _labels(labels))
+        self._counters[key] = self._counters.get(key, 0.0) + amount
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        key = (name, _labels(labels))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0]
+        histogram[0][bisect_left(LATENCY_BUCKETS, value)] += 1
+        histogram[1] += value
+
+    def gauge(self, name: str, read: Callable[[], float], **labels: Any) -> None:
+        """Registra un gauge que se lee en el momento de volcar el estado"""
+        self._gauges.append((name, labels, read))
+
+    def snapshot(self) -> Dict[str, Any]:
+        gauges = []
+        for name, labels, read in self._gauges:
+            try:
+                gauges.append([name, labels, float(read())])
+            except Exception as e:
+                logger.debug(f"No se pudo leer el gauge {name}: {e}")
+        return {
+            'pid': os.getpid(),
+            'counters': [[name, dict(labels), value] for (name, labels), value in self._counters.items()],
+            'histograms': [[name, dict(labels), h[0], h[1]] for (name, labels), h in self._histograms.items()],
+            'gauges': gauges
+        }
+
+    def flush(self) -> None:
+        if not self._path:
+            return
+        # Temporal propio por escritura: el volcado periódico y un /metrics pueden coincidir
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=os.path.basename(self._path) + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp, self._path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+    def start(self) -> None:
+        if self._path and self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            self.flush()
+        except OSError as e:
+            logger.warning(f"No se pudieron volcar las métricas: {e}")
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError as e:
+                logger.warning(f"No se pudieron volcar las métricas: {e}")
+
+    def _snapshots(self) -> Iterable[Dict[str, Any]]:
+        if not self.directory:
+            yield self.snapshot()
+            return
+        try:
+            self.flush()
+        except OSError as e:
+            # Se usa el último volcado del worker: el scrape no falla por esto
+            logger.warning(f"No se pudieron volcar las métricas: {e}")
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.json') or filename == RETIRED_FILE:
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                # Archivo a medio reemplazar o ya sumado por otro worker
+                continue
+            if _alive(snapshot.get('pid')):
+                yield snapshot
+                continue
+            try:
+                self._retire(path)
+            except OSError as e:
+                logger.warning(f"No se pudieron archivar las métricas de {filename}: {e}")
+                yield snapshot
+        retired = _read_json(os.path.join(self.directory, RETIRED_FILE))
+        if retired:
+            yield retired
+
+    def _retire(self, path: str) -> None:
+        """Suma el archivo de un worker que ya no existe a retired.json y lo borra"""
+        retired_path = os.path.join(self.directory, RETIRED_FILE)
+        with open(retired_path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Otro worker pudo haberlo sumado mientras se esperaba el lock
+            snapshot = _read_json(path)
+            if snapshot is None:
+                return
+            retired = _read_json(retired_path) or {'pid': None, 'counters': [], 'histograms': []}
+            counters = {(name, _labels(labels)): value for name, labels, value in retired['counters']}
+            histograms = {(name, _labels(labels)): [buckets, total] for name, labels, buckets, total in retired['histograms']}
+            for name, labels, value in snapshot.get('counters', []):
+                key = (name, _labels(labels))
+                counters[key] = counters.get(key, 0.0) + value
+            for name, labels, buckets, total in snapshot.get('histograms', []):
+                merged = histograms.setdefault((name, _labels(labels)), [[0] * len(buckets), 0.0])
+                merged[0] = [a + b for a, b in zip(merged[0], buckets)]
+                merged[1] += total
+            retired = {
+                'pid': None,
+                'counters': [[name, dict(labels), value] for (name, labels), value in counters.items()],
+                'histograms': [[name, dict(labels), h[0], h[1]] for (name, labels), h in histograms.items()]
+            }
+            tmp = f'{retired_path}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(retired, f)
+            os.replace(tmp, retired_path)
+            os.remove(path)
+
+    def render(self) -> str:
+        """Métricas de todos los workers en formato de texto de Prometheus"""
+        counters: Dict[Tuple[str, Labels], float] = {}
+        histograms: Dict[Tuple[str, Labels], List[Any]] = {}
+        gauges: Dict[Tuple[str, Labels], float] = {}
+        for snapshot in self._snapshots():
+            alive = _alive(snapshot.get('pid'))
+            for name, labels, value in snapshot.get('counters', []):
+                key = (name, _labels(labels))
+                counters[key] = counters.get(key, 0.0) + value
+            for name, labels, buckets, total in snapshot.get('histograms', []):
+                key = (name, _labels(labels))
+                merged = histograms.setdefault(key, [[0] * len(buckets), 0.0])
+                merged[0] = [a + b for a, b in zip(merged[0], buckets)]
+                merged[1] += total
+            if alive:
+                for name, labels, value in snapshot.get('gauges', []):
+                    gauges[(name, _labels({**labels, 'pid': snapshot['pid']}))] = value
+
+        lines: List[str] = []
+        for name, (kind, description) in METRICS.items():
+            full = PREFIX + name
+            lines.append(f'# HELP {full} {description}')
+            lines.append(f'# TYPE {full} {kind}')
+            if kind == 'counter':
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f'{full}{_format(labels)} {value}')
+            elif kind == 'gauge':
+                for (metric, labels), value in sorted(gauges.items()):
+                    if metric == name:
+                        lines.append(f'{full}{_format(labels)} {value}')
+            else:
+                for (metric, labels), (buckets, total) in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), buckets):
+                        cumulative += count
+                        lines.append(f'{full}_bucket{_format(labels + (("le", str(bound)),))} {cumulative}')
+                    lines.append(f'{full}_sum{_format(labels)} {round(total, 6)}')
+                    lines.append(f'{full}_count{_format(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+def _read_json(path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _alive(pid: Optional[int]) -> bool:
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+def _format(labels: Labels) -> str:
+    if not labels:
+        return ''
+    escaped = (
+        f'{k}="' + v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for k, v in labels
+    )
+    return '{' + ','.join(escaped) + '}'
+
+def timed(metric: str):
+    """Decora un método async para medir su duración en self.metrics, por método y resultado"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(self, *args, **kwargs):
+            started = time.perf_counter()
+            outcome = 'ok'
+            try:
+                return await fn(self, *args, **kwargs)
+            except asyncio.CancelledError:
+                outcome = 'cancelled'
+                raise
+            except Exception:
+                outcome = 'error'
+                raise
+            finally:
+                self.metrics.observe(metric, time.perf_counter() - started, method=fn.__name__, outcome=outcome)
+        return wrapper
+    return decorator
+
+def http_pool_stats(client, max_connections: Optional[int] = None) -> Dict[str, Any]:
+    """Ocupación del pool de conexiones de un httpx.AsyncClient"""
+    pool = getattr(getattr(client, '_transport', None), '_pool', None)
+    connections = list(getattr(pool, 'connections', []))
+    active = sum(1 for c in connections if not c.is_idle())
+    waiting = sum(1 for r in getattr(pool, '_requests', []) if getattr(r, 'connection', None) is None)
+    return {
+        'connections': len(connections),
+        'active': active,
+        'waiting': waiting,
+        'max_connections': max_connections,
+        'saturation': round(active / max_connections, 4) if max_connections else None
+    }
+
+class MetricsMiddleware:
+    """Middleware ASGI que mide cada petición HTTP por endpoint y código de estado"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            services = getattr(scope['app'].state, 'services', None)
+            if services is not None:
+                # El router deja el endpoint en el scope: la etiqueta no depende de los parámetros de la ruta
+                endpoint = getattr(scope.get('endpoint'), '__name__', 'desconocido')
+                services.metrics.observe('http_request_seconds', time.perf_counter() - started, handler=endpoint, status=status)
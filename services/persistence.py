@@ -0,0 +1,177 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from postgrest.exceptions import APIError
+
+logger = logging.getLogger(__name__)
+
+Row = Dict[str, Any]
+
+# Errores de PostgREST/Postgres que sí vale la pena reintentar: conexión, bloqueos y recursos
+_TRANSIENT_CODES = ('08', '40', '53', '57', 'PGRST000', 'PGRST001', 'PGRST002', 'PGRST003')
+
+def _is_rejection(error: Exception) -> bool:
+    """Indica si el servidor rechazó las filas en sí, de modo que reintentar el lote no sirve"""
+    if not isinstance(error, APIError):
+        return False
+    code = error.code
+    # Sin cuerpo JSON el código es el estado HTTP (502, 503...): falla del camino, no de las filas
+    return isinstance(code, str) and not code.startswith(_TRANSIENT_CODES)
+
+class MessageWriter:
+    """Cola de inserciones de mensajes que se escriben en lotes por tamaño o por tiempo
+
+    Un único consumidor vacía la cola en orden de llegada, así que los mensajes de
+    una conversación se insertan en el mismo orden en que se encolaron. Cada fila
+    lleva un timestamp asignado al encolar, estrictamente creciente en el worker,
+    para que el orden se conserve también dentro de un mismo lote.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = 50,
+        flush_interval: float = 0.02,
+        max_queue: int = 10000,
+        max_retries: int = 5
+    ):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.insert: Optional[Callable[[List[Row]], Awaitable[None]]] = None
+        self.on_flushed: Optional[Callable[[List[Row]], None]] = None
+        self.on_failed: Optional[Callable[[List[Row]], None]] = None
+        self._queue: "asyncio.Queue[Tuple[Row, asyncio.Future]]" = asyncio.Queue(maxsize=max_queue)
+        self._task: Optional[asyncio.Task] = None
+        self._last_timestamp: Optional[datetime] = None
+        self.enqueued = 0
+        self.flushed = 0
+        self.batches = 0
+        self.retries = 0
+        self.failed = 0
+
+    def next_timestamp(self) -> str:
+        now = datetime.now(timezone.utc)
+        if self._last_timestamp and now <= self._last_timestamp:
+            now = self._last_timestamp + timedelta(microseconds=1)
+        self._last_timestamp = now
+        return now.isoformat()
+
+    def start(
+        self,
+        insert: Callable[[List[Row]], Awaitable[None]],
+        on_flushed: Optional[Callable[[List[Row]], None]] = None,
+        on_failed: Optional[Callable[[List[Row]], None]] = None
+    ) -> None:
+        """Arranca el consumidor que escribe los lotes con insert(filas)"""
+        self.insert = insert
+        self.on_flushed = on_flushed
+        self.on_failed = on_failed
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def enqueue(self, row: Row) -> asyncio.Future:
+        """Encola una fila; el futuro se resuelve cuando el lote que la contiene se inserta"""
+        future = asyncio.get_running_loop().create_future()
+        # Si la cola está llena, el productor espera: contrapresión en lugar de perder filas
+        await self._queue.put((row, future))
+        self.enqueued += 1
+        return future
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            if self._queue.qsize() < self.batch_size - 1:
+                # Breve espera para agrupar los mensajes que llegan casi al mismo tiempo
+                await asyncio.sleep(self.flush_interval)
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self._flush(batch)
+            except Exception as e:
+                logger.error(f"Error inesperado al escribir lote de mensajes: {e}", exc_info=True)
+                self._resolve(batch, e)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _flush(self, batch: List[Tuple[Row, asyncio.Future]]) -> None:
+        rows = [row for row, _ in batch]
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self.insert(rows)
+                break
+            except Exception as e:
+                if _is_rejection(e):
+                    # Se insertan una por una para aislar la fila inválida sin perder el resto
+                    logger.warning(f"Lote de {len(rows)} mensajes rechazado ({e}), se reintenta fila por fila")
+                    await self._flush_individually(batch)
+                    return
+                if attempt == self.max_retries:
+                    logger.error(f"No se pudo escribir un lote de {len(rows)} mensajes tras {attempt + 1} intentos: {e}")
+                    self._resolve(batch, e)
+                    return
+                self.retries += 1
+                delay = min(10.0, 0.5 * 2 ** attempt)
+                logger.warning(f"Error al escribir lote de mensajes, reintento en {delay}s: {e}")
+                await asyncio.sleep(delay)
+
+        self._resolve(batch)
+
+    async def _flush_individually(self, batch: List[Tuple[Row, asyncio.Future]]) -> None:
+        for item in batch:
+            try:
+                await self.insert([item[0]])
+                self._resolve([item])
+            except Exception as e:
+                logger.error(f"Mensaje descartado de la conversación {item[0].get('conversacion_id')}: {e}")
+                self._resolve([item], e)
+
+    def _resolve(self, batch: List[Tuple[Row, asyncio.Future]], error: Optional[BaseException] = None) -> None:
+        if error is None:
+            self.batches += 1
+            self.flushed += len(batch)
+        else:
+            self.failed += len(batch)
+        callback = self.on_flushed if error is None else self.on_failed
+        if callback:
+            try:
+                callback([row for row, _ in batch])
+            except Exception as e:
+                logger.warning(f"Error al notificar el resultado de un lote de mensajes: {e}")
+        for _, future in batch:
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+                future.exception()  # Nadie espera las escrituras en segundo plano
+
+    async def drain(self, timeout: float) -> None:
+        """Espera a que la cola se vacíe (apagado ordenado) y detiene el consumidor"""
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+            logger.info("Cola de mensajes vaciada antes del apagado")
+        except asyncio.TimeoutError:
+            logger.error(f"Apagado con {self._queue.qsize()} mensajes sin escribir")
+        finally:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'queued': self._queue.qsize(),
+            'max_queue': self._queue.maxsize,
+            'enqueued': self.enqueued,
+            'flushed': self.flushed,
+            'batches': self.batches,
+            'retries': self.retries,
+            'failed': self.failed
+        }
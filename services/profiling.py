@@ -0,0 +1,335 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+from collections import Counter, deque
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+from services.logs import current_request_id
+from services.metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Frames hoja de un hilo que espera (selector del loop, pool de hilos sin trabajo, colas)
+IDLE_FRAMES = frozenset({
+    ('selectors.py', 'select'),
+    ('threading.py', 'wait'),
+    ('queue.py', 'get'),
+    ('thread.py', '_worker'),
+    ('handlers.py', 'dequeue'),
+})
+
+_labels: Dict[Any, str] = {}
+
+def _label(code) -> str:
+    """Nombre corto y estable de una función para el archivo de stacks"""
+    label = _labels.get(code)
+    if label is None:
+        path = code.co_filename
+        if path.startswith(ROOT):
+            path = os.path.relpath(path, ROOT)
+        elif 'site-packages' in path:
+            path = path.split('site-packages' + os.sep, 1)[1]
+        else:
+            path = os.path.basename(path)
+        # ';' separa los frames y el último espacio separa la cuenta
+        label = f"{path}:{code.co_qualname}".replace(';', ',').replace(' ', '_')
+        _labels[code] = label
+    return label
+
+def _frame_stack(frame) -> List[str]:
+    """Stack de un frame, de la raíz a la hoja"""
+    labels = []
+    while frame is not None:
+        labels.append(_label(frame.f_code))
+        frame = frame.f_back
+    labels.reverse()
+    return labels
+
+def _idle(frame) -> bool:
+    code = frame.f_code
+    return (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES
+
+def task_stack(task: asyncio.Task) -> List[str]:
+    """Cadena de awaits de una tarea, desde la corrutina raíz hasta donde está suspendida"""
+    labels = []
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None) or getattr(coro, 'ag_frame', None)
+        if frame is None:
+            break
+        labels.append(f"{_label(frame.f_code)}:{frame.f_lineno}")
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None) or getattr(coro, 'ag_await', None)
+    return labels
+
+def _iso(moment: float) -> str:
+    return datetime.fromtimestamp(moment, tz=timezone.utc).isoformat()
+
+class SamplingProfiler:
+    """Profiler por muestreo de todos los hilos del worker
+
+    Un hilo toma cada `interval` segundos los frames de todos los hilos
+    (sys._current_frames) y cuenta los stacks; el resultado está en formato
+    "collapsed" (frame;frame;frame cuenta) que leen flamegraph.pl y speedscope.
+    El costo es el de recorrer los stacks en cada muestra, sin instrumentar las
+    llamadas, así que se puede usar en producción por unos segundos.
+    """
+
+    def __init__(self, interval: float = 0.005, include_idle: bool = False):
+        self.interval = interval
+        self.include_idle = include_idle
+        self.samples: Counter = Counter()
+        self.count = 0
+        self.started: Optional[float] = None
+        self.elapsed = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self.started = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.elapsed = time.monotonic() - self.started if self.started else 0.0
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own or (not self.include_idle and _idle(frame)):
+                    continue
+                stack = [names.get(ident, f'hilo-{ident}')] + _frame_stack(frame)
+                self.samples[';'.join(stack)] += 1
+            self.count += 1
+
+    def collapsed(self) -> str:
+        return ''.join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+class _InFlight:
+    __slots__ = ('request_id', 'route', 'method', 'started', 'task', 'budget', 'stack', 'stack_at')
+
+    def __init__(self, request_id: Optional[str], route: str, method: str, task: Optional[asyncio.Task]):
+        self.request_id = request_id
+        self.route = route
+        self.method = method
+        self.started = time.monotonic()
+        self.task = task
+        self.budget = None
+        self.stack: Optional[List[str]] = None
+        self.stack_at: Optional[float] = None
+
+_current: contextvars.ContextVar[Optional[_InFlight]] = contextvars.ContextVar('profiling_request', default=None)
+
+def track_budget(budget: Any) -> None:
+    """Asocia el presupuesto de latencia a la petición en curso para registrar sus etapas si es lenta"""
+    request = _current.get()
+    if request is not None and request.budget is None:
+        request.budget = budget
+
+class SlowRequestRecorder:
+    """Registro permanente de las peticiones lentas en un buffer circular
+
+    Una petición de las rutas vigiladas que pasa de `threshold` segundos deja
+    sus etapas (el RequestBudget), su estado y una muestra de su stack: la
+    cadena de awaits de la tarea tomada al cruzar el umbral, que muestra en qué
+    estaba esperando (el modelo, el limitador, PostgREST...).
+    """
+
+    def __init__(
+        self,
+        threshold: float = 5.0,
+        capacity: int = 100,
+        prefixes: Tuple[str, ...] = ('/message',),
+        metrics: Optional[Metrics] = None
+    ):
+        self.threshold = threshold
+        self.prefixes = prefixes
+        self.metrics = metrics or Metrics()
+        self.entries: deque = deque(maxlen=capacity)
+        self.inflight: Dict[int, _InFlight] = {}
+        # Peticiones terminadas en el worker: el profiler por cantidad de peticiones las espera
+        self.completed = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def watches(self, path: str) -> bool:
+        return path.startswith(self.prefixes)
+
+    def begin(self, request_id: Optional[str], route: str, method: str) -> Tuple[_InFlight, contextvars.Token]:
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        request = _InFlight(request_id, route, method, task)
+        self.inflight[id(request)] = request
+        return request, _current.set(request)
+
+    def end(self, request: _InFlight, token: contextvars.Token, status: int) -> None:
+        _current.reset(token)
+        self.inflight.pop(id(request), None)
+        self.completed += 1
+        elapsed = time.monotonic() - request.started
+        if elapsed < self.threshold:
+            return
+        budget = request.budget
+        self.entries.append({
+            'request_id': request.request_id,
+            'route': request.route,
+            'method': request.method,
+            'status': status,
+            'duration_ms': round(elapsed * 1000, 2),
+            'at': _iso(time.time() - elapsed),
+            'stages': dict(budget.timings) if budget is not None else None,
+            'skipped': list(budget.skipped) if budget is not None else None,
+            'stack': request.stack,
+            'stack_at_ms': round((request.stack_at - request.started) * 1000, 2) if request.stack_at else None
+        })
+        self.metrics.inc('slow_requests_total', route=request.route)
+        logger.warning(
+            "Petición lenta: %s %s %.0fms (%s)", request.method, request.route, elapsed * 1000,
+            budget.summary() if budget is not None else 'sin etapas'
+        )
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._watch())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _watch(self) -> None:
+        """Toma el stack de las peticiones que cruzan el umbral mientras siguen en curso"""
+        interval = min(0.25, self.threshold / 4)
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            for request in list(self.inflight.values()):
+                if request.stack is None and request.task is not None and now - request.started >= self.threshold:
+                    try:
+                        request.stack = task_stack(request.task)
+                        request.stack_at = now
+                    except Exception as e:
+                        logger.debug(f"No se pudo tomar el stack de la petición {request.request_id}: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {'umbral_s': self.threshold, 'registradas': len(self.entries), 'en_curso': len(self.inflight)}
+
+class LoopLagMonitor:
+    """Mide el retraso del event loop y toma el stack del hilo del loop cuando se bloquea
+
+    Una tarea duerme `interval` segundos y mide cuánto tarda de más en
+    despertar: ese retraso es el tiempo que el loop pasó ocupado en código
+    síncrono. Un hilo vigía revisa el latido de la tarea; si el loop lleva más
+    de `stall_threshold` segundos sin atenderla, toma el stack del hilo del loop
+    mientras sigue bloqueado y lo guarda en un buffer circular.
+    """
+
+    def __init__(
+        self,
+        interval: float = 0.1,
+        stall_threshold: float = 0.5,
+        capacity: int = 50,
+        metrics: Optional[Metrics] = None
+    ):
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.metrics = metrics or Metrics()
+        self.stalls: deque = deque(maxlen=capacity)
+        self.max_lag = 0.0
+        self.last_lag = 0.0
+        self._heartbeat = time.monotonic()
+        self._loop_thread: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = asyncio.create_task(self._measure())
+        self._watchdog = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._watchdog.start()
+
+    async def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _measure(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self._heartbeat = time.monotonic()
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            self.metrics.observe('event_loop_lag_seconds', lag)
+
+    def _watch(self) -> None:
+        captured_for = None
+        while not self._stop.wait(self.interval):
+            heartbeat = self._heartbeat
+            blocked = time.monotonic() - heartbeat - self.interval
+            if blocked < self.stall_threshold or captured_for == heartbeat:
+                continue
+            # Una sola muestra por bloqueo: la del momento en que cruza el umbral
+            captured_for = heartbeat
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            self.stalls.append({
+                'at': _iso(time.time() - blocked),
+                'blocked_ms': round(blocked * 1000, 2),
+                'stack': _frame_stack(frame)
+            })
+            self.metrics.inc('event_loop_stalls_total')
+            logger.warning("Event loop bloqueado %.0fms en %s", blocked * 1000, _label(frame.f_code))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'retraso_ms': round(self.last_lag * 1000, 2),
+            'retraso_max_ms': round(self.max_lag * 1000, 2),
+            'bloqueos': len(self.stalls)
+        }
+
+class ProfilingMiddleware:
+    """Middleware ASGI que alimenta el SlowRequestRecorder del worker"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        services = getattr(scope['app'].state, 'services', None) if scope['type'] == 'http' else None
+        recorder = getattr(services, 'slow_requests', None)
+        if recorder is None or not recorder.watches(scope['path']):
+            await self.app(scope, receive, send)
+            if recorder is not None:
+                recorder.completed += 1
+            return
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        request, token = recorder.begin(current_request_id(), scope['path'], scope['method'])
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            recorder.end(request, token, status)
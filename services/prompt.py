@@ -0,0 +1,184 @@
+import re
+import math
+import asyncio
+import logging
+import hashlib
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Tokens que el formato de chat añade por mensaje y para iniciar la respuesta
+MESSAGE_OVERHEAD = 4
+REPLY_OVERHEAD = 3
+
+SUMMARY_HEADER = "\n\nResumen de la conversación hasta ahora:\n"
+
+# Fin de oración o salto de línea: los únicos puntos donde se permite cortar un texto
+_SENTENCE_END = re.compile(r'(?<=[.!?…])\s+|\n+')
+
+def _load_encoding(model: str):
+    """Codificación del modelo, o cl100k_base si tiktoken no lo conoce; None si no se puede cargar"""
+    try:
+        import tiktoken
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding('cl100k_base')
+    except Exception as e:
+        logger.warning(f"No se pudo cargar la codificación de tokens, se usará una estimación: {e}")
+        return None
+
+class TokenCounter:
+    """Cuenta tokens con tiktoken y guarda los conteos de los textos estáticos
+
+    La codificación se carga aparte (load) porque tiktoken puede descargarla la
+    primera vez; mientras no esté disponible se estima por caracteres, de forma
+    conservadora para no exceder el presupuesto.
+    """
+
+    def __init__(self, model: str = 'deepseek-chat', static_entries: int = 4096):
+        self.model = model
+        self.static_entries = static_entries
+        self._encoding = None
+        self._static: "OrderedDict[str, int]" = OrderedDict()
+
+    async def load(self) -> None:
+        """Carga la codificación fuera del loop; hasta entonces se usa la estimación"""
+        encoding = await asyncio.to_thread(_load_encoding, self.model)
+        if encoding is not None:
+            self._encoding = encoding
+            # Los conteos estimados ya no sirven una vez que hay codificación real
+            self._static.clear()
+            logger.info(f"Codificación de tokens cargada: {encoding.name}")
+
+    @property
+    def exact(self) -> bool:
+        return self._encoding is not None
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        if self._encoding is None:
+            return math.ceil(len(text) / 3)
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+    def count_static(self, text: str) -> int:
+        """Cuenta un texto que se repite entre peticiones (contexto del chatbot o del programa)"""
+        key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        tokens = self._static.get(key)
+        if tokens is None:
+            tokens = self._static[key] = self.count(text)
+            while len(self._static) > self.static_entries:
+                self._static.popitem(last=False)
+        else:
+            self._static.move_to_end(key)
+        return tokens
+
+    def count_turn(self, turn: Dict[str, Any]) -> int:
+        """Cuenta un turno del historial una sola vez: el conteo viaja con el turno en el buffer"""
+        tokens = turn.get('tokens')
+        if tokens is None or not self.exact:
+            tokens = self.count(turn.get('contenido') or '')
+            if self.exact:
+                turn['tokens'] = tokens
+        return tokens
+
+class PromptBuilder:
+    """Arma el prompt dentro de un presupuesto de tokens de entrada
+
+    El mensaje actual siempre va. Con lo que queda se llena, en orden de
+    prioridad, el contexto del chatbot, la información del programa y tantos
+    turnos recientes como quepan. Nada se corta a mitad de oración: lo que no
+    cabe se descarta por oraciones completas o por turnos completos.
+    """
+
+    def __init__(self, counter: TokenCounter, max_input_tokens: int = 3000):
+        self.counter = counter
+        self.max_input_tokens = max_input_tokens
+
+    def build(
+        self,
+        context: str,
+        history: List[Dict[str, Any]],
+        message: str,
+        program_context: str = '',
+        context_tokens: Optional[int] = None,
+        program_tokens: Optional[int] = None,
+        summary: str = ''
+    ) -> List[Dict[str, str]]:
+        """context_tokens y program_tokens evitan volver a contar un contexto precompilado
+
+        summary es el resumen de los turnos anteriores a history; va al final del
+        mensaje del sistema para no alterar el prefijo común a las conversaciones.
+        """
+        budget = self.max_input_tokens - REPLY_OVERHEAD
+        budget -= self.counter.count(message) + MESSAGE_OVERHEAD
+        if budget < 0:
+            logger.warning(f"El mensaje supera por sí solo el presupuesto de {self.max_input_tokens} tokens")
+
+        # El contexto del sistema va en un único mensaje aunque tenga dos partes
+        budget -= MESSAGE_OVERHEAD
+        system, used = self._fit(context, budget, context_tokens)
+        budget -= used
+        if program_context:
+            program, used = self._fit(program_context, budget, program_tokens)
+            budget -= used
+            system += program
+        if summary:
+            header = self.counter.count_static(SUMMARY_HEADER)
+            summary, used = self._fit(summary, budget - header, self.counter.count(summary))
+            if summary:
+                budget -= header + used
+                system += SUMMARY_HEADER + summary
+
+        turns: List[Dict[str, str]] = []
+        for turn in reversed(history):
+            tokens = self.counter.count_turn(turn) + MESSAGE_OVERHEAD
+            if tokens > budget:
+                break
+            budget -= tokens
+            turns.append(self._as_message(turn))
+        turns.reverse()
+
+        messages = [{'role': 'system', 'content': system}] if system else []
+        return messages + turns + [{'role': 'user', 'content': message}]
+
+    def _fit(self, text: str, budget: int, tokens: Optional[int] = None) -> tuple:
+        """Devuelve el texto (o sus primeras oraciones completas) que cabe en budget y sus tokens"""
+        if not text or budget <= 0:
+            return '', 0
+        if tokens is None:
+            tokens = self.counter.count_static(text)
+        if tokens <= budget:
+            return text, tokens
+
+        kept: List[str] = []
+        used = 0
+        position = 0
+        for match in _SENTENCE_END.finditer(text + '\n'):
+            sentence = text[position:match.end()]
+            # Las oraciones de un contexto estático también se repiten entre peticiones
+            cost = self.counter.count_static(sentence)
+            if used + cost > budget:
+                break
+            kept.append(sentence)
+            used += cost
+            position = match.end()
+        logger.debug(f"Contexto recortado a {used} de {tokens} tokens")
+        return ''.join(kept).rstrip(), used
+
+    @staticmethod
+    def _as_message(turn: Dict[str, Any]) -> Dict[str, str]:
+        # El lead habla como usuario; el chatbot y los agentes humanos como asistente
+        role = 'user' if turn.get('emisor_tipo') == 'lead' else 'assistant'
+        return {'role': role, 'content': turn['contenido']}
+
+def trim_to_sentence(text: str) -> str:
+    """Quita la oración incompleta del final de un texto cortado por límite de tokens"""
+    ends = [m.start() for m in _SENTENCE_END.finditer(text)]
+    last = max((i for i in ends if i > 0), default=None)
+    if last is None:
+        stripped = text.rstrip()
+        return stripped if stripped.endswith(('.', '!', '?', '…')) else stripped + '…'
+    return text[:last].rstrip()
@@ -0,0 +1,282 @@
+import math
+import time
+import asyncio
+import logging
+from collections import deque
+from contextlib import aclosing
+from typing import Any, AsyncIterator, Deque, Dict, Iterator, List, Optional, Sequence, Tuple
+from services.limiter import ConcurrencyLimiter, LLMOverloadedError
+from services.llm_client import ChatCompletion
+from services.metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'cerrado'
+HALF_OPEN = 'semiabierto'
+OPEN = 'abierto'
+# Valor del gauge llm_breaker_state por estado
+BREAKER_STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+class LLMUnavailableError(LLMOverloadedError):
+    """Ningún proveedor del modelo acepta llamadas: todos los circuitos están abiertos
+
+    Se responde igual que a la falta de cupo (503 con Retry-After).
+    """
+
+class CircuitBreaker:
+    """Corta las llamadas a un proveedor después de varias fallas seguidas
+
+    Abierto, rechaza de inmediato durante reset_timeout; luego deja pasar una
+    sola llamada de prueba (semiabierto) que lo cierra si tiene éxito o lo
+    vuelve a abrir si falla. Si la prueba nunca informa su resultado (se canceló),
+    pasado otro reset_timeout se permite una nueva.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0, metrics: Optional[Metrics] = None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.metrics = metrics or Metrics()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_started: Optional[float] = None
+
+    def allow(self) -> bool:
+        """Indica si se puede llamar al proveedor; en semiabierto reserva la llamada de prueba"""
+        if self.state == CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == OPEN:
+            if now - self.opened_at < self.reset_timeout:
+                return False
+            self._transition(HALF_OPEN)
+        if self._probe_started is None or now - self._probe_started >= self.reset_timeout:
+            self._probe_started = now
+            return True
+        return False
+
+    def retry_after(self) -> int:
+        """Segundos hasta que el circuito deje pasar una llamada de prueba"""
+        return max(1, math.ceil(self.opened_at + self.reset_timeout - time.monotonic()))
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self._probe_started = None
+        if self.state != CLOSED:
+            self._transition(CLOSED)
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._probe_started = None
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+            self.opened_at = time.monotonic()
+            self._transition(OPEN)
+
+    def _transition(self, state: str) -> None:
+        logger.warning(f"Circuito del proveedor {self.name}: {self.state} -> {state}")
+        self.state = state
+        self.metrics.inc('llm_breaker_transitions_total', provider=self.name, state=state)
+
+    def stats(self) -> dict:
+        return {'estado': self.state, 'fallas_seguidas': self.failures}
+
+class LatencyWindow:
+    """Latencias recientes de las llamadas exitosas de un proveedor"""
+
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples: Deque[float] = deque(maxlen=size)
+        self._sorted: Optional[List[float]] = None
+
+    def add(self, seconds: float) -> None:
+        self._samples.append(seconds)
+        self._sorted = None
+
+    def percentile(self, q: float) -> Optional[float]:
+        """Percentil q (0-1) de la ventana; None mientras no haya muestras suficientes"""
+        if len(self._samples) < self.min_samples:
+            return None
+        if self._sorted is None:
+            self._sorted = sorted(self._samples)
+        return self._sorted[min(len(self._sorted) - 1, int(q * len(self._sorted)))]
+
+class LLMProvider:
+    """Un backend del modelo con su circuito y su ventana de latencias"""
+
+    def __init__(self, name: str, client: Any, breaker: CircuitBreaker, slow_call: float = 10.0):
+        self.name = name
+        # Cliente de services.llm_client: generate(mensajes) y stream(mensajes) con ChatCompletion
+        self.client = client
+        self.breaker = breaker
+        # Una llamada cancelada después de esto cuenta como falla (el proveedor no respondió a tiempo)
+        self.slow_call = slow_call
+        self.latency = LatencyWindow()
+
+    async def generate(self, messages: List[Dict[str, str]]) -> ChatCompletion:
+        started = time.monotonic()
+        try:
+            result = await self.client.generate(messages)
+        except asyncio.CancelledError:
+            if time.monotonic() - started >= self.slow_call:
+                self.breaker.record_failure()
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        self.latency.add(time.monotonic() - started)
+        return result
+
+class ProviderRouter:
+    """Elige el proveedor del modelo: el principal mientras su circuito esté cerrado, si no el de respaldo
+
+    Con hedging, si la llamada al principal supera el percentil configurado de
+    sus latencias recientes se lanza una segunda llamada igual y se usa la
+    primera que responda; la otra se cancela. Las llamadas extra se limitan a
+    una proporción de las llamadas y solo se hacen si el limitador tiene cupo.
+    """
+
+    def __init__(
+        self,
+        providers: Sequence[LLMProvider],
+        limiter: Optional[ConcurrencyLimiter] = None,
+        metrics: Optional[Metrics] = None,
+        hedge: bool = False,
+        hedge_percentile: float = 0.95,
+        hedge_min_delay: float = 1.0,
+        hedge_max_ratio: float = 0.1
+    ):
+        self.providers = list(providers)
+        self.limiter = limiter or ConcurrencyLimiter()
+        self.metrics = metrics or Metrics()
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_ratio = hedge_max_ratio
+        self.calls = 0
+        self.hedges = 0
+
+    @property
+    def primary(self) -> LLMProvider:
+        return self.providers[0]
+
+    def _candidates(self) -> Iterator[LLMProvider]:
+        """Proveedores a intentar, en orden
+
+        allow() se consulta recién al llegar a cada proveedor: en semiabierto
+        reserva la única llamada de prueba, que no se debe gastar en un respaldo
+        que no se va a llamar.
+        """
+        tried = False
+        for provider in self.providers:
+            if provider.breaker.allow():
+                tried = True
+                yield provider
+        if not tried:
+            retry_after = min(provider.breaker.retry_after() for provider in self.providers)
+            raise LLMUnavailableError("Todos los proveedores del modelo tienen el circuito abierto", retry_after)
+
+    def _count_fallback(self, provider: LLMProvider, error: Optional[Exception]) -> None:
+        if error is not None:
+            self.metrics.inc('llm_fallbacks_total', provider=provider.name, reason='error')
+        elif provider is not self.primary:
+            self.metrics.inc('llm_fallbacks_total', provider=provider.name, reason='circuito')
+
+    async def generate(self, messages: List[Dict[str, str]]) -> Tuple[ChatCompletion, LLMProvider]:
+        """Genera con el primer proveedor disponible y pasa al siguiente si falla"""
+        error: Optional[Exception] = None
+        for provider in self._candidates():
+            self._count_fallback(provider, error)
+            try:
+                return await self._generate_hedged(provider, messages), provider
+            except (asyncio.CancelledError, LLMOverloadedError):
+                raise
+            except Exception as e:
+                logger.warning(f"Falla del proveedor {provider.name}: {e}")
+                error = e
+        raise error
+
+    def _hedge_delay(self, provider: LLMProvider) -> Optional[float]:
+        if not self.hedge:
+            return None
+        threshold = provider.latency.percentile(self.hedge_percentile)
+        if threshold is None:
+            return None
+        return max(self.hedge_min_delay, threshold)
+
+    def _may_hedge(self) -> bool:
+        # Tope de llamadas extra: una proporción de las llamadas y nunca a costa de la cola
+        return self.hedges < self.hedge_max_ratio * self.calls and self.limiter.has_capacity()
+
+    async def _generate_hedged(self, provider: LLMProvider, messages: List[Dict[str, str]]) -> ChatCompletion:
+        self.calls += 1
+        delay = self._hedge_delay(provider)
+        if delay is None:
+            return await provider.generate(messages)
+
+        original = asyncio.ensure_future(provider.generate(messages))
+        hedge: Optional[asyncio.Future] = None
+        try:
+            done, _ = await asyncio.wait({original}, timeout=delay)
+            if done or not self._may_hedge():
+                return await original
+
+            self.hedges += 1
+            hedge = asyncio.ensure_future(self._generate_in_slot(provider, messages))
+            pending = {original, hedge}
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = 'hedge' if task is hedge else 'original'
+                        self.metrics.inc('llm_hedges_total', provider=provider.name, winner=winner)
+                        return task.result()
+                    error = task.exception()
+            # Ambas fallaron
+            self.metrics.inc('llm_hedges_total', provider=provider.name, winner='ninguna')
+            raise error
+        finally:
+            for task in (original, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    async def _generate_in_slot(self, provider: LLMProvider, messages: List[Dict[str, str]]) -> ChatCompletion:
+        async with self.limiter.slot():
+            return await provider.generate(messages)
+
+    async def stream(self, messages: List[Dict[str, str]]) -> AsyncIterator[Tuple[ChatCompletion, LLMProvider]]:
+        """Entrega (fragmento, proveedor); pasa al siguiente proveedor solo si falla antes del primer fragmento"""
+        error: Optional[Exception] = None
+        for provider in self._candidates():
+            self._count_fallback(provider, error)
+            started = time.monotonic()
+            received = False
+            try:
+                async with aclosing(provider.client.stream(messages)) as chunks:
+                    async for chunk in chunks:
+                        if not received:
+                            received = True
+                            provider.breaker.record_success()
+                        yield chunk, provider
+                provider.latency.add(time.monotonic() - started)
+                return
+            except (asyncio.CancelledError, GeneratorExit):
+                if not received and time.monotonic() - started >= provider.slow_call:
+                    provider.breaker.record_failure()
+                raise
+            except Exception as e:
+                provider.breaker.record_failure()
+                if received:
+                    raise
+                logger.warning(f"Falla del proveedor {provider.name} en stream: {e}")
+                error = e
+        raise error
+
+    def stats(self) -> dict:
+        return {
+            'proveedores': {provider.name: provider.breaker.stats() for provider in self.providers},
+            'llamadas': self.calls,
+            'hedges': self.hedges
+        }
@@ -0,0 +1,211 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Dict, List, NamedTuple, Optional, Set
+from services.limiter import ConcurrencyLimiter
+from services.local_store import LocalStore
+from services.metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS resumenes (
+    conversacion_id TEXT PRIMARY KEY,
+    resumen TEXT NOT NULL,
+    hasta TEXT NOT NULL,
+    turnos INTEGER NOT NULL,
+    actualizado REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS resumenes_actualizado ON resumenes (actualizado);
+'''
+
+SUMMARY_INSTRUCTIONS = (
+    "Resume la conversación entre un lead y el asistente de admisiones de una institución educativa. "
+    "Conserva los datos del lead (nombre, programa de interés, modalidad, presupuesto, ciudad), "
+    "lo que ya se le respondió y sus dudas pendientes. Escribe en tercera persona, sin saludos, "
+    "en un solo párrafo de menos de {words} palabras."
+)
+
+SPEAKERS = {'lead': 'Lead', 'chatbot': 'Asistente', 'agente': 'Agente'}
+
+class Summary(NamedTuple):
+    """Resumen de los turnos de una conversación hasta el timestamp `until` (incluido)"""
+    text: str
+    until: str
+    turns: int
+
+def _moment(turn: Dict[str, Any]) -> Optional[datetime]:
+    value = turn.get('timestamp')
+    if not value:
+        return None
+    try:
+        moment = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    # PostgREST devuelve `timestamp without time zone` sin zona: se guarda en UTC
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+def turns_after(history: List[Dict[str, Any]], until: Optional[str]) -> List[Dict[str, Any]]:
+    """Turnos del historial posteriores al último turno resumido"""
+    if not until:
+        return history
+    cutoff = _moment({'timestamp': until})
+    if cutoff is None:
+        return history
+    # Un turno sin timestamp es uno recién guardado: siempre es posterior
+    return [turn for turn in history if (_moment(turn) or datetime.max.replace(tzinfo=timezone.utc)) > cutoff]
+
+class ConversationSummarizer:
+    """Resumen acumulado por conversación, actualizado fuera del camino de la respuesta
+
+    Después de responder, si hay al menos `every` turnos sin resumir además de
+    los `keep` más recientes, se programa una llamada a un modelo barato que
+    combina el resumen anterior con esos turnos. El prompt lleva entonces el
+    resumen y solo los turnos posteriores a él, así que su tamaño no crece con
+    la conversación. Los resúmenes se guardan en el LocalStore del host.
+
+    Las actualizaciones no compiten con las respuestas: solo arrancan si el
+    limitador del modelo tiene un cupo libre; si no, se reintentan con el
+    siguiente mensaje de la conversación.
+    """
+
+    def __init__(
+        self,
+        store: LocalStore,
+        client: Any,
+        limiter: Optional[ConcurrencyLimiter] = None,
+        every: int = 6,
+        keep: int = 4,
+        max_words: int = 120,
+        max_concurrency: int = 2,
+        timeout: float = 30.0,
+        cache_entries: int = 5000,
+        provider: str = 'deepseek',
+        metrics: Optional[Metrics] = None
+    ):
+        self.store = store
+        # Cliente de services.llm_client con el modelo de los resúmenes
+        self.client = client
+        self.limiter = limiter or ConcurrencyLimiter()
+        self.every = every
+        self.keep = keep
+        self.max_words = max_words
+        self.timeout = timeout
+        self.cache_entries = cache_entries
+        self.provider = provider
+        self.metrics = metrics or Metrics()
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._cache: "OrderedDict[str, Optional[Summary]]" = OrderedDict()
+        self._pending: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self.counts = {'actualizado': 0, 'error': 0, 'sin_cupo': 0}
+
+    @property
+    def history_limit(self) -> int:
+        """Turnos que se deben leer para resumir aunque una actualización se haya atrasado una vez"""
+        return 2 * self.every + self.keep
+
+    async def get(self, conversation_id: str) -> Optional[Summary]:
+        if conversation_id in self._cache:
+            self._cache.move_to_end(conversation_id)
+            return self._cache[conversation_id]
+        try:
+            row = await self.store.run(_select, conversation_id)
+        except Exception as e:
+            logger.warning(f"Error al leer el resumen de la conversación {conversation_id}: {e}")
+            return None
+        summary = Summary(row['resumen'], row['hasta'], row['turnos']) if row else None
+        self._remember(conversation_id, summary)
+        return summary
+
+    def schedule(self, conversation_id: str, history: List[Dict[str, Any]], summary: Optional[Summary]) -> None:
+        """Programa la actualización del resumen si hay suficientes turnos nuevos; no espera"""
+        if conversation_id in self._pending:
+            return
+        pending = turns_after(history, summary.until if summary else None)[:-self.keep or None]
+        if len(pending) < self.every or any(_moment(turn) is None for turn in pending):
+            return
+        if not self.limiter.has_capacity():
+            self.counts['sin_cupo'] += 1
+            self.metrics.inc('summary_updates_total', result='sin_cupo')
+            return
+        self._pending.add(conversation_id)
+        task = asyncio.create_task(self._update(conversation_id, pending, summary))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _update(self, conversation_id: str, turns: List[Dict[str, Any]], summary: Optional[Summary]) -> None:
+        started = time.perf_counter()
+        result = 'error'
+        try:
+            # Otro worker pudo haber resumido la conversación desde que se leyó el resumen
+            row = await self.store.run(_select, conversation_id)
+            if row and (summary is None or row['turnos'] > summary.turns):
+                summary = Summary(row['resumen'], row['hasta'], row['turnos'])
+                turns = turns_after(turns, summary.until)
+                if len(turns) < self.every:
+                    self._remember(conversation_id, summary)
+                    result = 'actualizado'
+                    return
+            async with self._semaphore, self.limiter.slot():
+                completion = await asyncio.wait_for(self.client.generate(self._prompt(turns, summary)), self.timeout)
+            text = completion.text.strip()
+            if not text:
+                raise ValueError("Resumen vacío")
+            updated = Summary(text, str(turns[-1]['timestamp']), (summary.turns if summary else 0) + len(turns))
+            await self.store.run(_upsert, conversation_id, updated.text, updated.until, updated.turns, time.time())
+            self._remember(conversation_id, updated)
+            result = 'actualizado'
+            logger.debug(f"Resumen de la conversación {conversation_id} actualizado: {updated.turns} turnos")
+        except Exception as e:
+            logger.warning(f"Error al actualizar el resumen de la conversación {conversation_id}: {e}")
+        finally:
+            self._pending.discard(conversation_id)
+            self.counts[result] += 1
+            self.metrics.inc('summary_updates_total', result=result)
+            self.metrics.observe(
+                'llm_seconds', time.perf_counter() - started,
+                operation='summary', outcome='ok' if result == 'actualizado' else 'error', provider=self.provider
+            )
+
+    def _prompt(self, turns: List[Dict[str, Any]], summary: Optional[Summary]) -> List[Dict[str, str]]:
+        lines = [f"{SPEAKERS.get(turn.get('emisor_tipo'), 'Asistente')}: {turn.get('contenido') or ''}" for turn in turns]
+        previous = summary.text if summary else 'Sin resumen previo.'
+        return [
+            {'role': 'system', 'content': SUMMARY_INSTRUCTIONS.format(words=self.max_words)},
+            {'role': 'user', 'content': f"Resumen previo:\n{previous}\n\nTurnos nuevos:\n" + '\n'.join(lines)}
+        ]
+
+    def _remember(self, conversation_id: str, summary: Optional[Summary]) -> None:
+        self._cache[conversation_id] = summary
+        self._cache.move_to_end(conversation_id)
+        while len(self._cache) > self.cache_entries:
+            self._cache.popitem(last=False)
+
+    async def aclose(self) -> None:
+        """Espera las actualizaciones en curso un momento y cierra el store"""
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=5.0)
+        for task in self._tasks:
+            task.cancel()
+        self.store.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.counts, 'en_curso': len(self._pending), 'en_memoria': len(self._cache)}
+
+def _select(conn, conversation_id: str):
+    return conn.execute(
+        'SELECT resumen, hasta, turnos FROM resumenes WHERE conversacion_id = ?',
+        (conversation_id,)
+    ).fetchone()
+
+def _upsert(conn, conversation_id: str, summary: str, until: str, turns: int, now: float) -> None:
+    # Otro worker pudo haber guardado un resumen más reciente mientras tanto
+    conn.execute(
+        'INSERT INTO resumenes (conversacion_id, resumen, hasta, turnos, actualizado) VALUES (?, ?, ?, ?, ?) '
+        'ON CONFLICT (conversacion_id) DO UPDATE SET resumen = excluded.resumen, hasta = excluded.hasta, '
+        'turnos = excluded.turnos, actualizado = excluded.actualizado WHERE excluded.turnos > resumenes.turnos',
+        (conversation_id, summary, until, turns, now)
+    )
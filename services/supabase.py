@@ -1,34 +1,153 @@
 import os
-from supabase import create_client, Client
+import httpx
+import asyncio
+from postgrest import AsyncPostgrestClient
+from postgrest.constants import DEFAULT_POSTGREST_CLIENT_HEADERS
+from postgrest.types import ReturnMethod
 import logging
 from typing import List, Dict, Any, Optional
-import asyncio
 from fastapi import HTTPException
+from services.cache import TTLCache
+from services.catalog import SNAPSHOT_TABLES, CatalogSnapshot, ProgramCatalog
+from services.history import RecentTurnsBuffer
+from services.persistence import MessageWriter
+from services.metrics import Metrics, timed
 
 logger = logging.getLogger(__name__)
 
+class PooledPostgrestClient(AsyncPostgrestClient):
+    """Cliente PostgREST asíncrono con un pool keep-alive configurable"""
+
+    def __init__(self, base_url: str, *, limits: httpx.Limits, **kwargs):
+        self.limits = limits
+        super().__init__(base_url, **kwargs)
+
+    def create_session(self, base_url, headers, timeout) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            base_url=base_url,
+            headers=headers,
+            timeout=timeout,
+            limits=self.limits
+        )
+
+def create_postgrest_client(limits: Optional[httpx.Limits] = None, timeout: float = 10.0) -> PooledPostgrestClient:
+    """Cliente PostgREST de Supabase con las credenciales del entorno"""
+    supabase_url = os.getenv('SUPABASE_URL')
+    supabase_key = os.getenv('SUPABASE_KEY')
+    
+    if not supabase_url or not supabase_key:
+        raise ValueError("SUPABASE_URL y SUPABASE_KEY son requeridos")
+    
+    return PooledPostgrestClient(
+        f"{supabase_url.rstrip('/')}/rest/v1",
+        limits=limits or httpx.Limits(),
+        headers={
+            **DEFAULT_POSTGREST_CLIENT_HEADERS,
+            'apiKey': supabase_key,
+            'Authorization': f"Bearer {supabase_key}"
+        },
+        timeout=timeout
+    )
+
+async def fetch_catalog_tables(client: AsyncPostgrestClient, page_size: int = 1000) -> Dict[str, List[Dict[str, Any]]]:
+    """Consulta completas las tablas del snapshot del catálogo; propaga los errores"""
+    async def fetch_all(table: str) -> List[Dict[str, Any]]:
+        rows: List[Dict[str, Any]] = []
+        # PostgREST limita las filas por respuesta: se pagina en un orden estable
+        while True:
+            result = await (
+                client.table(table)
+                    .select('*')
+                    .order('id')
+                    .limit(page_size)
+                    .offset(len(rows))
+                    .execute()
+            )
+            page = result.data or []
+            rows.extend(page)
+            if len(page) < page_size:
+                return rows
+
+    tables = [table for table, _ in SNAPSHOT_TABLES]
+    return dict(zip(tables, await asyncio.gather(*(fetch_all(table) for table in tables))))
+
 class SupabaseService:
-    def __init__(self):
-        supabase_url = os.getenv('SUPABASE_URL')
-        supabase_key = os.getenv('SUPABASE_KEY')
-        
-        if not supabase_url or not supabase_key:
-            raise ValueError("SUPABASE_URL y SUPABASE_KEY son requeridos")
-        
-        self.client = create_client(supabase_url, supabase_key)
+    def __init__(
+        self,
+        limits: Optional[httpx.Limits] = None,
+        timeout: float = 10.0,
+        cache: Optional[TTLCache] = None,
+        catalog_refresh_interval: float = 300.0,
+        history: Optional[RecentTurnsBuffer] = None,
+        writer: Optional[MessageWriter] = None,
+        ack_before_flush: bool = False,
+        metrics: Optional[Metrics] = None,
+        catalog_path: Optional[str] = None,
+        catalog_poll_interval: float = 5.0,
+        catalog_load_backoff: float = 30.0,
+        catalog_snapshot: Optional[CatalogSnapshot] = None
+    ):
+        self.client = create_postgrest_client(limits, timeout)
+        self.cache = cache or TTLCache()
+        self.history = history or RecentTurnsBuffer()
+        # Chatbots, programas y planes se leen del snapshot en memoria, sin consultas por petición
+        self.catalog = ProgramCatalog(
+            self._fetch_catalog,
+            catalog_refresh_interval,
+            path=catalog_path,
+            poll_interval=catalog_poll_interval,
+            load_backoff=catalog_load_backoff,
+            snapshot=catalog_snapshot
+        )
+        # Sin writer cada mensaje se inserta en línea, una fila por petición
+        self.writer = writer
+        self.ack_before_flush = ack_before_flush
+        self.metrics = metrics or Metrics()
+
+    def start(self) -> None:
+        """Inicia el refresco del catálogo y la escritura diferida de mensajes"""
+        self.catalog.start()
+        if self.writer:
+            self.writer.start(self._insert_messages, self._messages_flushed, self._messages_failed)
+
+    async def drain(self, timeout: float) -> None:
+        """Escribe los mensajes pendientes antes del apagado"""
+        if self.writer:
+            await self.writer.drain(timeout)
+
+    async def aclose(self) -> None:
+        """Cierra el pool de conexiones hacia Supabase"""
+        await self.catalog.stop()
+        await self.client.aclose()
+        if self.history.versions:
+            self.history.versions.close()
 
-    async def save_message(self, message_data: Dict[str, Any]) -> None:
-        """Guarda un mensaje en la base de datos"""
+    @timed('supabase_seconds')
+    async def save_message(self, message_data: Dict[str, Any], background: bool = False) -> None:
+        """Guarda un mensaje en la base de datos
+
+        Con escritura diferida el mensaje se encola y se inserta en lote. Se espera a
+        que el lote llegue a la base de datos salvo con ack_before_flush o background.
+        """
         try:
             required_fields = ['conversacion_id', 'emisor_tipo', 'emisor_id', 'contenido']
             for field in required_fields:
                 if field not in message_data:
                     raise ValueError(f"Campo requerido faltante: {field}")
             
-            await asyncio.to_thread(
-                self.client.table('mensajes').insert(message_data).execute
-            )
-            logger.debug(f"Mensaje guardado: {message_data['conversacion_id']}")
+            if self.writer is None:
+                saved = await self._insert_message(message_data)
+                self._remember(message_data, saved.get('timestamp'))
+                logger.debug("Mensaje guardado: %s", message_data['conversacion_id'])
+                return
+            
+            # El timestamp se asigna al encolar para conservar el orden dentro del lote
+            row = {**message_data, 'timestamp': message_data.get('timestamp') or self.writer.next_timestamp()}
+            written = await self.writer.enqueue(row)
+            self._remember(row, row['timestamp'])
+            if not (background or self.ack_before_flush):
+                await written
+                logger.debug("Mensaje guardado: %s", message_data['conversacion_id'])
         
         except Exception as e:
             logger.error(f"Error al guardar mensaje: {e}")
@@ -37,105 +156,216 @@ class SupabaseService:
                 detail=f"Error al guardar mensaje: {str(e)}"
             )
 
+    def _remember(self, message_data: Dict[str, Any], timestamp: Optional[str]) -> None:
+        self.history.append(message_data['conversacion_id'], {
+            'contenido': message_data['contenido'],
+            'emisor_tipo': message_data['emisor_tipo'],
+            'timestamp': timestamp
+        })
+
+    @timed('supabase_query_seconds')
+    async def _insert_message(self, message_data: Dict[str, Any]) -> Dict[str, Any]:
+        result = await self.client.table('mensajes').insert(message_data).execute()
+        return result.data[0] if result.data else message_data
+
+    @timed('supabase_query_seconds')
+    async def _insert_messages(self, rows: List[Dict[str, Any]]) -> None:
+        await self.client.table('mensajes').insert(rows, returning=ReturnMethod.minimal).execute()
+
+    def _messages_flushed(self, rows: List[Dict[str, Any]]) -> None:
+        for conversation_id in {row['conversacion_id'] for row in rows}:
+            self.history.touch(conversation_id)
+
+    def _messages_failed(self, rows: List[Dict[str, Any]]) -> None:
+        # El buffer ya tenía esos turnos: se descartan para no servir mensajes que no existen
+        for conversation_id in {row['conversacion_id'] for row in rows}:
+            self.history.discard(conversation_id)
+
+    @timed('supabase_seconds')
     async def get_chatbot_config(self, chatbot_id: str) -> Optional[Dict[str, Any]]:
         """Obtiene la configuración de un chatbot"""
         try:
-            result = await asyncio.to_thread(
-                lambda: self.client.table('chatbots')
-                    .select('*')
-                    .eq('id', chatbot_id)
-                    .single()
-                    .execute()
+            snapshot = self.catalog.snapshot_for('chatbots', chatbot_id)
+            if snapshot and chatbot_id in snapshot.chatbots:
+                return snapshot.chatbots[chatbot_id]
+            # Un chatbot creado después del último snapshot se consulta con la caché
+            return await self.cache.get_or_load(
+                ('chatbots', chatbot_id),
+                lambda: self._fetch_row('chatbots', 'id', chatbot_id)
             )
-            return result.data if result else None
         
         except Exception as e:
             logger.error(f"Error al obtener configuración del chatbot: {e}")
             return None
 
-    async def get_conversation_history(self, conversation_id: str) -> List[str]:
-        """Obtiene el historial de una conversación"""
+    @timed('supabase_seconds')
+    async def get_conversation_history(self, conversation_id: str, limit: int = 10) -> List[Dict[str, Any]]:
+        """Obtiene los últimos turnos de una conversación, del más antiguo al más reciente"""
         try:
-            result = await asyncio.to_thread(
-                lambda: self.client.table('mensajes')
-                    .select('contenido')
-                    .eq('conversacion_id', conversation_id)
-                    .order('timestamp')
-                    .execute()
-            )
-            return [msg['contenido'] for msg in result.data] if result.data else []
+            turns = self.history.get(conversation_id)
+            if turns is not None:
+                return turns[-limit:]
+
+            # Se toma la versión antes de consultar: una escritura concurrente invalida el resultado
+            version = self.history.version(conversation_id)
+            known = self.history.peek(conversation_id)
+            since = known[-1].get('timestamp') if known else None
+            rows = await self._fetch_turns(conversation_id, self.history.max_turns, since)
+            if since and len(rows) < self.history.max_turns:
+                # Solo llegaron los turnos nuevos: se completan con los ya conocidos
+                rows = (known + rows)[-self.history.max_turns:]
+            self.history.seed(conversation_id, rows, version)
+            return rows[-limit:]
         
         except Exception as e:
             logger.error(f"Error al obtener historial de conversación: {e}")
             return []
 
-    async def get_program_mentions(self, history: List[str]) -> List[str]:
-        """Obtiene menciones de programas en el historial"""
+    @timed('supabase_query_seconds')
+    async def _fetch_turns(self, conversation_id: str, limit: int, since: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Consulta los últimos turnos (opcionalmente solo los posteriores a since) ordenados en el servidor"""
+        query = (
+            self.client.table('mensajes')
+                .select('contenido, emisor_tipo, timestamp')
+                .eq('conversacion_id', conversation_id)
+        )
+        if since:
+            query = query.gt('timestamp', since)
+        result = await query.order('timestamp', desc=True).limit(limit).execute()
+        return list(reversed(result.data)) if result.data else []
+
+    @timed('supabase_seconds')
+    async def get_conversation_status(self, conversation_id: str) -> Optional[str]:
+        """Obtiene el estado de una conversación ('chatbot_activo' o 'agente_activo')"""
         try:
-            # Obtener todos los programas
-            result = await asyncio.to_thread(
-                lambda: self.client.table('programas_academicos')
-                    .select('id, nombre')
+            return await self.cache.get_or_load(
+                ('conversaciones', conversation_id),
+                lambda: self._fetch_conversation_status(conversation_id)
+            )
+        
+        except Exception as e:
+            logger.error(f"Error al obtener estado de la conversación: {e}")
+            return None
+
+    async def _fetch_conversation_status(self, conversation_id: str) -> Optional[str]:
+        row = await self._fetch_row('conversaciones', 'id', conversation_id)
+        return row.get('estado') if row else None
+
+    @timed('supabase_seconds')
+    async def update_conversation_status(self, conversation_id: str, status: str) -> bool:
+        """Actualiza el estado de una conversación; False si la conversación no existe"""
+        try:
+            result = await (
+                self.client.table('conversaciones')
+                    .update({'estado': status})
+                    .eq('id', conversation_id)
                     .execute()
             )
-            
-            if not result.data:
-                return []
-            
-            # Buscar menciones en el historial
-            mentions = []
-            for programa in result.data:
-                if any(programa['nombre'].lower() in msg.lower() for msg in history):
-                    mentions.append(programa['id'])
-            
-            return mentions
+        
+        except Exception as e:
+            logger.error(f"Error al actualizar estado de la conversación: {e}")
+            raise HTTPException(
+                status_code=500,
+                detail=f"Error al actualizar estado de la conversación: {str(e)}"
+            )
+        
+        if not result.data:
+            return False
+        # El worker que cambia el estado lo conoce de inmediato; los demás lo vuelven a consultar
+        self.cache.set(('conversaciones', conversation_id), status)
+        return True
+
+    @timed('supabase_seconds')
+    async def get_program_mentions(self, history: List[str]) -> List[str]:
+        """Obtiene menciones de programas en el historial, la más reciente al final"""
+        try:
+            return await self.catalog.find_mentions(history)
         
         except Exception as e:
             logger.error(f"Error al buscar menciones de programas: {e}")
             return []
 
+    @timed('supabase_seconds')
     async def get_available_programs(self) -> List[Dict[str, Any]]:
         """Obtiene la lista de programas disponibles"""
         try:
-            result = await asyncio.to_thread(
-                lambda: self.client.table('programas_academicos')
-                    .select('id, nombre')
-                    .execute()
-            )
-            return result.data if result.data else []
+            if await self.catalog.ensure_loaded():
+                return list(self.catalog.programs)
+            return await self._fetch_programs()
         
         except Exception as e:
             logger.error(f"Error al obtener programas disponibles: {e}")
             return []
 
+    @timed('supabase_query_seconds')
+    async def _fetch_programs(self) -> List[Dict[str, Any]]:
+        """Consulta id y nombre de todos los programas; propaga los errores"""
+        result = await (
+            self.client.table('programas_academicos')
+                .select('id, nombre')
+                .execute()
+        )
+        return result.data if result.data else []
+
+    @timed('supabase_query_seconds')
+    async def _fetch_catalog(self) -> Dict[str, List[Dict[str, Any]]]:
+        return await fetch_catalog_tables(self.client)
+
+    @timed('supabase_seconds')
     async def get_study_plan(self, programa_id: str) -> Optional[Dict[str, Any]]:
         """Obtiene el plan de estudios de un programa"""
         try:
-            result = await asyncio.to_thread(
-                lambda: self.client.table('planes_estudio')
-                    .select('*')
-                    .eq('programa_id', programa_id)
-                    .single()
-                    .execute()
+            snapshot = self.catalog.snapshot_for('planes_estudio', programa_id)
+            if snapshot and programa_id in snapshot.programs:
+                # El programa ya existía en el snapshot: si no trae plan, es que no tiene
+                return snapshot.study_plans.get(programa_id)
+            return await self.cache.get_or_load(
+                ('planes_estudio', programa_id),
+                lambda: self._fetch_row('planes_estudio', 'programa_id', programa_id)
             )
-            return result.data if result else None
         
         except Exception as e:
             logger.error(f"Error al obtener plan de estudios: {e}")
             return None
 
+    @timed('supabase_seconds')
     async def get_program_info(self, programa_id: str) -> Optional[Dict[str, Any]]:
         """Obtiene información detallada de un programa"""
         try:
-            result = await asyncio.to_thread(
-                lambda: self.client.table('programas_academicos')
-                    .select('*')
-                    .eq('id', programa_id)
-                    .single()
-                    .execute()
+            snapshot = self.catalog.snapshot_for('programas_academicos', programa_id)
+            if snapshot and programa_id in snapshot.programs:
+                return snapshot.programs[programa_id]
+            return await self.cache.get_or_load(
+                ('programas_academicos', programa_id),
+                lambda: self._fetch_row('programas_academicos', 'id', programa_id)
             )
-            return result.data if result else None
         
         except Exception as e:
             logger.error(f"Error al obtener información del programa: {e}")
-            return None
\ No newline at end of file
+            return None
+
+    @timed('supabase_query_seconds')
+    async def _fetch_row(self, table: str, column: str, value: str) -> Optional[Dict[str, Any]]:
+        """Consulta una fila; devuelve None solo si no existe y propaga los errores"""
+        result = await (
+            self.client.table(table)
+                .select('*')
+                .eq(column, value)
+                .maybe_single()
+                .execute()
+        )
+        return result.data if result else None
+
+    def invalidate_chatbot(self, chatbot_id: str) -> int:
+        """Descarta la configuración en caché de un chatbot y la oculta del snapshot hasta refrescarlo"""
+        self.catalog.invalidate('chatbots', chatbot_id)
+        return self.cache.invalidate([('chatbots', chatbot_id)])
+
+    def invalidate_program(self, programa_id: str) -> int:
+        """Descarta la información y el plan de estudios en caché de un programa y los oculta del snapshot"""
+        self.catalog.invalidate('programas_academicos', programa_id)
+        self.catalog.invalidate('planes_estudio', programa_id)
+        return self.cache.invalidate([
+            ('programas_academicos', programa_id),
+            ('planes_estudio', programa_id)
+        ])
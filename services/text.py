@@ -0,0 +1,18 @@
+import re
+import unicodedata
+
+_WHITESPACE = re.compile(r'\s+')
+
+def normalize_text(text: str) -> str:
+    """Normaliza un texto para comparaciones: sin tildes, en minúsculas y con espacios simples"""
+    if not text:
+        return ''
+    decomposed = unicodedata.normalize('NFKD', text)
+    stripped = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return _WHITESPACE.sub(' ', stripped.casefold()).strip()
+
+_PUNCTUATION = re.compile(r'[^\w\s]')
+
+def normalize_question(text: str) -> str:
+    """Normaliza una pregunta para compararla: además de tildes y mayúsculas, ignora la puntuación"""
+    return _WHITESPACE.sub(' ', _PUNCTUATION.sub(' ', normalize_text(text))).strip()
@@ -0,0 +1,92 @@
+import time
+import asyncio
+from contextlib import contextmanager
+from typing import Any, Awaitable, Dict, Iterator, Optional
+
+class RequestBudget:
+    """Presupuesto de latencia compartido por todas las etapas de una petición
+
+    Las etapas obligatorias pueden usar todo el tiempo restante. Las opcionales
+    (enriquecimientos) solo usan lo que sobra después de reservar tiempo para
+    el modelo, y se omiten si ese margen ya se agotó.
+    """
+
+    def __init__(self, total: float, reserve: float = 0.0, metrics: Optional[Any] = None):
+        self.total = total
+        self.reserve = reserve
+        self.started = time.monotonic()
+        self.deadline = self.started + total
+        self.timings: Dict[str, float] = {}
+        self.skipped: list = []
+        self.metrics = metrics
+
+    def remaining(self) -> float:
+        return max(0.0, self.deadline - time.monotonic())
+
+    def optional_remaining(self) -> float:
+        return max(0.0, self.remaining() - self.reserve)
+
+    def record(self, stage: str, started: float) -> None:
+        elapsed = time.monotonic() - started
+        self.timings[stage] = round(elapsed * 1000, 2)
+        if self.metrics:
+            self.metrics.observe('stage_seconds', elapsed, stage=stage)
+
+    def skip(self, stage: str) -> None:
+        self.skipped.append(stage)
+        if self.metrics:
+            self.metrics.inc('stage_skipped_total', stage=stage)
+
+    @contextmanager
+    def measure(self, stage: str) -> Iterator[None]:
+        """Registra la duración de un bloque como una etapa más"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(stage, started)
+
+    async def run(self, stage: str, awaitable: Awaitable, optional: bool = False, default: Any = None) -> Any:
+        """Ejecuta una etapa con el tiempo que le queda al presupuesto
+
+        Si la etapa es opcional y se agota el margen devuelve ``default`` en lugar
+        de fallar; las etapas obligatorias propagan ``asyncio.TimeoutError``.
+        """
+        timeout = self.optional_remaining() if optional else self.remaining()
+        if timeout <= 0:
+            _close(awaitable)
+            if optional:
+                self.skip(stage)
+                return default
+            raise asyncio.TimeoutError()
+
+        started = time.monotonic()
+        try:
+            return await asyncio.wait_for(awaitable, timeout=timeout)
+        except asyncio.TimeoutError:
+            if optional:
+                self.skip(stage)
+                return default
+            raise
+        finally:
+            self.record(stage, started)
+
+    def summary(self) -> str:
+        parts = [f"{stage}={ms}ms" for stage, ms in self.timings.items()]
+        if self.skipped:
+            parts.append(f"omitidas={','.join(self.skipped)}")
+        parts.append(f"total={round((time.monotonic() - self.started) * 1000, 2)}ms")
+        return ' '.join(parts)
+
+    def server_timing(self) -> str:
+        """Valor del encabezado Server-Timing con las etapas medidas hasta ahora"""
+        parts = [f"{stage};dur={ms}" for stage, ms in self.timings.items()]
+        parts.append(f"total;dur={round((time.monotonic() - self.started) * 1000, 2)}")
+        return ', '.join(parts)
+
+def _close(awaitable: Awaitable) -> None:
+    # Evita el aviso de corrutina nunca esperada cuando se omite una etapa
+    if isinstance(awaitable, asyncio.Future):
+        awaitable.cancel()
+    elif hasattr(awaitable, 'close'):
+        awaitable.close()
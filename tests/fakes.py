@@ -0,0 +1,42 @@
+import asyncio
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence
+from services.llm_client import ChatCompletion
+
+class FakeChatClient:
+    """Cliente del modelo para las pruebas: cuenta las llamadas y tarda o falla a pedido"""
+
+    def __init__(
+        self,
+        text: str = 'Hola, ¿en qué te puedo ayudar?',
+        delay: float = 0.0,
+        error: Optional[Exception] = None,
+        chunks: Optional[Sequence[str]] = None
+    ):
+        self.text = text
+        self.delay = delay
+        self.error = error
+        self.chunks = chunks
+        self.calls = 0
+        self.streamed = 0
+
+    async def generate(self, messages: List[Dict[str, str]]) -> ChatCompletion:
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return ChatCompletion(self.text, 'stop', {'prompt_tokens': 10, 'completion_tokens': 5})
+
+    async def stream(self, messages: List[Dict[str, str]]) -> AsyncIterator[ChatCompletion]:
+        self.calls += 1
+        for chunk in self.chunks if self.chunks is not None else [self.text]:
+            await asyncio.sleep(self.delay)
+            if self.error is not None:
+                raise self.error
+            self.streamed += 1
+            yield ChatCompletion(chunk)
+
+    async def aclose(self) -> None:
+        pass
+
+def run(coro: Any) -> Any:
+    return asyncio.run(coro)
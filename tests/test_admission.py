@@ -0,0 +1,41 @@
+import time
+from services.admission import AdmissionController, TokenBucket, _peek
+from services.limiter import ConcurrencyLimiter
+
+def test_token_bucket_allows_burst_then_waits():
+    bucket = TokenBucket(rate=10.0, burst=3.0)
+    assert [bucket.take() for _ in range(3)] == [0.0, 0.0, 0.0]
+    wait = bucket.take()
+    assert 0 < wait <= 0.1
+    time.sleep(wait + 0.01)
+    assert bucket.take() == 0.0
+
+def test_noisy_chatbot_does_not_use_others_quota():
+    controller = AdmissionController(chatbot_rate=0.01, chatbot_burst=2.0)
+    assert controller.admit('ruidoso', 'lead') is None
+    assert controller.admit('ruidoso', 'lead') is None
+    rejection = controller.admit('ruidoso', 'lead')
+    assert rejection.reason == 'chatbot' and rejection.retry_after >= 1
+    assert controller.admit('otro', 'lead') is None
+    assert controller.in_flight == 3
+
+def test_agents_are_admitted_when_saturated():
+    controller = AdmissionController(max_in_flight=1)
+    assert controller.admit('b1', 'lead') is None
+    assert controller.admit('b1', 'lead').reason == 'en_curso'
+    assert controller.admit('b1', 'agente') is None
+    controller.release()
+    controller.release()
+    assert controller.admit('b1', 'lead') is None
+
+def test_llm_queue_limit():
+    limiter = ConcurrencyLimiter()
+    limiter.queued = 5
+    controller = AdmissionController(limiter=limiter, max_llm_queue=5)
+    assert controller.admit('b1', 'lead').reason == 'cola_modelo'
+
+def test_peek_ignores_non_string_fields():
+    assert _peek(b'{"chatbot_id": "b1", "emisor_tipo": "lead"}') == ('b1', 'lead')
+    assert _peek(b'{"chatbot_id": ["b1"], "emisor_tipo": {"a": 1}}') == (None, None)
+    assert _peek(b'[1, 2]') == (None, None)
+    assert _peek(b'no es json') == (None, None)
@@ -0,0 +1,70 @@
+import time
+import asyncio
+import pytest
+from services.ai import AIService, ERROR_MESSAGE, MAX_RESPONSE_CHARS, TIMEOUT_MESSAGE, cap_response
+from tests.fakes import FakeChatClient, run
+
+def make_service(client: FakeChatClient) -> AIService:
+    ai = AIService(backend='http', fallback_model=None)
+    ai.providers.providers[0].client = client
+    return ai
+
+def test_timeout_does_not_retry():
+    client = FakeChatClient(delay=3.0)
+    ai = make_service(client)
+    started = time.monotonic()
+    response = run(ai.generate_response('contexto', [], 'hola', timeout=0.5))
+    assert response == TIMEOUT_MESSAGE
+    assert time.monotonic() - started < 1.5
+    assert client.calls == 1
+
+def test_cancellation_does_not_retry():
+    client = FakeChatClient(delay=3.0)
+    ai = make_service(client)
+
+    async def scenario():
+        task = asyncio.create_task(ai.generate_response('contexto', [], 'hola', timeout=10))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert ai.limiter.in_flight == 0
+
+    run(scenario())
+    assert client.calls == 1
+
+def test_model_error_is_retried_once():
+    client = FakeChatClient(error=RuntimeError('falla del proveedor'))
+    ai = make_service(client)
+    response = run(ai.generate_response('contexto', [], 'hola', timeout=10))
+    assert response == ERROR_MESSAGE
+    assert client.calls == 2
+
+def test_stream_is_capped_like_generate():
+    sentence = 'El programa dura nueve semestres. '
+    text = sentence * 100
+    chunks = [text[i:i + 50] for i in range(0, len(text), 50)]
+    streaming = FakeChatClient(chunks=chunks)
+    ai = make_service(streaming)
+
+    async def collect():
+        return [chunk async for chunk in ai.stream_response('contexto', [], 'hola')]
+
+    parts = run(collect())
+    emitted = ''.join(parts)
+    assert len(emitted) == MAX_RESPONSE_CHARS
+    # El stream del proveedor se cerró al llegar al límite
+    assert streaming.streamed < len(chunks)
+
+    generated = run(make_service(FakeChatClient(text=text)).generate_response('contexto', [], 'hola', timeout=10))
+    assert cap_response(emitted) == generated
+    assert generated.endswith('semestres.')
+    assert len(generated) < MAX_RESPONSE_CHARS
+
+def test_short_stream_is_not_trimmed():
+    ai = make_service(FakeChatClient(chunks=['Hola. ', 'Bien.']))
+
+    async def collect():
+        return [chunk async for chunk in ai.stream_response('contexto', [], 'hola')]
+
+    assert cap_response(''.join(run(collect()))) == 'Hola. Bien.'
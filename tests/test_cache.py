@@ -0,0 +1,61 @@
+import asyncio
+import pytest
+from services.cache import TTLCache
+from tests.fakes import run
+
+def test_concurrent_misses_load_once():
+    cache = TTLCache()
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {'id': 'b1'}
+
+    async def scenario():
+        return await asyncio.gather(*(cache.get_or_load(('chatbots', 'b1'), loader) for _ in range(5)))
+
+    results = run(scenario())
+    assert len(calls) == 1
+    assert all(result == {'id': 'b1'} for result in results)
+    assert cache.stats()['coalesced'] == 4
+
+def test_missing_rows_are_cached_and_errors_are_not():
+    cache = TTLCache(negative_ttl=60.0)
+    calls = []
+
+    async def missing():
+        calls.append('missing')
+        return None
+
+    async def failing():
+        calls.append('failing')
+        raise ConnectionError('caído')
+
+    async def scenario():
+        assert await cache.get_or_load(('chatbots', 'x'), missing) is None
+        assert await cache.get_or_load(('chatbots', 'x'), missing) is None
+        for _ in range(2):
+            with pytest.raises(ConnectionError):
+                await cache.get_or_load(('chatbots', 'y'), failing)
+
+    run(scenario())
+    assert calls == ['missing', 'failing', 'failing']
+
+def test_invalidation_during_load_discards_value():
+    cache = TTLCache()
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {'version': len(calls)}
+
+    async def scenario():
+        loading = asyncio.create_task(cache.get_or_load(('chatbots', 'b1'), loader))
+        await asyncio.sleep(0.01)
+        cache.invalidate([('chatbots', 'b1')], broadcast=False)
+        await loading
+        return await cache.get_or_load(('chatbots', 'b1'), loader)
+
+    assert run(scenario()) == {'version': 2}
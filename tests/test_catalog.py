@@ -0,0 +1,67 @@
+import time
+from services.catalog import ProgramCatalog
+from tests.fakes import run
+
+def tables(prompt: str):
+    return {
+        'chatbots': [{'id': 'b1', 'prompt': prompt}],
+        'programas_academicos': [{'id': 'p1', 'nombre': 'Psicología'}],
+        'planes_estudio': []
+    }
+
+class Loader:
+    def __init__(self):
+        self.prompt = 'viejo'
+        self.fail = False
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        if self.fail:
+            raise ConnectionError('base de datos caída')
+        return tables(self.prompt)
+
+def test_invalidated_row_is_hidden_until_a_later_refresh():
+    loader = Loader()
+    catalog = ProgramCatalog(loader, load_backoff=0)
+
+    async def scenario():
+        assert await catalog.ensure_loaded()
+        assert catalog.snapshot_for('chatbots', 'b1').chatbots['b1']['prompt'] == 'viejo'
+
+        catalog.invalidate('chatbots', 'b1')
+        assert catalog.snapshot_for('chatbots', 'b1') is None
+        # Las demás filas se siguen sirviendo del snapshot
+        assert catalog.snapshot_for('programas_academicos', 'p1') is catalog.snapshot
+
+        # Mientras el refresco falla la fila sigue oculta
+        loader.fail = True
+        try:
+            await catalog.refresh()
+        except ConnectionError:
+            pass
+        assert catalog.snapshot_for('chatbots', 'b1') is None
+
+        loader.fail = False
+        loader.prompt = 'nuevo'
+        await catalog.refresh()
+        assert catalog.snapshot_for('chatbots', 'b1').chatbots['b1']['prompt'] == 'nuevo'
+        assert catalog.stats()['invalidadas'] == 0
+
+    run(scenario())
+
+def test_refresh_started_before_invalidation_does_not_unhide_row():
+    loader = Loader()
+    catalog = ProgramCatalog(loader)
+
+    async def scenario():
+        await catalog.ensure_loaded()
+        started = catalog.checked_at
+        catalog.invalidate('chatbots', 'b1')
+        # Una verificación anterior a la invalidación (por ejemplo adoptada de otro worker) no alcanza
+        catalog.checked_at = started
+        assert catalog.snapshot_for('chatbots', 'b1') is None
+        catalog.checked_at = time.time()
+        assert catalog.snapshot_for('chatbots', 'b1') is catalog.snapshot
+
+    run(scenario())
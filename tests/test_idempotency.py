@@ -0,0 +1,177 @@
+import asyncio
+import pytest
+from services.idempotency import ConversationBusyError, MessageGuard, SCHEMA
+from services.local_store import LocalStore
+from tests.fakes import run
+
+MESSAGE = {'conversation_id': 'conv1', 'emisor_tipo': 'lead', 'lead_id': 'l1', 'content': 'sí'}
+
+@pytest.fixture
+def store(tmp_path):
+    store = LocalStore(str(tmp_path / 'idempotency.sqlite3'), SCHEMA)
+    yield store
+    store.close()
+
+def counting_compute(calls):
+    async def compute(received: bool):
+        calls.append(received)
+        return {'response': f'respuesta {len(calls)}', 'status': 'success'}
+    return compute
+
+def test_repeated_message_without_key_is_processed_again(store):
+    guard = MessageGuard(store)
+    calls = []
+
+    async def scenario():
+        results = []
+        for _ in range(2):
+            key, ttl = guard.key_for(MESSAGE)
+            results.append(await guard.run(key, ttl, 'conv1', counting_compute(calls)))
+        return results
+
+    first, second = run(scenario())
+    assert len(calls) == 2
+    assert first == ({'response': 'respuesta 1', 'status': 'success'}, False)
+    assert second == ({'response': 'respuesta 2', 'status': 'success'}, False)
+
+def test_message_with_key_is_replayed(store):
+    guard = MessageGuard(store)
+    calls = []
+
+    async def scenario():
+        results = []
+        for _ in range(2):
+            key, ttl = guard.key_for(MESSAGE, 'pasarela-1')
+            results.append(await guard.run(key, ttl, 'conv1', counting_compute(calls)))
+        return results
+
+    first, second = run(scenario())
+    assert len(calls) == 1
+    assert second == (first[0], True)
+
+def test_content_window_deduplicates_when_enabled(store):
+    guard = MessageGuard(store, window=5.0)
+    assert guard.key_for(MESSAGE) == guard.key_for(dict(MESSAGE))
+    assert guard.key_for(MESSAGE) != guard.key_for({**MESSAGE, 'content': 'no'})
+
+def test_concurrent_duplicates_share_one_computation(store):
+    guard = MessageGuard(store)
+    calls = []
+
+    async def slow_compute(received: bool):
+        calls.append(received)
+        await asyncio.sleep(0.1)
+        return {'response': 'única', 'status': 'success'}
+
+    async def scenario():
+        key, ttl = guard.key_for(MESSAGE, 'pasarela-2')
+        return await asyncio.gather(*(guard.run(key, ttl, 'conv1', slow_compute) for _ in range(3)))
+
+    results = run(scenario())
+    assert len(calls) == 1
+    assert [replayed for _, replayed in results] == [False, True, True]
+    assert guard.counts['adjunto'] == 2
+
+def test_retry_after_failure_does_not_save_message_again(store):
+    guard = MessageGuard(store)
+    received = []
+
+    async def scenario():
+        key, ttl = guard.key_for(MESSAGE, 'pasarela-3')
+
+        async def failing(was_received: bool):
+            received.append(was_received)
+            await guard.mark_received(key, 'conv1', ttl)
+            raise RuntimeError('falla del modelo')
+
+        async def succeeding(was_received: bool):
+            received.append(was_received)
+            return {'response': 'ok', 'status': 'success'}
+
+        with pytest.raises(RuntimeError):
+            await guard.run(key, ttl, 'conv1', failing)
+        return await guard.run(key, ttl, 'conv1', succeeding)
+
+    body, replayed = run(scenario())
+    assert received == [False, True]
+    assert (body['response'], replayed) == ('ok', False)
+
+def test_messages_of_a_conversation_run_in_arrival_order(store):
+    guard = MessageGuard(store)
+    events = []
+
+    def compute_for(name: str, delay: float):
+        async def compute(received: bool):
+            events.append(f'{name}:inicio')
+            await asyncio.sleep(delay)
+            events.append(f'{name}:fin')
+            return {'response': name}
+        return compute
+
+    async def scenario():
+        tasks = []
+        for name, delay in (('a', 0.1), ('b', 0.0), ('c', 0.05)):
+            key, ttl = guard.key_for({**MESSAGE, 'content': name}, name)
+            tasks.append(asyncio.create_task(guard.run(key, ttl, 'conv1', compute_for(name, delay))))
+            await asyncio.sleep(0)
+        other_key, ttl = guard.key_for({**MESSAGE, 'conversation_id': 'conv2'}, 'x')
+        other = asyncio.create_task(guard.run(other_key, ttl, 'conv2', compute_for('otra', 0.0)))
+        await asyncio.gather(*tasks, other)
+
+    run(scenario())
+    own = [event for event in events if not event.startswith('otra')]
+    assert own == ['a:inicio', 'a:fin', 'b:inicio', 'b:fin', 'c:inicio', 'c:fin']
+    # Otra conversación no espera a la primera
+    assert events.index('otra:fin') < events.index('a:fin')
+    assert guard.stats()['conversaciones_en_proceso'] == 0
+
+def test_conversation_lease_is_exclusive_between_workers(tmp_path):
+    path = str(tmp_path / 'idempotency.sqlite3')
+    first_store, second_store = LocalStore(path, SCHEMA), LocalStore(path, SCHEMA)
+    first = MessageGuard(first_store, lease=0.3)
+    second = MessageGuard(second_store, wait_timeout=0.1, poll_interval=0.01)
+    second.owner = 'otro-worker'
+
+    async def scenario():
+        async with first.ordered('conv1'):
+            with pytest.raises(ConversationBusyError):
+                async with second.ordered('conv1'):
+                    pass
+        # Liberado el turno, el otro worker lo toma
+        async with second.ordered('conv1'):
+            pass
+
+        # Un turno que no se liberó (worker muerto) se toma al vencer
+        await first._acquire_lease('conv2')
+        second.wait_timeout = 1.0
+        async with second.ordered('conv2'):
+            pass
+
+    try:
+        run(scenario())
+    finally:
+        first_store.close()
+        second_store.close()
+
+def test_generation_claim_blocks_duplicates_until_released_or_expired(store):
+    guard = MessageGuard(store, lease=0.1)
+
+    async def scenario():
+        attempt = await guard.claim('clave')
+        assert attempt is not None
+        assert await guard.claim('clave') is None
+        await guard.release('clave', attempt)
+
+        attempt = await guard.claim('clave')
+        assert attempt is not None
+        await asyncio.sleep(0.06)
+        await guard.renew('clave', attempt)
+        await asyncio.sleep(0.06)
+        # Renovada: sigue vigente
+        assert await guard.claim('clave') is None
+        await asyncio.sleep(0.12)
+        # Vencida: el intento original murió y otro la toma
+        assert await guard.claim('clave') is not None
+
+    run(scenario())
+    assert guard.counts['generando'] == 2
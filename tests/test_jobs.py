@@ -0,0 +1,136 @@
+import time
+import asyncio
+from services.jobs import (
+    DONE, FAILED, PENDING, RUNNING, SCHEMA, JobRetryError, MessageJobs, _claim, _prune
+)
+from services.local_store import LocalStore
+from tests.fakes import run
+
+PAYLOAD = {'conversation_id': 'conv1', 'content': 'hola'}
+
+def make_jobs(tmp_path, **kwargs) -> MessageJobs:
+    store = LocalStore(str(tmp_path / 'jobs.sqlite3'), SCHEMA)
+    return MessageJobs(store, workers=2, poll_interval=0.05, **kwargs)
+
+async def wait_status(jobs: MessageJobs, job_id: str, status: str, timeout: float = 3.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = await jobs.get(job_id)
+        if job['status'] == status:
+            return job
+        await asyncio.sleep(0.02)
+    raise AssertionError(f"El trabajo quedó en {job['status']}, se esperaba {status}")
+
+def test_submitted_job_completes_once(tmp_path):
+    calls = []
+
+    async def handler(payload):
+        calls.append(payload)
+        return {'response': 'listo', 'status': 'success'}
+
+    async def scenario():
+        jobs = make_jobs(tmp_path)
+        jobs.start(handler)
+        try:
+            created = await jobs.submit('conv1', PAYLOAD)
+            assert created['status'] == PENDING
+            job = await wait_status(jobs, created['job_id'], DONE)
+            # Los barridos siguientes no lo vuelven a tomar
+            await asyncio.sleep(0.2)
+            return job
+        finally:
+            await jobs.aclose()
+
+    job = run(scenario())
+    assert calls == [PAYLOAD]
+    assert job['attempts'] == 1
+    assert job['result'] == {'response': 'listo', 'status': 'success'}
+
+def test_retry_error_postpones_job_until_sweep(tmp_path):
+    attempts = []
+
+    async def handler(payload):
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise JobRetryError('modelo saturado', retry_after=0.2)
+        return {'response': 'segundo intento'}
+
+    async def scenario():
+        jobs = make_jobs(tmp_path)
+        jobs.start(handler)
+        try:
+            created = await jobs.submit('conv1', PAYLOAD)
+            job = await wait_status(jobs, created['job_id'], DONE)
+            return job, jobs.counts
+        finally:
+            await jobs.aclose()
+
+    job, counts = run(scenario())
+    assert job['attempts'] == 2
+    assert attempts[1] - attempts[0] >= 0.2
+    assert counts['reintento'] == 1 and counts['recuperado'] == 1
+
+def test_job_fails_after_max_attempts(tmp_path):
+    async def handler(payload):
+        raise JobRetryError('conversación ocupada', retry_after=0.01)
+
+    async def scenario():
+        jobs = make_jobs(tmp_path, max_attempts=2)
+        jobs.start(handler)
+        try:
+            created = await jobs.submit('conv1', PAYLOAD)
+            return await wait_status(jobs, created['job_id'], FAILED)
+        finally:
+            await jobs.aclose()
+
+    job = run(scenario())
+    assert job['attempts'] == 2
+    assert job['error'] == 'conversación ocupada'
+
+def test_expired_lease_of_dead_worker_is_recovered(tmp_path):
+    calls = []
+
+    async def handler(payload):
+        calls.append(payload)
+        return {'response': 'recuperado'}
+
+    async def scenario():
+        jobs = make_jobs(tmp_path)
+        created = await jobs.submit('conv1', PAYLOAD)
+        job_id = created['job_id']
+        jobs._queue.get_nowait()
+        jobs._queued.clear()
+        # Otro worker lo tomó y murió: en curso con el plazo vigente nadie lo toca
+        now = time.time()
+        await jobs.store.run(_claim, job_id, 'muerto', now, now + 0.3, jobs.max_attempts)
+        jobs.start(handler)
+        try:
+            await asyncio.sleep(0.15)
+            assert (await jobs.get(job_id))['status'] == RUNNING
+            assert calls == []
+            # Vencido el plazo, el barrido lo recupera
+            job = await wait_status(jobs, job_id, DONE)
+            return job, jobs.counts['recuperado']
+        finally:
+            await jobs.aclose()
+
+    job, recovered = run(scenario())
+    assert calls == [PAYLOAD]
+    assert job['attempts'] == 2
+    assert recovered == 1
+
+def test_prune_fails_job_whose_last_attempt_died(tmp_path):
+    async def scenario():
+        jobs = make_jobs(tmp_path, max_attempts=1)
+        created = await jobs.submit('conv1', PAYLOAD)
+        job_id = created['job_id']
+        now = time.time()
+        await jobs.store.run(_claim, job_id, 'muerto', now, now - 1, jobs.max_attempts)
+        await jobs.store.run(_prune, time.time(), jobs.max_attempts)
+        job = await jobs.get(job_id)
+        jobs.store.close()
+        return job
+
+    job = run(scenario())
+    assert job['status'] == FAILED
+    assert job['error'] == 'Worker detenido durante el último intento'
@@ -0,0 +1,10 @@
+import logging
+from services.logs import parse_level
+
+def test_parse_level():
+    assert parse_level('info') == logging.INFO
+    assert parse_level(' WARNING ') == logging.WARNING
+    assert parse_level('15') == 15
+    assert parse_level('verbose') is None
+    assert parse_level('') is None
+    assert parse_level(None) is None
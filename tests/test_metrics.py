@@ -0,0 +1,36 @@
+import os
+import threading
+from services.metrics import Metrics
+
+def test_concurrent_flushes_do_not_collide(tmp_path):
+    metrics = Metrics(directory=str(tmp_path))
+    metrics.inc('admission_total', decision='admitido', reason='lead')
+    errors = []
+
+    def flush_many():
+        try:
+            for _ in range(200):
+                metrics.flush()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=flush_many) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
+    assert 'admission_total{decision="admitido",reason="lead"} 1.0' in metrics.render()
+
+def test_render_survives_failed_flush(tmp_path, monkeypatch):
+    metrics = Metrics(directory=str(tmp_path))
+    metrics.inc('admission_total', decision='admitido', reason='lead')
+    metrics.flush()
+
+    def broken():
+        raise OSError('disco lleno')
+
+    monkeypatch.setattr(metrics, 'flush', broken)
+    assert 'admission_total{decision="admitido",reason="lead"} 1.0' in metrics.render()
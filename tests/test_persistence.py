@@ -0,0 +1,99 @@
+import asyncio
+import pytest
+from postgrest.exceptions import APIError
+from services.persistence import MessageWriter
+from tests.fakes import run
+
+def api_error(code: str) -> APIError:
+    return APIError({'message': 'error', 'code': code, 'hint': None, 'details': None})
+
+def rows(n: int):
+    return [{'conversacion_id': 'conv1', 'contenido': f'm{i}'} for i in range(n)]
+
+def test_rows_are_written_in_one_ordered_batch():
+    batches = []
+
+    async def insert(batch):
+        batches.append(list(batch))
+
+    async def scenario():
+        writer = MessageWriter(batch_size=10, flush_interval=0.01)
+        writer.start(insert)
+        pending = []
+        for row in rows(5):
+            row['timestamp'] = writer.next_timestamp()
+            pending.append(await writer.enqueue(row))
+        await asyncio.gather(*pending)
+        await writer.drain(1.0)
+        return writer
+
+    writer = run(scenario())
+    assert [[row['contenido'] for row in batch] for batch in batches] == [['m0', 'm1', 'm2', 'm3', 'm4']]
+    stamps = [row['timestamp'] for row in batches[0]]
+    assert stamps == sorted(stamps) and len(set(stamps)) == 5
+    assert writer.stats()['flushed'] == 5
+
+def test_rejected_batch_is_retried_row_by_row():
+    written = []
+
+    async def insert(batch):
+        if len(batch) > 1:
+            raise api_error('23502')
+        if batch[0]['contenido'] == 'm1':
+            raise api_error('23502')
+        written.extend(row['contenido'] for row in batch)
+
+    async def scenario():
+        writer = MessageWriter(batch_size=10, flush_interval=0.01)
+        failed = []
+        writer.start(insert, on_failed=failed.extend)
+        pending = [await writer.enqueue(row) for row in rows(3)]
+        results = await asyncio.gather(*pending, return_exceptions=True)
+        await writer.drain(1.0)
+        return results, failed, writer
+
+    results, failed, writer = run(scenario())
+    assert written == ['m0', 'm2']
+    assert results[0] is None and results[2] is None
+    assert isinstance(results[1], APIError)
+    assert [row['contenido'] for row in failed] == ['m1']
+    assert writer.failed == 1
+
+def test_transient_error_retries_the_whole_batch():
+    attempts = []
+
+    async def insert(batch):
+        attempts.append(len(batch))
+        if len(attempts) == 1:
+            raise api_error('08006')
+
+    async def scenario():
+        writer = MessageWriter(batch_size=10, flush_interval=0.01)
+        writer.start(insert)
+        pending = [await writer.enqueue(row) for row in rows(2)]
+        await asyncio.gather(*pending)
+        await writer.drain(1.0)
+        return writer
+
+    writer = run(scenario())
+    assert attempts == [2, 2]
+    assert writer.retries == 1 and writer.failed == 0
+
+def test_drain_writes_queued_rows_before_stopping():
+    written = []
+
+    async def insert(batch):
+        await asyncio.sleep(0.01)
+        written.extend(batch)
+
+    async def scenario():
+        writer = MessageWriter(batch_size=3, flush_interval=0.01)
+        writer.start(insert)
+        for row in rows(7):
+            await writer.enqueue(row)
+        await writer.drain(2.0)
+        return writer
+
+    writer = run(scenario())
+    assert len(written) == 7
+    assert writer._task is None
@@ -0,0 +1,116 @@
+import time
+import asyncio
+import pytest
+from services.limiter import ConcurrencyLimiter
+from services.providers import (
+    CLOSED, HALF_OPEN, OPEN, CircuitBreaker, LLMProvider, LLMUnavailableError, ProviderRouter
+)
+from tests.fakes import FakeChatClient, run
+
+MESSAGES = [{'role': 'user', 'content': 'hola'}]
+
+def provider(name: str, client: FakeChatClient, failures: int = 2, reset: float = 0.05) -> LLMProvider:
+    return LLMProvider(name, client, CircuitBreaker(name, failures, reset))
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker('p', failure_threshold=2, reset_timeout=0.05)
+    breaker.record_failure()
+    assert breaker.state == CLOSED and breaker.allow()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    assert breaker.retry_after() >= 1
+
+def test_half_open_allows_a_single_probe():
+    breaker = CircuitBreaker('p', failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == OPEN
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    assert breaker.allow() and breaker.allow()
+
+def test_unreported_probe_is_allowed_again_after_reset_timeout():
+    breaker = CircuitBreaker('p', failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+
+def test_fallback_probe_is_not_spent_while_primary_serves():
+    primary, fallback = FakeChatClient(text='principal'), FakeChatClient(text='respaldo')
+    router = ProviderRouter([provider('p', primary), provider('f', fallback, failures=1)])
+    router.providers[1].breaker.record_failure()
+    time.sleep(0.06)
+
+    result, used = run(router.generate(MESSAGES))
+    assert (result.text, used.name) == ('principal', 'p')
+    assert fallback.calls == 0
+    # La llamada de prueba sigue disponible para cuando haga falta
+    assert router.providers[1].breaker.allow()
+
+def test_failing_primary_falls_back_and_probe_closes_breaker():
+    primary = FakeChatClient(error=RuntimeError('caído'))
+    fallback = FakeChatClient(text='respaldo')
+    router = ProviderRouter([provider('p', primary), provider('f', fallback, failures=1)])
+    router.providers[1].breaker.record_failure()
+    time.sleep(0.06)
+
+    result, used = run(router.generate(MESSAGES))
+    assert (result.text, used.name) == ('respaldo', 'f')
+    assert router.providers[1].breaker.state == CLOSED
+    assert router.providers[0].breaker.failures == 1
+
+def test_all_breakers_open_raises_unavailable():
+    router = ProviderRouter([provider('p', FakeChatClient(), failures=1, reset=30.0)])
+    router.providers[0].breaker.record_failure()
+    with pytest.raises(LLMUnavailableError) as error:
+        run(router.generate(MESSAGES))
+    assert error.value.retry_after >= 1
+
+class SlowFirstClient(FakeChatClient):
+    """La primera llamada tarda; las siguientes responden de inmediato"""
+
+    def __init__(self, text: str):
+        super().__init__(text=text)
+        self.cancelled = False
+
+    async def generate(self, messages):
+        if self.calls == 0:
+            self.calls += 1
+            try:
+                await asyncio.sleep(2.0)
+            except asyncio.CancelledError:
+                self.cancelled = True
+                raise
+        return await super().generate(messages)
+
+def test_hedge_wins_over_slow_call_and_cancels_it():
+    client = SlowFirstClient(text='cubierta')
+    p = provider('p', client)
+    for _ in range(p.latency.min_samples):
+        p.latency.add(0.01)
+    router = ProviderRouter(
+        [p], limiter=ConcurrencyLimiter(max_concurrency=4), hedge=True, hedge_min_delay=0.05, hedge_max_ratio=1.0
+    )
+
+    started = time.monotonic()
+    result, _ = run(router.generate(MESSAGES))
+    assert result.text == 'cubierta'
+    assert time.monotonic() - started < 1.0
+    assert client.calls == 2
+    assert router.hedges == 1
+    assert client.cancelled
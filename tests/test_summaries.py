@@ -0,0 +1,19 @@
+from services.summaries import turns_after
+
+HISTORY = [
+    {'timestamp': '2026-01-01T10:00:00', 'contenido': 'a'},
+    {'timestamp': '2026-01-01T11:00:00+00:00', 'contenido': 'b'},
+    {'contenido': 'recién guardado'},
+    {'timestamp': '2026-01-01T12:00:00Z', 'contenido': 'c'},
+]
+
+def contents(turns):
+    return [turn['contenido'] for turn in turns]
+
+def test_naive_and_aware_timestamps_compare_as_utc():
+    assert contents(turns_after(HISTORY, '2026-01-01T10:30:00Z')) == ['b', 'recién guardado', 'c']
+    assert contents(turns_after(HISTORY, '2026-01-01T10:30:00')) == ['b', 'recién guardado', 'c']
+
+def test_without_cutoff_everything_is_pending():
+    assert turns_after(HISTORY, None) == HISTORY
+    assert turns_after(HISTORY, 'no es fecha') == HISTORY